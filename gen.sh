@@ -1,2 +1,2 @@
 #!/bin/sh
-cat tested | xargs -L 1 -- python3 generator.py -p -r /var/db/repos/gentoo-pypi-sci
+python3 generator.py -d -p -r /var/db/repos/gentoo-pypi-sci --batch tested
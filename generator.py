@@ -1,15 +1,25 @@
 import argparse
 import sys
 import json
-import os
-import requests
-import re
-import glob
-from collections import defaultdict
-from pathlib import Path
-
-# TODO: this dependency can be replaced by `xml`
-import xmltodict
+import time
+import logging
+from logging import info, warn
+from collections import defaultdict, deque
+from pathlib import Path, PurePosixPath
+
+from src.repo_index import RepoIndex
+from src.pypi_fetch import PyPIFetcher
+from src.rate_limit import RequestScheduler
+from src.http_cache import HTTPCache
+from src.pypi_mirror import open_source
+from src.name_index import NameIndex, normalize_pypi_name
+from src.overlay_files import WriteStats
+from src.overlay_bundle import DirectoryOutput, OverlayBundle, archive_mode
+from src.manifest import ManifestWriter, HashCache
+from src.distfiles import DistfileStore, release_distfile
+from src.requirement import parse_requirement, version_hint, marker_extras, marker_variables, InvalidRequirement
+from src import server
+from src import profiling
 
 def regularize_package_name(package):
     """
@@ -74,33 +84,73 @@ class PyPIEbuilder():
     # useless dependencies
     use_blackhole = set(('dev',))
 
-    def __init__(self, category, repo, repoman: bool, recursive: bool, verbose: bool, get_uri_from_pypi: bool):
+    def __init__(self, category, repo, repoman: bool, recursive: bool, verbose: bool, get_uri_from_pypi: bool, fetcher=None,
+                 manifests=None, downloads=None, output=None):
         """
         Input:
             category: String, the default category of the generated ebuild files
-            repo: Path / String, location of the overlay
-            repoman: bool, generate manifest or not
+            repo: Path / String, location of the overlay, a directory or an archive
+            repoman: bool, write the Manifest of generated packages or not
             recursive: bool, recursively generate ebuild or not
             verbose: bool
             get_uri_from_pypi: bool
+            fetcher: PyPIFetcher, shared connection pool to PyPI, a default one is created if None
+            manifests: ManifestWriter, shared with its hash cache, a default one is created if None and repoman
+            downloads: DistfileStore, the sdists are downloaded into it if provided
+            output: DirectoryOutput / OverlayBundle, where the files go, the directory repo if None
         """
         self.category = category
 
-        # key: regularized PyPI project name
-        # value: [Portage category, Portage package]
-        self.existing_packages = dict()
-        # contains: regularized PyPI project name
+        # key: PyPI project name, normalized by the index
+        # value: String, ${CATEGORY}/${PN}, or the dependency string of an exception
+        self.existing_packages = NameIndex(PyPIEbuilder.exceptions)
+        # contains: normalized PyPI project name
         self.missing_packages = set()
+        # PyPI project names waiting to be generated
+        self.queue = deque()
+        # contains: normalized PyPI project name, queued or generated,
+        # so all spellings of a name, e.g. "Typing_Extensions" and "typing-extensions", are generated once
+        self.visited = set()
+        # key: normalized PyPI project name
+        # value: String, why it could not be generated
+        self.failed = dict()
         # path to the repository where I will generate ebuild files
         self.repo = repo
-        # run repoman or not
+        # every file of the overlay, the Manifests included, is written through it
+        self.output = output or DirectoryOutput(Path(repo))
+        # write Manifests or not
         self.repoman = repoman
+        self.manifests = manifests or (ManifestWriter() if repoman else None)
+        # (package dir, [distfile]) whose Manifests are written at the end of resolve()
+        self.pending_manifests = []
+        # download the sdists or not
+        self.downloads = downloads
+        # Futures of the downloads, waited for before the Manifests are written
+        self.pending_downloads = []
         # recursively generate ebuild files or not
         self.recursive = recursive
         # verbose
         self.verbose = verbose
         # whether it should use the uri provided by pypi instead Gentoo's "mirror" syntax
         self.get_uri_from_pypi = get_uri_from_pypi
+        # fetch json metadata from PyPI
+        self.fetcher = fetcher or PyPIFetcher(upstream_template=self.upstream_template)
+        # files written or left as they were
+        self.write_stats = WriteStats()
+
+    def find_existing_package(self, package):
+        """
+        Connect PyPI and Portage -
+        look up the Portage package of a PyPI project, without side effects
+
+        Input:
+            package: String, PyPI project name
+
+        return: String, ${CATEGORY}/${PN}, or None if it does not exist
+        """
+        # exceptions are pinned in the index,
+        # and all spellings of a name meet, e.g. "Foo_Bar", "foo-bar" and "foo.bar"
+        return self.existing_packages.get(package)
 
     def get_package_name(self, package):
         """
@@ -114,26 +164,19 @@ class PyPIEbuilder():
         """
         # regularize it anyway
         package = regularize_package_name(package)
-        # if it matches exceptions, it will return the matching item
-        if package in PyPIEbuilder.exceptions:
-            return PyPIEbuilder.exceptions[package]
-
-        # if it exists in self.existing_pkgs, it will return the matching pkg
-        # if not, then add the pkg to self.missing_pkgs
-        if package in self.existing_packages:
-            category, gentoo_package = self.existing_packages[package]
-            return f'{category}/{gentoo_package}'
-        # there are cases that pypi_id and requirements are inconsistent
-        elif package.replace('-', '_') in self.existing_packages:
-            category, gentoo_package = self.existing_packages[package.replace('-', '_')]
-            return f'{category}/{gentoo_package}'
-        elif package.replace('_', '-') in self.existing_packages:
-            category, gentoo_package = self.existing_packages[package.replace('_', '-')]
-            return f'{category}/{gentoo_package}'
-        else:
-            print("Package '%s' does not exist" % package)
-            self.missing_packages.add(package)
-            return f'{self.category}/{package}'
+        existing = self.find_existing_package(package)
+        if existing is not None:
+            return existing
+        # if not, then add the pkg to self.missing_pkgs, it is reported once however many packages depend on it
+        key = normalize_pypi_name(package)
+        if key not in self.missing_packages:
+            info("Package '%s' does not exist" % package)
+            profiling.count("missing_packages")
+            self.missing_packages.add(key)
+        if self.recursive and key not in self.visited:
+            self.visited.add(key)
+            self.queue.append(package)
+        return f'{self.category}/{package}'
 
 
     def get_project_python_versions(self, project):
@@ -169,41 +212,17 @@ class PyPIEbuilder():
 
         return: String, Portage dependency
         """
-        # ignore strings after ';'
-        depend = depend.split(';')[0].strip()
-        # ignore strings after '[', e.g. horovod[torch]
-        depend = depend.split('[')[0]
-
-        # handle: package ([<>]=version)
-        match = re.match("(.+) \(?([<>]=?) *([0-9\.\-]+)\)?", depend)
-        if match:
-            name = match.group(1)
-            specifier = match.group(2)
-            version = match.group(3)
-            return '{}{}-{}[${{PYTHON_USEDEP}}]'.format(specifier, self.get_package_name(name), version)
-
-        # handle: package ([~=]=version)
-        match = re.match("(.+) \(?([~=])= *([0-9\.\-]+)\)?", depend)
-        if match:
-            name = match.group(1)
-            specifier = match.group(2)
-            version = match.group(3)
-            return '{}{}-{}[${{PYTHON_USEDEP}}]'.format(specifier, self.get_package_name(name), version)
-
-        # handle: package (!=version)
-        match = re.match("(.+) \(?!= *([0-9\.\-]+)\)?", depend)
-        if match:
-            name = match.group(1)
-            version = match.group(2)
-            return '!={}-{}[${{PYTHON_USEDEP}}]'.format(self.get_package_name(name), version)
-
-        # strip all exotic (.*), e.g. (~=1-32-0), (~=3-7-4), (<2,>=1-21-1)
-        #match = re.match("(.+) \([^()]*\)", depend)
-        #if match:
-        #    name = match.group(1)
-        #    return '{}[${{PYTHON_USEDEP}}]'.format(self.get_package_name(name))
-
-        return '{}[${{PYTHON_USEDEP}}]'.format(self.get_package_name(depend))
+        try:
+            requirement = parse_requirement(depend)
+        except InvalidRequirement as e:
+            warn(f'Unknown dependency {depend!r}: {e}')
+            # ignore strings after ';' and '[', e.g. horovod[torch]
+            return '{}[${{PYTHON_USEDEP}}]'.format(self.get_package_name(depend.split(';')[0].split('[')[0].strip()))
+        specifier, version = version_hint(requirement)
+        name = self.get_package_name(requirement.name)
+        if specifier is None:
+            return '{}[${{PYTHON_USEDEP}}]'.format(name)
+        return '{}{}-{}[${{PYTHON_USEDEP}}]'.format(specifier, name, version)
 
     def get_iuse_and_depend(self, project):
         """
@@ -225,22 +244,21 @@ class PyPIEbuilder():
                 if rm in req:
                     break
             else:
-                match = re.match("(.+); extra == '(.+)'", req)
-                if match:
-                    name = match.group(1).strip()
-                    use = match.group(2)
-                    if use in PyPIEbuilder.use_blackhole:
-                        continue
-                    uses[use].append(self.convert_dependency(name))
-                else:
-                    match = re.match('(.+); python_version < "(.+)"', req)
-                    if match:
-                        name = match.group(1).strip()
-                        if not name.startswith('backports'):
-                            # we don't need backports for python3
-                            simple.append(self.convert_dependency(name))
-                    else:
-                        simple.append(self.convert_dependency(req.strip()))
+                try:
+                    marker = parse_requirement(req).marker
+                except InvalidRequirement:
+                    marker = None
+                extras = marker_extras(marker)
+                for use in extras:
+                    if use not in PyPIEbuilder.use_blackhole:
+                        uses[use].append(self.convert_dependency(req))
+                if extras:
+                    continue
+                if marker is not None and req.startswith('backports') \
+                        and marker_variables(marker) <= {"python_version", "python_full_version"}:
+                    # we don't need backports for python3
+                    continue
+                simple.append(self.convert_dependency(req))
 
         use_res = []
         for use in uses:
@@ -250,52 +268,28 @@ class PyPIEbuilder():
 
 
 
-    def upstream_has_pypi(self, metadata_dict):
-        """
-        Parse Portage -
-        whether a package exists in PyPI
-
-        Input:
-            metadata_dict: dict, parsed metadata.xml
-
-        return: PyPI project name or False
-        """
-        try:
-            upstream = metadata_dict['pkgmetadata']['upstream']['remote-id']
-        except:
-            return False
-        if isinstance(upstream, list):
-            for u in upstream:
-                if u['@type'] == 'pypi':
-                    return u['#text']
-        else:
-            if upstream['@type'] == 'pypi':
-                return upstream['#text']
-        return False
-
-    # reimplement find_package() by checking the metadata.xml of a pkg
-    def find_packages(self, repo):
+    def find_packages(self, repos, index, jobs=None):
         """
         Parse Portage -
-        parse metadata of all pkgs from a Portage repository,
+        parse metadata of all pkgs from Portage repositories,
         add existing pkgs to self.existing_packages
 
         Input:
-            repo: ToString, the location of a repository
+            repos: list of ToString, the locations of the repositories, in priority order
+            index: RepoIndex, on-disk index of the parsed metadata.xml
+            jobs: int, the number of processes parsing metadata.xml
 
         return: None
         """
-        len_old = len(self.existing_packages)
-        cate_pkg_match = re.compile(f"{repo}/(.*)/(.+)/metadata.xml")
-
-        for pkg_metadata in glob.glob(f'{repo}/**/metadata.xml', recursive=True):
-            match = cate_pkg_match.match(pkg_metadata)
-            if match:
-                pypi_id = self.upstream_has_pypi(xmltodict.parse(open(pkg_metadata).read()))
-                if pypi_id:
-                    self.existing_packages[regularize_package_name(pypi_id)] = [match.group(1), match.group(2)]
-
-        print(f'Found {len(self.existing_packages) - len_old} packages in {repo}')
+        index.refresh(repos, jobs=jobs)
+        print(index.describe_stats())
+        # later repos take priority
+        for repo in repos:
+            found = 0
+            for pypi_id, category, package, _ in index.packages(repo):
+                self.existing_packages.add(pypi_id, f'{category}/{package}')
+                found += 1
+            print(f'Found {found} packages in {repo}')
 
     # TODO: update maintainer
     # TODO: accept description
@@ -305,29 +299,33 @@ class PyPIEbuilder():
         write metadata to provided path
 
         Input:
-            metadata_path: pathlib.Path, the path of the metadata
+            metadata_path: PurePosixPath, the path of the metadata, relative to the overlay
             pypi_id: ToString, PyPI project name
 
         return: the number of characters written
         """
-        if not metadata_path.exists():
+        if not self.output.exists(metadata_path):
             metadata = PyPIEbuilder.metadata_template.format(pypi_id)
-            return open(metadata_path, 'w').write(metadata)
+            self.output.write(metadata_path, metadata)
+            return len(metadata)
         return 0
 
-    def generate(self, package):
+    def generate(self, package, body=None):
         """
         Write Portage -
-        resolve and (may recursively) generate the ebuild of a PyPI project
+        resolve and generate the ebuild of a PyPI project,
+        its missing dependencies are queued if self.recursive
 
         Input:
             package: ToString, project name
+            body: dict, the json metadata provided by PyPI, fetched if None
 
         return: None
         """
-        print('Generating {} to {}'.format(package, self.repo))
-        resp = requests.get(self.upstream_template.format(package))
-        body = json.loads(resp.content)
+        info('Generating {} to {}'.format(package, self.repo))
+        start = time.perf_counter()
+        if body is None:
+            body = self.fetcher.fetch(package)
 
         #
         pv = body['info']['version']
@@ -340,7 +338,8 @@ class PyPIEbuilder():
         license = body['info']['license']
         if license in PyPIEbuilder.license_mapping:
             license = PyPIEbuilder.license_mapping[license]
-        iuse_and_depend = self.get_iuse_and_depend(body)
+        with profiling.stage("parse"):
+            iuse_and_depend = self.get_iuse_and_depend(body)
         # verbose logging
         if self.verbose:
             print('Python versions', versions)
@@ -351,16 +350,19 @@ class PyPIEbuilder():
             print('IUSE and Depend', iuse_and_depend)
 
         # get category of the package
-        category = self.existing_packages.get(package, [self.category])[0]
+        existing = self.existing_packages.get(package)
+        if existing and not self.existing_packages.is_pinned(package):
+            category = existing.split('/')[0]
+        else:
+            # the dependency string of an exception does not tell where the package is
+            category = self.category
 
-        # dir of the project
-        dir = Path(self.repo) / category / package
+        # dir of the project, relative to the overlay
+        dir = PurePosixPath(category, package)
         # ${P}
         path = dir / "{}-{}.ebuild".format(package, pv)
-        print('Writing to', path)
-        dir.mkdir(parents=True, exist_ok=True)
-        # write ebuild
-        with path.open('w') as f:
+        with profiling.stage("render"):
+            # render ebuild
             content = '# Copyright 1999-2021 Gentoo Authors\n'
             content += '# Distributed under the terms of the GNU General Public License v2\n\n'
             content += 'EAPI=7\n\n'
@@ -368,13 +370,13 @@ class PyPIEbuilder():
             content += 'inherit distutils-r1\n\n'
             content += 'DESCRIPTION="{}"\n'.format(body['info']['summary'])
             src_uri = 'SRC_URI="mirror://pypi/${PN:0:1}/${PN}/${P}.tar.gz"\n'
-            if self.get_uri_from_pypi:
-                #
-                for release_body in body['releases'][pv]:
-                    if release_body['python_version'] == 'source':
-                        provided_srcuri = release_body['url']
-                        src_uri += 'SRC_URI="{}"\n'.format(provided_srcuri)
-                        break
+            distfile = '{}-{}.tar.gz'.format(package, pv)
+            source = next((release_body for release_body in body['releases'].get(pv, ())
+                           if release_body['python_version'] == 'source'), None)
+            if self.get_uri_from_pypi and source is not None:
+                provided_srcuri = source['url']
+                src_uri += 'SRC_URI="{}"\n'.format(provided_srcuri)
+                distfile = provided_srcuri.rsplit('/', 1)[-1]
             content += src_uri
             content += 'HOMEPAGE="{}"\n\n'.format(body['info']['home_page'])
             content += 'LICENSE="{}"\n'.format(body['info']['license'])
@@ -383,28 +385,132 @@ class PyPIEbuilder():
             content += iuse_and_depend
             content += '\ndistutils_enable_tests pytest\n'
 
-            f.write(content)
+        # write it only if it changed, so unchanged packages keep their mtime and Manifest
+        with profiling.stage("write"):
+            ebuild_changed = self.output.write(path, content)
+            metadata_written = self.generate_metadata_if_not_exists(dir / "metadata.xml", pypi_id) > 0
+        info(f"{'Writing to' if ebuild_changed else 'Unchanged'} {path}")
+        self.write_stats.count(written=ebuild_changed + metadata_written,
+                               unchanged=2 - ebuild_changed - metadata_written)
+        changed = ebuild_changed or metadata_written
+
+        # the distfile of an unchanged package with a Manifest is neither downloaded nor hashed again
+        needs_manifest = self.repoman and (changed or not self.output.exists(dir / "Manifest"))
+        if needs_manifest:
+            self.pending_manifests.append((dir, [distfile]))
+        elif self.repoman:
+            self.write_stats.count(skipped=1)
+        if self.downloads and source is not None and (needs_manifest or not self.repoman):
+            # stored under the name the ebuild fetches it by
+            self.pending_downloads.append(self.downloads.submit(release_distfile(source, distfile)))
 
-        self.generate_metadata_if_not_exists(dir / "metadata.xml", pypi_id)
+        # update existing_packages anyway
+        self.existing_packages.add(pypi_id, f'{category}/{package}')
+        key = normalize_pypi_name(pypi_id)
+        self.visited.add(key)
+        self.missing_packages.discard(key)
+        profiling.observe("generate", time.perf_counter() - start)
 
-        if self.repoman:
-            os.system('cd %s && repoman manifest' % (dir))
+    def resolve(self, packages):
+        """
+        Write Portage -
+        generate the ebuilds of PyPI projects, and of all their missing dependencies if self.recursive
 
-        # regularize_package_name() is called before
-        # update existing_packages anyway
-        self.existing_packages[package] = [category, package]
-        # simply try-except, although it is expensive
-        if package in self.missing_packages:
-            print(f"self.missing_packages.remove({package})")
-            self.missing_packages.remove(package)
-
-        # recursively generate ebuild
-        if self.recursive:
-            print("exexex", self.missing_packages)
-            # copy to avoid "RuntimeError: Set changed size during iteration"
-            for pkg in self.missing_packages.copy():
-                if pkg not in self.existing_packages:
-                    self.generate(pkg)
+        every package is generated once: the queue is worked off level by level,
+        a level is fetched at once, and dependency cycles end at self.visited,
+        a package which fails is recorded in self.failed and does not stop the others
+
+        Input:
+            packages: list of ToString, project names
+
+        return: int, the number of generated ebuilds
+        """
+        for package in packages:
+            key = normalize_pypi_name(package)
+            # overlapping inputs are generated once
+            if key not in self.visited:
+                self.visited.add(key)
+                self.queue.append(package)
+        generated = 0
+        while self.queue:
+            level = [self.queue.popleft() for _ in range(len(self.queue))]
+            print(f'Queue depth: {len(level)}, generated: {generated}')
+            # all of them are needed, fetch them at once
+            with profiling.stage("fetch"):
+                bodies = self.fetcher.fetch_many(level, return_exceptions=True)
+            for package in level:
+                try:
+                    if isinstance(bodies[package], Exception):
+                        raise bodies[package]
+                    self.generate(package, bodies[package])
+                except Exception as e:
+                    print(f'Failed to generate {package}: {type(e).__name__}: {e}')
+                    self.failed[normalize_pypi_name(package)] = f'{type(e).__name__}: {e}'
+                    continue
+                generated += 1
+        # the Manifests need the distfiles
+        if self.pending_downloads:
+            with profiling.stage("download"):
+                failed = self.downloads.wait(self.pending_downloads, report=print)
+            if failed:
+                print(f'Failed to download {failed} distfiles')
+            self.pending_downloads = []
+        # the Manifests of all generated packages in one pass
+        if self.pending_manifests:
+            _, missing = self.manifests.write(self.pending_manifests, self.output)
+            self.pending_manifests = []
+            # an ebuild without the digest of its distfile can not be fetched
+            for pkg_dir, distfiles in missing.items():
+                print(f'Failed to write the Manifest of {pkg_dir}: {", ".join(distfiles)} not in {self.manifests.distdir}')
+                self.failed[normalize_pypi_name(pkg_dir.name)] = f'missing distfile {", ".join(distfiles)}'
+        return generated
+
+class EbuilderService:
+    """
+    handlers of the --serve mode
+
+    every request gets its own PyPIEbuilder, sharing the index of existing packages,
+    the fetcher and its caches with all others, so they stay warm between requests
+    """
+
+    def __init__(self, ebuilder):
+        """
+        Input:
+            ebuilder: PyPIEbuilder, with the repositories already scanned
+        """
+        self.ebuilder = ebuilder
+
+    def resolve(self, request):
+        """
+        {"op": "resolve", "packages": [...]} => {"packages": {package: "cate/pn" or null}}
+        """
+        return {"packages": {package: self.ebuilder.find_existing_package(regularize_package_name(package))
+                             for package in request["packages"]}}
+
+    def generate(self, request):
+        """
+        {"op": "generate", "packages": [...], "recursive": bool}
+        => {"generated": int, "failed": {package: reason}, "seconds": float}
+        """
+        start = time.perf_counter()
+        t = self.ebuilder
+        ebuilder = PyPIEbuilder(t.category, t.repo, t.repoman, request.get("recursive", t.recursive),
+                                t.verbose, t.get_uri_from_pypi, t.fetcher, t.manifests, t.downloads, t.output)
+        ebuilder.existing_packages = t.existing_packages
+        generated = ebuilder.resolve(request["packages"])
+        stats = ebuilder.write_stats
+        return {"generated": generated, "failed": ebuilder.failed,
+                "written": stats.written, "unchanged": stats.unchanged, "skipped": stats.skipped,
+                "seconds": time.perf_counter() - start}
+
+    def stats(self, request):
+        return {"stats": self.ebuilder.fetcher.describe_stats(),
+                "names": self.ebuilder.existing_packages.describe_stats(),
+                "profile": profiling.PROFILER.to_json(),
+                "existing_packages": len(self.ebuilder.existing_packages)}
+
+    def handlers(self):
+        return {"resolve": self.resolve, "generate": self.generate, "stats": self.stats}
 
 def main():
     parser = argparse.ArgumentParser()
@@ -413,21 +519,75 @@ def main():
     parser.add_argument('-r', '--repos', action='append',
         help='existing Portage repositories, do not specify it if you want it to find all repositories automatically',
         default=[])
-    parser.add_argument('-t', '--target', help='target repo directory', default='../gentoo-localrepo')
+    parser.add_argument('-t', '--target', default='../gentoo-localrepo',
+        help='target repo directory, or an archive (.tar, .tar.gz, .tgz, .tar.bz2, .tar.xz) the overlay is streamed into')
     parser.add_argument('-v', '--verbose', action='store_true', help='enable verbose logging')
     parser.add_argument('-R', '--recursive', action='store_true', help='generate ebuild recursively')
-    parser.add_argument('-p', '--repoman', action='store_true', help='run "repoman manifest" after generation')
-    parser.add_argument('packages', nargs='+')
+    parser.add_argument('-p', '--repoman', action='store_true', help='write the Manifest of generated packages, hashing the distfiles in --distdir, '
+                        'the missing ones are downloaded as -d does')
+    parser.add_argument('--distdir', help='the directory of the distfiles, default: /var/cache/distfiles')
+    parser.add_argument('-d', '--download', action='store_true', help='download the sdists of generated packages into --distdir, verified against the sha256 of PyPI')
+    parser.add_argument('--download-jobs', type=int, default=4, help='the number of concurrent downloads')
+    parser.add_argument('--index', help='location of the repository index, default: $XDG_CACHE_HOME/pypi-ebuilder/repo-index.json')
+    parser.add_argument('--rebuild-index', action='store_true', help='ignore the repository index and parse all metadata.xml again')
+    parser.add_argument('--scan-jobs', type=int, help='the number of processes parsing metadata.xml, default: the number of CPUs')
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='the number of concurrent requests to PyPI')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for PyPI')
+    parser.add_argument('--rate', type=float, help='the most requests per second to PyPI, unlimited by default, '
+                        'the concurrency adapts to throttling anyway')
+    parser.add_argument('--retries', type=int, default=5, help='times a throttled or failed request to PyPI is repeated')
+    parser.add_argument('--cache-dir', help='location of the HTTP cache, default: $XDG_CACHE_HOME/pypi-ebuilder/http')
+    parser.add_argument('--cache-ttl', type=float, default=3600, help='seconds during which cached PyPI metadata is used without revalidation')
+    parser.add_argument('--cache-size', type=int, default=1024, help='MiB of PyPI metadata kept in the HTTP cache')
+    parser.add_argument('--no-cache', action='store_true', help='do not cache PyPI metadata')
+    parser.add_argument('--lean', action='store_true', help='only download the metadata of the latest release of each package')
+    parser.add_argument('--stream', action='store_true', help='parse the metadata while it is downloaded and keep the needed fields only, which bounds the memory for huge projects')
+    parser.add_argument('--mirror', help='read PyPI metadata from a local directory, SQLite dump or JSONL dump instead of the network')
+    parser.add_argument('-b', '--batch', help='read package names from a file, one per line, "-" for stdin')
+    parser.add_argument('--serve', metavar='SOCKET', help='keep running, and serve requests on a Unix domain socket')
+    parser.add_argument('--connect', metavar='SOCKET', help='let the server on the Unix domain socket generate the packages')
+    profiling.add_arguments(parser)
+    parser.add_argument('packages', nargs='*')
     args = parser.parse_args()
-
-    # setup repo structure
-    metadata = Path(args.target) / "metadata"
-    metadata.mkdir(parents=True, exist_ok=True)
-    with (metadata / "layout.conf").open('w') as f:
-        f.write("masters = gentoo\nauto-sync = false\n")
+    # the per-package lines are only printed in the verbose mode
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(message)s')
+    profiling.start(args)
+
+    packages = list(args.packages)
+    if args.batch:
+        with (sys.stdin if args.batch == '-' else open(args.batch)) as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line:
+                    packages.append(line)
+    if args.connect:
+        response = server.request(args.connect, {"op": "generate", "packages": packages,
+                                                 "recursive": args.recursive})
+        print(json.dumps(response, indent=2))
+        sys.exit(0 if response["ok"] and not response["failed"] else 1)
+    if len(packages) == 0 and not args.serve:
+        parser.error('no packages given')
+
+    # setup repo structure, an archive is written as it goes
+    output = OverlayBundle(args.target) if archive_mode(args.target) else DirectoryOutput(Path(args.target))
+    # unchanged, it keeps its mtime as the other files of the overlay
+    output.write("metadata/layout.conf", "masters = gentoo\nauto-sync = false\nthin-manifests = true\n")
 
     # instantiate PyPIEbuilder
-    ebuilder = PyPIEbuilder(args.category, args.target, args.repoman, args.recursive, args.verbose, args.get_uri_from_pypi)
+    cache = None if args.no_cache or args.mirror else HTTPCache(args.cache_dir, args.cache_ttl, args.cache_size * 1024 * 1024)
+    # a server keeps parsed responses in memory
+    source = open_source(args.mirror) if args.mirror else None
+    scheduler = RequestScheduler(args.jobs, rate=args.rate, retries=args.retries)
+    fetcher = PyPIFetcher(args.jobs, args.timeout, PyPIEbuilder.upstream_template, cache,
+                          memo_size=4096 if args.serve else 0, source=source, lean=args.lean,
+                          stream=args.stream, scheduler=scheduler)
+    # a distfile verified after its download is not hashed again for its Manifest, and the other way round
+    hashes = HashCache() if args.download or args.repoman else None
+    manifests = ManifestWriter(args.distdir, cache=hashes) if args.repoman else None
+    # a Manifest needs the distfiles
+    downloads = DistfileStore(args.distdir, args.download_jobs, args.timeout, cache=hashes) if args.download or args.repoman else None
+    ebuilder = PyPIEbuilder(args.category, args.target, args.repoman, args.recursive, args.verbose, args.get_uri_from_pypi, fetcher,
+                            manifests, downloads, output)
 
     # parse
     if len(args.repos) == 0:
@@ -441,12 +601,54 @@ def main():
     else:
         repos = args.repos
 
-    for repo in repos:
-        ebuilder.find_packages(repo)
+    index = RepoIndex(args.index, rebuild=args.rebuild_index)
+    ebuilder.find_packages(repos, index, args.scan_jobs)
+    index.save()
+    # existing_packages has what is needed, do not keep the whole index resident
+    del index
+
+    if args.serve:
+        try:
+            server.serve(args.serve, EbuilderService(ebuilder).handlers())
+        finally:
+            fetcher.close()
+            if downloads:
+                downloads.close()
+            if isinstance(output, OverlayBundle):
+                output.close()
+            profiling.finish(args)
+        return
 
     # run
-    for package in args.packages:
-        ebuilder.generate(package)
+    generated = ebuilder.resolve(packages)
+    print(fetcher.describe_stats())
+    print(ebuilder.existing_packages.describe_stats())
+    print(ebuilder.write_stats.describe_stats())
+    if isinstance(output, OverlayBundle):
+        output.close()
+    if downloads:
+        print(downloads.describe_stats())
+        downloads.close()
+    if manifests:
+        print(manifests.describe_stats())
+    fetcher.close()
+    profiling.finish(args)
+
+    # summary
+    requested = {normalize_pypi_name(package): package for package in reversed(packages)}
+    failed_inputs = 0
+    for key, package in reversed(requested.items()):
+        error = ebuilder.failed.get(key)
+        if error:
+            failed_inputs += 1
+            print(f'FAILED {package}: {error}')
+        elif len(requested) > 1:
+            print(f'OK     {package}')
+    print(f'{len(ebuilder.visited)} packages resolved, {generated} ebuilds generated, '
+          f'{failed_inputs} of {len(requested)} requested packages and '
+          f'{len(ebuilder.failed) - failed_inputs} dependencies failed')
+    if ebuilder.failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,543 @@
+"""
+This file benchmarks the stages of the generation on reproducible inputs
+
+A synthetic Portage repository with N packages (metadata.xml, an ebuild, an
+md5-cache entry each) and a directory of PyPI json fixtures are generated, or
+recorded fixtures are replayed, then every stage is timed on its own:
+    scan:    RepoIndex.refresh() of the synthetic repository, cold and warm
+    fetch:   PyPIFetcher reading and decoding the fixtures
+    parse:   the requirements of all projects, with a cold parser cache
+    render:  PkgMetadata and the ebuild/metadata.xml of all projects
+    write:   the rendered files into an empty overlay, and again over it
+    startup: a fresh interpreter importing generator.py, which should stay far below 100 ms
+Nothing needs the network or a Portage installation.
+
+usage: python -m src.benchmark [-n PACKAGES] [--fixtures DIR] [-o RESULT.json] [--compare OLD.json]
+       python -m src.benchmark record DIR PROJECT...
+       python -m src.benchmark requirements [--mirror SOURCE] [-n REPEAT]
+       python -m src.benchmark index [-n ENTRIES]
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import logging
+import itertools
+import platform
+import resource
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+from pathlib import Path
+
+from .repo_index import RepoIndex
+from .pypi_fetch import PyPIFetcher
+from .pypi_mirror import DirectorySource
+from .pypi_parser import PYPIParser
+from .metadata_repr import PkgMetadata, PortagePackage
+from .name_index import NameIndex
+from .requirement import parse_requirement, InvalidRequirement
+from .overlay_bundle import DirectoryOutput
+from .portage_parser import highest_versions
+from . import ebuild_writer
+
+# bump it whenever the layout of the result changes
+# 2: the "startup" stage and "imports"
+RESULT_FORMAT = 2
+
+# the root of the repository, where generator.py is
+ROOT = Path(__file__).resolve().parent.parent
+
+# modules that take long to import, and are only needed on some code paths
+HEAVY_MODULES = ("requests", "portage", "xmltodict", "multiprocessing", "pstats", "sqlite3")
+
+CATEGORIES = ["dev-python", "sci-libs", "dev-libs", "media-libs", "net-libs", "app-misc",
+              "dev-util", "sys-apps", "www-apps", "sci-mathematics"]
+
+METADATA_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE pkgmetadata SYSTEM "https://www.gentoo.org/dtd/metadata.dtd">
+<pkgmetadata>
+	<maintainer type="project">
+		<email>python@gentoo.org</email>
+	</maintainer>
+	<upstream>
+{remote_ids}	</upstream>
+</pkgmetadata>
+"""
+
+
+def make_repo(repo, packages):
+    """
+    Write Portage -
+    a synthetic repository, two of three packages are on PyPI,
+    and a third of those have a remote-id spelled differently from their name
+
+    Input:
+        repo: Path
+        packages: int, the number of packages
+
+    return: list of String, the PyPI names in the repository
+    """
+    pypi_ids = []
+    for i in range(packages):
+        cate = CATEGORIES[i % len(CATEGORIES)]
+        pn = f"py-project{i}"
+        pv = f"1.{i % 10}.{i % 7}"
+        remote_ids = f'\t\t<remote-id type="github">example/{pn}</remote-id>\n'
+        if i % 3:
+            pypi_id = f"Py_Project{i}" if i % 3 == 2 else pn
+            remote_ids += f'\t\t<remote-id type="pypi">{pypi_id}</remote-id>\n'
+            pypi_ids.append(pypi_id)
+        pkg_dir = repo / cate / pn
+        pkg_dir.mkdir(parents=True, exist_ok=True)
+        (pkg_dir / "metadata.xml").write_text(METADATA_TEMPLATE.format(remote_ids=remote_ids))
+        (pkg_dir / f"{pn}-{pv}.ebuild").write_text("EAPI=8\n")
+        cache_dir = repo / "metadata" / "md5-cache" / cate
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        (cache_dir / f"{pn}-{pv}").write_text("EAPI=8\n")
+    return pypi_ids
+
+
+def _project(name, version, requires, releases, files_per_release):
+    sdist = {"python_version": "source", "packagetype": "sdist", "filename": f"{name}-{version}.tar.gz",
+             "url": f"https://files.pythonhosted.org/packages/source/{name[0]}/{name}/{name}-{version}.tar.gz",
+             "digests": {"sha256": "0" * 64}, "size": 1000}
+    wheels = [{"python_version": f"cp3{j}", "packagetype": "bdist_wheel",
+               "filename": f"{name}-{version}-cp3{j}-manylinux_x86_64.whl",
+               "url": f"https://files.pythonhosted.org/packages/{j:02x}/{name}-cp3{j}.whl",
+               "digests": {"sha256": "0" * 64}, "size": 1000}
+              for j in range(files_per_release)]
+    return {
+        "info": {"name": name, "version": version, "license": "MIT", "summary": f"synthetic {name}",
+                 "home_page": f"https://example.org/{name}", "description": f"{name} " * 200,
+                 "requires_dist": requires,
+                 "classifiers": ["Programming Language :: Python :: 3.11",
+                                 "Programming Language :: Python :: 3.12"]},
+        "releases": {f"0.{i}": [dict(f, filename=f["filename"].replace(version, f"0.{i}")) for f in [sdist, *wheels]]
+                     for i in range(releases)} | {version: [sdist, *wheels]},
+        "urls": [sdist, *wheels],
+    }
+
+
+def make_fixtures(fixtures, projects, existing):
+    """
+    Write Mirror -
+    synthetic PyPI json documents, each project requires a few others and a few existing packages,
+    "tensorflow-like" has thousands of releases with dozens of files and many conditional requirements
+
+    Input:
+        fixtures: Path, a directory, as DirectorySource reads it
+        projects: int, the number of projects
+        existing: list of String, PyPI names in the synthetic repository
+
+    return: list of String, the project names
+    """
+    fixtures.mkdir(parents=True, exist_ok=True)
+    names = [f"bench-project{i}" for i in range(projects)]
+    for i, name in enumerate(names):
+        requires = [f"bench-project{j} (>={j % 5}.0)" for j in (2 * i + 1, 2 * i + 2) if j < projects]
+        requires += [f"{existing[(i * 7 + k) % len(existing)]}>=1.0,<3" for k in range(3)] if existing else []
+        requires += [f"pytest>=7 ; extra == 'test'", f"typing-extensions>=4 ; python_version < '3.11'",
+                     f"colorama ; sys_platform == 'win32'"]
+        body = _project(name, f"1.{i % 10}", requires, releases=20, files_per_release=4)
+        (fixtures / f"{name}.json").write_text(json.dumps(body))
+    requires = [f"{dep}>={k}.{k}" for k, dep in enumerate(names[:40])]
+    requires += [f"extra-dep{k}[all]~=1.{k} ; python_version >= '3.9' and extra == 'and-cuda'" for k in range(60)]
+    requires += [f"gpu-dep{k}==2.{k}.* ; platform_system == 'Linux' and platform_machine == 'x86_64'" for k in range(40)]
+    body = _project("tensorflow-like", "2.16.1", requires, releases=1500, files_per_release=30)
+    (fixtures / "tensorflow-like.json").write_text(json.dumps(body))
+    return names + ["tensorflow-like"]
+
+
+def record(fixtures, projects, template=PyPIFetcher.upstream_template):
+    """
+    Fetch PyPI -
+    record the json documents of projects as fixtures, as PyPI returns them
+
+    Input:
+        fixtures: Path
+        projects: list of String
+        template: String, uri of the json metadata, "{}" is replaced by the project name
+    """
+    fixtures.mkdir(parents=True, exist_ok=True)
+    import requests
+    with requests.Session() as session:
+        for name in projects:
+            resp = session.get(template.format(name), timeout=60)
+            resp.raise_for_status()
+            (fixtures / f"{name}.json").write_bytes(resp.content)
+            print(f"Recorded {name}: {len(resp.content) / 1024:.0f} KiB")
+
+
+def _render(bodies):
+    rendered = []
+    for pypi_id, body in bodies.items():
+        cate, pn, _ = PYPIParser.catepn(body["info"]["name"])
+        pkgmeta = PkgMetadata(pypi_id, cate, pn, PYPIParser.pv(body["info"]["version"]),
+                              PYPIParser.license(body["info"]["license"]))
+        # the streaming mode of PyPIFetcher drops the long description
+        pkgmeta.add_descriptions(body["info"]["summary"], body["info"].get("description", ""))
+        pkgmeta.add_homepage(body["info"]["home_page"])
+        pkgmeta.parse_deps(PYPIParser.get_iuse_and_depend(body), fetch_missing=False)
+        rendered.append(ebuild_writer.render(pypi_id, pkgmeta))
+    return rendered
+
+
+def _parse(bodies):
+    parse_requirement.cache_clear()
+    return sum(len(deps) for body in bodies.values() for deps in PYPIParser.get_iuse_and_depend(body).values())
+
+
+def import_time(module):
+    """
+    import a module in a fresh interpreter, as a run starts
+
+    Input:
+        module: String, e.g. "generator" or "src.dep_graph"
+
+    return: dict, the seconds of its imports as -X importtime reports them, and the HEAVY_MODULES it imported
+    """
+    code = f"import sys, {module}; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          cwd=ROOT, capture_output=True, text=True, check=True)
+    # "import time: self [us] | cumulative | imported package", the module itself comes last
+    cumulative = next(int(line.split("|")[1]) for line in reversed(proc.stderr.splitlines())
+                      if line.split("|")[-1].strip() == module)
+    return {"seconds": cumulative / 1e6, "heavy": proc.stdout.split()}
+
+
+def run(workdir, packages, projects, fixtures=None, repeat=3, jobs=None, stream=False):
+    """
+    time every stage, the best of repeat runs is reported
+
+    Input:
+        workdir: Path, where the synthetic inputs and the outputs are written
+        packages: int, the number of packages of the synthetic repository
+        projects: int, the number of synthetic projects, unused if fixtures is given
+        fixtures: Path, a directory of recorded json documents, synthetic ones are generated if None
+        repeat: int
+        jobs: int, the number of processes scanning the repository, os.cpu_count() if None
+        stream: bool, fetch in the streaming mode of PyPIFetcher
+
+    return: dict, the result, see main()
+    """
+    repo = workdir / "repo"
+    existing = make_repo(repo, packages)
+    if fixtures is None:
+        fixtures = workdir / "fixtures"
+        make_fixtures(fixtures, projects, existing)
+    names = list(DirectorySource(fixtures).paths)
+    fixture_bytes = sum(f.stat().st_size for f in fixtures.iterdir())
+    stages = {}
+
+    def timed(stage, items, fn):
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            value = fn()
+            runs.append(time.perf_counter() - start)
+        best = min(runs)
+        stages[stage] = {"seconds": best, "runs": runs, "items": items,
+                         "per_second": items / max(best, 1e-9)}
+        print(f"{stage:>10}: {best * 1000:9.1f} ms, {items / max(best, 1e-9):10.0f} items/s")
+        return value
+
+    def scan(rebuild):
+        index = RepoIndex(workdir / "repo-index.json", rebuild=rebuild)
+        index.refresh([repo], version_lookup=highest_versions, jobs=jobs)
+        index.save()
+        return index
+
+    index = timed("scan", packages, lambda: scan(rebuild=True))
+    timed("scan_warm", packages, lambda: scan(rebuild=False))
+    for pypi_id, (cate, pn, version) in index.merged([repo]).items():
+        PYPIParser.PN_database.add(pypi_id, PortagePackage(cate, pn, version))
+
+    def fetch():
+        fetcher = PyPIFetcher(source=DirectorySource(fixtures), stream=stream)
+        try:
+            return fetcher.fetch_many(names)
+        finally:
+            fetcher.close()
+
+    bodies = timed("fetch", len(names), fetch)
+    requirements = sum(len(body["info"].get("requires_dist") or []) for body in bodies.values())
+    timed("parse", requirements, lambda: _parse(bodies))
+    rendered = timed("render", len(bodies), lambda: _render(bodies))
+    files = sum(map(len, rendered))
+
+    targets = (workdir / f"overlay{i}" for i in itertools.count())
+
+    def write(target):
+        output = DirectoryOutput(target)
+        return [ebuild_writer.write_files(output, package_files) for package_files in rendered]
+
+    # every run of "write" gets an empty overlay, "rewrite" finds its files unchanged
+    target = workdir / "overlay"
+    timed("write", files, lambda: write(next(targets)))
+    write(target)
+    timed("rewrite", files, lambda: write(target))
+
+    timed("startup", 1, lambda: subprocess.run([sys.executable, "-c", "import generator"], cwd=ROOT, check=True))
+    imports = {module: import_time(module) for module in ("generator", "src.dep_graph")}
+    for module, imported in imports.items():
+        print(f"{module:>14}: {imported['seconds'] * 1000:6.1f} ms of imports, "
+              f"heavy modules: {' '.join(imported['heavy']) or 'none'}")
+    return {
+        "format": RESULT_FORMAT,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "inputs": {"packages": packages, "pypi_packages": len(existing), "projects": len(names),
+                   "fixture_bytes": fixture_bytes, "requirements": requirements, "files": files,
+                   "repeat": repeat, "stream": stream},
+        "stages": stages,
+        "imports": imports,
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+# the regex chain PYPIParser.get_iuse_and_depend() and parse_single_dep() ran before parse_requirement()
+_BASELINE = [re.compile(pattern) for pattern in (
+    "(.+); extra == '(.+)'",
+    '(.+); python_version < "(.+)"',
+    "(.+); (.+)",
+    r"(^[ \(]+) *\(?([<>]=?) *([0-9\.\-]+)\)?",
+    r"(^[ \(]+) *?\(?([~=])= *([0-9\.\-]+)\)?",
+    r"(^[ \(]+) *\(?!= *([0-9\.\-]+)\)?",
+)]
+
+
+def _regex_baseline(req):
+    dep_use, dep_python_ver, dep_fallback, depv_normal, depv_locked, depv_rej = _BASELINE
+    match_use = dep_use.match(req)
+    match_pyver = dep_python_ver.match(req)
+    match_fallback = dep_fallback.match(req)
+    if match_use:
+        dep_string = match_use.group(1).strip()
+    elif match_pyver:
+        dep_string = match_pyver.group(1).strip()
+    elif match_fallback:
+        return None
+    else:
+        dep_string = req.strip()
+    dep_string = dep_string.split(';')[0].strip()
+    dep_string = dep_string.split('[')[0]
+    for pattern in (depv_normal, depv_locked, depv_rej):
+        match = pattern.match(dep_string)
+        if match:
+            return match.groups()
+    return dep_string.split(" ")[0]
+
+
+def _sample_requirements(mirror=None):
+    """
+    return: list of String, a built-in sample, or the requires_dist of every project in a mirror
+    """
+    if mirror is None:
+        return ["numpy>=1.17", "six", "requests (>=2.20,<3)", "pytest ; extra == 'test'",
+                "importlib-metadata; python_version < \"3.8\"", "typing_extensions>=3.7.4",
+                "horovod[torch]>=0.19", "pywin32>=1.0; sys_platform == \"win32\" and extra == 'win'",
+                "black==22.*; extra == 'dev'", "torch @ https://example.org/torch.whl"]
+    import json
+    import sqlite3
+    from .pypi_mirror import open_source, SQLiteSource
+    source = open_source(mirror)
+    if isinstance(source, SQLiteSource):
+        conn = sqlite3.connect(f"{source.path.resolve().as_uri()}?mode=ro", uri=True)
+        bodies = (row[0] for row in conn.execute("SELECT body FROM projects"))
+    else:
+        bodies = (source.get(name) for name in source.paths)
+    res = []
+    for body in bodies:
+        res.extend(json.loads(body).get("info", {}).get("requires_dist") or [])
+    return res
+
+
+def benchmark_requirements(requirements):
+    """
+    time parse_requirement() against the former regex chain
+
+    Input:
+        requirements: list of String
+    """
+    distinct = len(set(requirements))
+    print(f'{len(requirements)} requirements, {distinct} distinct')
+
+    start = time.perf_counter()
+    for req in requirements:
+        _regex_baseline(req)
+    elapsed = time.perf_counter() - start
+    print(f'regex chain: {len(requirements) / elapsed:.0f} requirements/s')
+
+    parse_requirement.cache_clear()
+    start = time.perf_counter()
+    invalid = 0
+    for req in requirements:
+        try:
+            # the parser without its cache
+            parse_requirement.__wrapped__(req)
+        except InvalidRequirement:
+            invalid += 1
+    elapsed = time.perf_counter() - start
+    print(f'one-pass parser, uncached: {len(requirements) / elapsed:.0f} requirements/s, {invalid} invalid')
+
+    start = time.perf_counter()
+    for req in requirements:
+        try:
+            parse_requirement(req)
+        except InvalidRequirement:
+            pass
+    elapsed = time.perf_counter() - start
+    print(f'one-pass parser, cached: {len(requirements) / elapsed:.0f} requirements/s, '
+          f'{parse_requirement.cache_info()}')
+
+
+class _DictPkgMetadata:
+    """
+    PkgMetadata as it was before __slots__, the baseline of benchmark_index()
+    """
+
+    def __init__(self, pypi_id, portage_cate, portage_name, portage_version=None, portage_lic=None):
+        self.pypi_id = pypi_id
+        self.portage_cate = portage_cate
+        self.portage_name = portage_name
+        self.portage_version = portage_version
+        self.portage_lic = portage_lic
+
+
+def _measure(build, document):
+    """
+    decode the packages like RepoIndex does, build a table of them and drop everything else
+
+    return: float, bytes kept alive by the table, per entry
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    entries = json.loads(document)
+    table = build(entries)
+    n = len(entries)
+    del entries
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del table
+    return (after - before) / n
+
+
+def benchmark_index(entries):
+    """
+    measure the memory of the index of existing Portage packages, against a dict of PkgMetadata
+
+    Input:
+        entries: int, the number of synthetic packages
+    """
+    categories = ["dev-python", "sci-libs", "dev-libs", "media-libs", "net-libs", "app-misc",
+                  "dev-util", "sys-apps", "www-apps", "sci-mathematics"]
+    # most remote-ids are spelled as their normalized name, some are not, e.g. "PyYAML"
+    document = json.dumps([[f"Py_Project{i}" if i % 3 == 0 else f"py-project{i}",
+                            categories[i % len(categories)], f"py-project{i}", f"1.{i % 10}.0"]
+                           for i in range(entries)])
+
+    def before(rows):
+        return {pypi_id: _DictPkgMetadata(pypi_id, cate, pn, portage_version=version)
+                for pypi_id, cate, pn, version in rows}
+
+    def after(rows):
+        index = NameIndex()
+        for pypi_id, cate, pn, version in rows:
+            index.add(pypi_id, PortagePackage(cate, pn, version))
+        return index
+
+    print(f'{entries} packages')
+    print(f'before, dict of PkgMetadata: {_measure(before, document):.0f} bytes per entry')
+    print(f'after, NameIndex of PortagePackage: {_measure(after, document):.0f} bytes per entry')
+
+
+def compare(result, old, threshold):
+    """
+    Input:
+        result: dict, see run()
+        old: dict, a former result
+        threshold: float, the ratio of seconds counted as a regression
+
+    return: list of String, the stages which got slower than threshold
+    """
+    regressions = []
+    for stage, new in result["stages"].items():
+        if stage not in old.get("stages", {}):
+            continue
+        ratio = new["seconds"] / max(old["stages"][stage]["seconds"], 1e-9)
+        print(f"{stage:>10}: {ratio:5.2f}x {'REGRESSION' if ratio > threshold else ''}")
+        if ratio > threshold:
+            regressions.append(stage)
+    return regressions
+
+
+def main():
+    if sys.argv[1:2] == ["record"]:
+        parser = argparse.ArgumentParser(prog='python -m src.benchmark record',
+                                         description='record the json documents of PyPI projects as fixtures')
+        parser.add_argument('fixtures', help='the directory of the fixtures')
+        parser.add_argument('projects', nargs='+', help='e.g. tensorflow boto3 django')
+        args = parser.parse_args(sys.argv[2:])
+        record(Path(args.fixtures), args.projects)
+        return
+    if sys.argv[1:2] == ["requirements"]:
+        parser = argparse.ArgumentParser(prog='python -m src.benchmark requirements',
+                                         description='benchmark the requirement parser against the former regex chain')
+        parser.add_argument('--mirror', help='take the requires_dist of every project in a local directory, SQLite dump or JSONL dump')
+        parser.add_argument('-n', '--repeat', type=int, default=10000,
+            help='times the built-in sample is repeated, the requirements of a mirror are used once')
+        args = parser.parse_args(sys.argv[2:])
+        requirements = _sample_requirements(args.mirror)
+        if args.mirror is None:
+            requirements = requirements * args.repeat
+        benchmark_requirements(requirements)
+        return
+    if sys.argv[1:2] == ["index"]:
+        parser = argparse.ArgumentParser(prog='python -m src.benchmark index',
+                                         description='benchmark the memory of the index of existing Portage packages')
+        parser.add_argument('-n', '--entries', type=int, default=30000, help='the number of synthetic packages')
+        args = parser.parse_args(sys.argv[2:])
+        benchmark_index(args.entries)
+        return
+
+    parser = argparse.ArgumentParser(description='benchmark the stages of the generation on synthetic inputs')
+    parser.add_argument('-n', '--packages', type=int, default=5000, help='the number of packages in the synthetic repository')
+    parser.add_argument('--projects', type=int, default=200, help='the number of synthetic PyPI projects')
+    parser.add_argument('--fixtures', help='a directory of recorded PyPI json documents, instead of synthetic ones')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs of every stage, the best one is reported')
+    parser.add_argument('-j', '--jobs', type=int, help='the number of processes scanning the repository')
+    parser.add_argument('--stream', action='store_true', help='fetch in the streaming mode')
+    parser.add_argument('--workdir', help='keep the inputs and outputs in this directory, a temporary one is removed otherwise')
+    parser.add_argument('-o', '--output', help='write the result as json')
+    parser.add_argument('--compare', help='a former result, exit with 1 if a stage got slower than --threshold')
+    parser.add_argument('--threshold', type=float, default=1.25, help='the ratio of seconds counted as a regression')
+    args = parser.parse_args()
+    # the synthetic requirements trigger warnings on purpose
+    logging.basicConfig(level=logging.ERROR)
+
+    workdir = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix="pypi-ebuilder-bench-"))
+    try:
+        result = run(workdir, args.packages, args.projects, Path(args.fixtures) if args.fixtures else None,
+                     args.repeat, args.jobs, args.stream)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(result, json.load(f), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+"""
+This file represents the dependencies between PyPI projects as a graph
+
+Nodes are PyPI ids, edges are tagged with the USE flag ("_default" for
+unconditional deps) and the version constraint from PYPIParser.get_iuse_and_depend().
+The graph is used to plan an import, and to write the ebuilds level by level:
+a level only depends on the levels before it, considering unconditional deps.
+"""
+import json
+import argparse
+from pathlib import Path
+from collections import defaultdict
+from logging import info, warn
+
+from .metadata_repr import ToBeGeneratedEbuilds
+from .pypi_parser import PYPIParser, PYPICommunicator
+from .name_index import normalize_pypi_name
+from .pypi_fetch import PyPIFetcher
+from .pypi_mirror import open_source
+from .overlay_files import WriteStats
+from .overlay_bundle import OverlayBundle, archive_mode
+from . import ebuild_writer
+from . import profiling
+
+
+class DepGraph:
+
+    def __init__(self):
+        # key: normalized name
+        # value: pypi id as spelled by PyPI (or by the first requirement that mentions it)
+        self.nodes = {}
+        # normalized names of nodes which are already provided by Portage
+        self.existing = set()
+        # normalized names of nodes added by add_project(), i.e. the ones to be generated
+        self.resolved = set()
+        # key: normalized name
+        # value: list of (normalized dep name, use, (specifier, version))
+        self.edges = defaultdict(list)
+
+    def add_node(self, pypi_id, existing=False):
+        key = normalize_pypi_name(pypi_id)
+        self.nodes.setdefault(key, pypi_id)
+        if existing:
+            self.existing.add(key)
+        return key
+
+    def add_project(self, pypi_id, deps):
+        """
+        add a project and its dependencies
+
+        Input:
+            pypi_id: String, PyPI project name
+            deps: dict of {use: [(pypi_id, (specifier, version))]}, see PYPIParser.get_iuse_and_depend()
+        """
+        key = normalize_pypi_name(pypi_id)
+        # the spelling from PyPI wins over the one from requirements
+        self.nodes[key] = pypi_id
+        self.resolved.add(key)
+        for use, dep_list in deps.items():
+            for dep_pypi_id, version_hint in dep_list:
+                dep_key = self.add_node(dep_pypi_id, PYPIParser.catepn(dep_pypi_id)[2])
+                self.edges[key].append((dep_key, use, tuple(version_hint)))
+
+    def dependencies(self, key):
+        """
+        the unconditional deps only, USE-conditional ones (e.g. test extras) would make up cycles,
+        and the resolved ones only, a dep which could not be fetched is not generated, see unresolved()
+
+        return: set of normalized names that the node depends on and that have to be generated
+        """
+        return {dep for dep, use, _ in self.edges.get(key, ())
+                if use == "_default" and dep in self.resolved and dep not in self.existing}
+
+    def unresolved(self):
+        """
+        the unconditional deps which have to be generated, but were not resolved,
+        e.g. because their metadata could not be fetched
+
+        return: sorted list of normalized names
+        """
+        return sorted({dep for key in self.resolved for dep, use, _ in self.edges.get(key, ())
+                       if use == "_default" and dep not in self.existing} - self.resolved)
+
+    def strongly_connected_components(self):
+        """
+        Tarjan's algorithm without recursion, so deep graphs do not hit the recursion limit
+
+        return: list of lists of normalized names, dependencies come before their dependents
+        """
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        components = []
+        counter = 0
+        for root in self.nodes:
+            if root in index or root not in self.resolved or root in self.existing:
+                continue
+            work = [(root, iter(sorted(self.dependencies(root))))]
+            index[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = lowlink[child] = counter
+                        counter += 1
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(sorted(self.dependencies(child)))))
+                        break
+                    elif child in on_stack:
+                        lowlink[node] = min(lowlink[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+                    if lowlink[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.remove(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        components.append(sorted(component))
+        return components
+
+    def cycles(self):
+        """
+        return: list of lists of normalized names, each list is a dependency cycle
+        """
+        return [component for component in self.strongly_connected_components()
+                if len(component) > 1 or component[0] in self.dependencies(component[0])]
+
+    def levels(self):
+        """
+        group the nodes to be generated, each level only depends on the previous ones,
+        the members of a cycle share one level
+
+        return: list of lists of normalized names
+        """
+        level_of = {}
+        levels = []
+        # Tarjan's algorithm emits dependencies first
+        for component in self.strongly_connected_components():
+            members = set(component)
+            deps = {dep for member in component for dep in self.dependencies(member)} - members
+            level = 1 + max((level_of[dep] for dep in deps), default=-1)
+            for member in component:
+                level_of[member] = level
+            if level == len(levels):
+                levels.append([])
+            levels[level].extend(component)
+        return levels
+
+    def topological_order(self):
+        """
+        return: list of normalized names, dependencies come before their dependents
+        """
+        return [key for level in self.levels() for key in level]
+
+    def critical_path(self):
+        """
+        the longest chain of dependencies, i.e. the lower bound of sequential steps
+
+        return: list of normalized names, from the top-most dependent down to a leaf
+        """
+        best = {}
+        for component in self.strongly_connected_components():
+            members = set(component)
+            # (length, next node) of the longest chain below each member of the component
+            below = max(((best[dep][0], dep) for member in component
+                         for dep in self.dependencies(member) - members), default=(0, None))
+            for member in component:
+                best[member] = (below[0] + 1, below[1])
+        if not best:
+            return []
+        node = max(best, key=lambda key: best[key][0])
+        path = []
+        while node is not None:
+            path.append(node)
+            node = best[node][1]
+        return path
+
+    def to_json(self):
+        """
+        return: dict, serializable with json.dump()
+        """
+        level_of = {key: i for i, level in enumerate(self.levels()) for key in level}
+        return {
+            "nodes": [{"id": key, "pypi_id": pypi_id, "existing": key in self.existing,
+                       "level": level_of.get(key)}
+                      for key, pypi_id in self.nodes.items()],
+            "edges": [{"from": key, "to": dep, "use": use, "constraint": list(constraint)}
+                      for key, edges in self.edges.items() for dep, use, constraint in edges],
+            "cycles": self.cycles(),
+            "critical_path": self.critical_path(),
+            "unresolved": self.unresolved(),
+        }
+
+    def to_dot(self):
+        """
+        return: String, the graph in Graphviz's dot language
+        """
+        lines = ["digraph dependencies {"]
+        for key, pypi_id in self.nodes.items():
+            style = ', style=dashed' if key in self.existing else ''
+            lines.append(f'\t"{key}" [label="{pypi_id}"{style}];')
+        for key, edges in self.edges.items():
+            for dep, use, (specifier, version) in edges:
+                label = "" if use == "_default" else f"{use}? "
+                if specifier is not None:
+                    label += f"{specifier}{version}"
+                lines.append(f'\t"{key}" -> "{dep}" [label="{label.strip()}"];')
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+
+def build_graph(packages):
+    """
+    Parse PyPI -
+    fetch the projects and their missing dependencies level by level,
+    translate them into ToBeGeneratedEbuilds, and record the dependencies
+
+    Input:
+        packages: list of ToString, project names
+
+    return: DepGraph
+    """
+    communicator = PYPICommunicator()
+    fetcher = communicator.get_fetcher()
+    graph = DepGraph()
+    queue = list(dict.fromkeys(packages))
+    visited = {normalize_pypi_name(package) for package in queue}
+    while queue:
+        info(f'Resolving {len(queue)} packages, {len(graph.edges)} resolved')
+        with profiling.stage("fetch"):
+            bodies = fetcher.fetch_many(queue, return_exceptions=True)
+        next_queue = []
+        for package in queue:
+            if isinstance(bodies[package], Exception):
+                # the rest of the graph is still worth planning
+                warn(f'Skipping {package}: {type(bodies[package]).__name__}: {bodies[package]}')
+                continue
+            pypi_id, deps = communicator.test(package, bodies[package], fetch_missing=False)
+            graph.add_project(pypi_id, deps)
+            # as PkgMetadata.parse_deps(), only the unconditional deps are followed
+            for dep_pypi_id, _ in deps["_default"]:
+                key = normalize_pypi_name(dep_pypi_id)
+                if key not in visited and key not in graph.existing:
+                    visited.add(key)
+                    next_queue.append(dep_pypi_id)
+        queue = next_queue
+    return graph
+
+
+def _write_ebuild(job):
+    repo_dir, pypi_id, my_metadata = job
+    return ebuild_writer.generate(repo_dir, pypi_id, my_metadata)
+
+
+def _render_ebuild(job):
+    return ebuild_writer.render(*job)
+
+
+def generate_by_level(graph, repo_dir: Path, jobs=None, bundle=None):
+    """
+    Write Portage -
+    write the ebuilds in ToBeGeneratedEbuilds level by level,
+    the ebuilds of one level are written by a process pool
+
+    Input:
+        graph: DepGraph
+        repo_dir: Path, location of the overlay
+        jobs: int, the number of worker processes, os.cpu_count() if None
+        bundle: OverlayBundle, the workers only render the files, and they go into it instead of repo_dir
+
+    return: WriteStats, the number of written and unchanged files
+    """
+    payload = {normalize_pypi_name(pypi_id): (pypi_id, my_metadata)
+               for pypi_id, my_metadata in ToBeGeneratedEbuilds.items()}
+    stats = WriteStats()
+    from concurrent.futures import ProcessPoolExecutor
+    with profiling.stage("write"), ProcessPoolExecutor(jobs) as executor:
+        for i, level in enumerate(graph.levels()):
+            if bundle is None:
+                level_jobs = [(repo_dir, *payload[key]) for key in level if key in payload]
+                results = executor.map(_write_ebuild, level_jobs)
+            else:
+                level_jobs = [payload[key] for key in level if key in payload]
+                results = (ebuild_writer.write_files(bundle, files)
+                           for files in executor.map(_render_ebuild, level_jobs))
+            for written, unchanged in results:
+                stats.count(written=written, unchanged=unchanged)
+            info(f'Wrote level {i}: {len(level_jobs)} ebuilds')
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='plan and generate the ebuilds of PyPI projects with their dependencies')
+    parser.add_argument('-r', '--repos', action='append', default=[],
+        help='existing Portage repositories, do not specify it if you want it to find all repositories automatically')
+    parser.add_argument('-t', '--target', help='target repo directory, or an archive (.tar, .tar.gz, .tgz, .tar.bz2, .tar.xz) '
+                        'the overlay is streamed into, nothing is written if not specified')
+    parser.add_argument('--in-memory', action='store_true', help='keep the overlay in memory and write it to --target at once')
+    parser.add_argument('-j', '--jobs', type=int, help='the number of processes writing ebuilds')
+    parser.add_argument('--json', help='export the graph as json')
+    parser.add_argument('--dot', help='export the graph in dot language')
+    parser.add_argument('--mirror', help='read PyPI metadata from a local directory, SQLite dump or JSONL dump instead of the network')
+    profiling.add_arguments(parser)
+    parser.add_argument('packages', nargs='+')
+    args = parser.parse_args()
+    profiling.start(args)
+
+    from . import portage_parser
+    if len(args.repos) == 0:
+        import portage
+        eroot = next(iter(portage.db.keys()))
+        repositories = portage.db[eroot]["vartree"].settings.repositories
+        repos = [repositories.treemap.get(name) for name in repositories.prepos_order]
+    else:
+        repos = args.repos
+    portage_parser.find_packages(repos)
+
+    if args.mirror:
+        PYPICommunicator.fetcher = PyPIFetcher(source=open_source(args.mirror))
+    graph = build_graph(args.packages)
+    levels = graph.levels()
+    print(f'{sum(map(len, levels))} packages to generate in {len(levels)} levels')
+    for i, level in enumerate(levels):
+        print(f'level {i}: {" ".join(level)}')
+    for cycle in graph.cycles():
+        print(f'cycle: {" -> ".join(cycle)}')
+    print(f'critical path: {" -> ".join(graph.critical_path())}')
+    unresolved = graph.unresolved()
+    if unresolved:
+        print(f'{len(unresolved)} dependencies could not be resolved: {" ".join(unresolved)}')
+    print(PYPIParser.PN_database.describe_stats())
+    print(ToBeGeneratedEbuilds.registry.describe_stats())
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(graph.to_json(), f, indent=2)
+    if args.dot:
+        with open(args.dot, 'w') as f:
+            f.write(graph.to_dot())
+    if args.target:
+        if archive_mode(args.target) or args.in_memory:
+            bundle = OverlayBundle(args.target)
+            generate_by_level(graph, Path(args.target), args.jobs, bundle)
+            print(bundle.close().describe_stats())
+        else:
+            print(generate_by_level(graph, Path(args.target), args.jobs).describe_stats())
+    profiling.finish(args)
+
+
+if __name__ == "__main__":
+    main()
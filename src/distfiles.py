@@ -0,0 +1,287 @@
+"""
+This file downloads the distfiles of generated packages into a shared DISTDIR
+
+Transfers run in a thread pool sharing one connection pool. A file being
+downloaded is kept as <name>.__download__, as Portage does, so an interrupted
+transfer continues with a Range request instead of starting over. Finished
+files are verified against the sha256 PyPI publishes for them, and concurrent
+requests for the same file share a single transfer.
+"""
+import os
+import time
+import hashlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+from threading import Lock
+from logging import info, warn
+
+from .manifest import DEFAULT_DISTDIR, HashCache, hash_file
+from . import profiling
+
+# bytes read from the network at once
+CHUNK_SIZE = 65536
+
+# suffix of partial downloads, the same as Portage's
+PARTIAL_SUFFIX = ".__download__"
+
+# url: String
+# filename: String, the name in the distdir
+# sha256: String, hex digest, nothing is verified if None
+# size: int, bytes, nothing is verified if None
+Distfile = namedtuple("Distfile", ["url", "filename", "sha256", "size"])
+
+
+def release_distfile(release_body, filename=None):
+    """
+    Parse PyPI -
+    the distfile of a file of a release
+
+    Input:
+        release_body: dict, an entry of body['releases'][version] or of body['urls']
+        filename: String, the name in the distdir, the one on PyPI if None
+
+    return: Distfile
+    """
+    url = release_body['url']
+    return Distfile(url, filename or release_body.get('filename') or url.rsplit('/', 1)[-1],
+                    (release_body.get('digests') or {}).get('sha256'), release_body.get('size'))
+
+
+class DigestError(Exception):
+    pass
+
+
+class DistfileStore:
+
+    def __init__(self, distdir=None, workers=4, timeout=60, retries=3, cache=None):
+        """
+        Input:
+            distdir: Path / String, the directory of the distfiles, DEFAULT_DISTDIR if None,
+                     it is created by the first download
+            workers: int, the maximum number of concurrent transfers
+            timeout: float, seconds to wait for the server
+            retries: int, times an interrupted transfer is resumed
+            cache: HashCache, the digests of verified distfiles, share the one of ManifestWriter,
+                   a default one is loaded if None
+        """
+        self.distdir = Path(distdir or DEFAULT_DISTDIR)
+        self.cache = cache or HashCache()
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        import requests
+        from requests.adapters import HTTPAdapter
+        # one pooled connection per worker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="distfile")
+        self.lock = Lock()
+        # key: filename
+        # value: Future of a transfer in progress
+        self.inflight = {}
+        # statistics
+        self.downloaded = 0
+        self.resumed = 0
+        self.present = 0
+        self.shared = 0
+        self.failed = 0
+        self.received = 0
+        # wall time with at least one transfer running
+        self.active = 0
+        self.active_since = 0.0
+        self.seconds = 0.0
+
+    def submit(self, distfile):
+        """
+        Write Portage -
+        download a distfile in the background, unless it is in the distdir already,
+        a request for a file being downloaded joins that transfer
+
+        Input:
+            distfile: Distfile
+
+        return: Future of Path
+        """
+        with self.lock:
+            future = self.inflight.get(distfile.filename)
+            if future is not None:
+                self.shared += 1
+                return future
+            future = self.executor.submit(self._fetch, distfile)
+            self.inflight[distfile.filename] = future
+        future.add_done_callback(lambda _: self._done(distfile.filename))
+        return future
+
+    def _done(self, filename):
+        with self.lock:
+            self.inflight.pop(filename, None)
+
+    def fetch(self, distfile):
+        """
+        Write Portage -
+        download a distfile, unless it is in the distdir already
+
+        Input:
+            distfile: Distfile
+
+        return: Path
+        """
+        return self.submit(distfile).result()
+
+    def wait(self, futures, report=None, interval=5.0):
+        """
+        wait for transfers, reporting the progress every interval seconds
+
+        Input:
+            futures: list of Future, returned by submit()
+            report: callable taking a String, e.g. print, nothing is reported if None
+            interval: float, seconds
+
+        return: int, the number of failed transfers
+        """
+        pending = set(futures)
+        while pending:
+            _, pending = wait(pending, timeout=interval)
+            if pending and report:
+                report(self.describe_progress())
+        return sum(1 for future in futures if future.exception() is not None)
+
+    def _fetch(self, distfile):
+        path = self.distdir / distfile.filename
+        try:
+            if self._is_valid(path, distfile):
+                with self.lock:
+                    self.present += 1
+                return path
+            self._download(distfile, path)
+        except Exception as e:
+            with self.lock:
+                self.failed += 1
+            warn(f"Failed to download {distfile.url}: {type(e).__name__}: {e}")
+            raise
+        return path
+
+    def _is_valid(self, path, distfile):
+        """
+        whether a file in the distdir has the size and the digest of a distfile,
+        a file is hashed once, until its size or mtime changes, see HashCache
+        """
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return False
+        if distfile.size is not None and st.st_size != distfile.size:
+            return False
+        if distfile.sha256 is None:
+            return True
+        abs_path = os.path.abspath(path)
+        digests = self.cache.get(abs_path, st)
+        if digests is None:
+            digests = hash_file(abs_path)
+            self.cache.put(abs_path, st, digests)
+        return digests["SHA256"] == distfile.sha256
+
+    def _download(self, distfile, path):
+        import requests
+        partial = path.with_name(path.name + PARTIAL_SUFFIX)
+        # not before, a run without downloads does not need a writable distdir
+        self.distdir.mkdir(parents=True, exist_ok=True)
+        self._begin()
+        start = time.perf_counter()
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    offset, digest = self._transfer(distfile, partial)
+                    break
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                    if attempt == self.retries:
+                        raise
+                    info(f"Resuming {distfile.filename} after {type(e).__name__}")
+            if distfile.sha256 is not None and digest.hexdigest() != distfile.sha256:
+                partial.unlink(missing_ok=True)
+                raise DigestError(f"{distfile.filename} has sha256 {digest.hexdigest()}, expected {distfile.sha256}")
+            os.replace(partial, path)
+        finally:
+            self._end()
+        seconds = time.perf_counter() - start
+        size = path.stat().st_size
+        with self.lock:
+            self.downloaded += 1
+            self.resumed += offset > 0
+        profiling.observe("download", seconds)
+        profiling.count("distfiles_downloaded")
+        profiling.count("distfile_bytes_received", size - offset)
+        info(f"Downloaded {distfile.filename}: {(size - offset) / 1024:.0f} KiB in {seconds:.2f}s "
+             f"({(size - offset) / 1024 / 1024 / max(seconds, 1e-9):.1f} MiB/s)"
+             + (f", resumed at {offset} bytes" if offset else ""))
+
+    def _transfer(self, distfile, partial):
+        """
+        continue the partial download of a distfile
+
+        return: (int, the offset it was resumed at; hashlib object, sha256 of the whole file)
+        """
+        offset = partial.stat().st_size if partial.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with self.session.get(distfile.url, headers=headers, stream=True, timeout=self.timeout) as resp:
+            if resp.status_code == 416 and offset:
+                # the partial file may be complete already, or garbage, it is verified anyway
+                return offset, _sha256_file(partial)
+            resp.raise_for_status()
+            if resp.status_code != 206 or not resp.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+                # the server ignored the range, start over
+                offset = 0
+            digest = _sha256_file(partial) if offset else hashlib.sha256()
+            with partial.open('ab' if offset else 'wb') as f:
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    with self.lock:
+                        self.received += len(chunk)
+        return offset, digest
+
+    def _begin(self):
+        with self.lock:
+            if self.active == 0:
+                self.active_since = time.perf_counter()
+            self.active += 1
+
+    def _end(self):
+        with self.lock:
+            self.active -= 1
+            if self.active == 0:
+                self.seconds += time.perf_counter() - self.active_since
+
+    def describe_progress(self):
+        """
+        return: String, a human readable summary of the transfers in progress
+        """
+        with self.lock:
+            return (f'Downloading {len(self.inflight)} distfiles, {self.downloaded + self.present} done, '
+                    f'{self.received / 1024 / 1024:.1f} MiB received')
+
+    def describe_stats(self):
+        """
+        return: String, a human readable summary of the transfers so far
+        """
+        with self.lock:
+            seconds = self.seconds + (time.perf_counter() - self.active_since if self.active else 0)
+            return (f'Distfiles: {self.downloaded} downloaded ({self.resumed} resumed), {self.present} present, '
+                    f'{self.shared} shared, {self.failed} failed, {self.received / 1024 / 1024:.1f} MiB '
+                    f'at {self.received / 1024 / 1024 / max(seconds, 1e-9):.1f} MiB/s ({self.workers} workers)')
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+        self.cache.save()
+
+
+def _sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h
@@ -1,9 +1,9 @@
 from pathlib import Path
-from logging import debug, info, warn, error
+from logging import info
 import datetime
 
-from .metadata_repr import PkgMetadata, ToBeGeneratedEbuilds
-from .pypi_parser import PYPIParser
+from .metadata_repr import PkgMetadata
+from .overlay_bundle import DirectoryOutput
 
 
 ## TODO: use a config file
@@ -54,49 +54,66 @@ METADATA_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
 """
 
 
-def generate_metadata_if_not_existing(metadata_path, supp_informations: dict):
+def render(pypi_id, my_metadata: PkgMetadata):
     """
     Write Portage -
-    write metadata to provided path
+    render the files of the package of a PyPI project
 
     Input:
-        metadata_path: pathlib.Path, the path of the metadata
         pypi_id: ToString, PyPI project name
+        my_metadata: PkgMetadata
 
-    return: the number of characters written
+    return: list of (Path, String, bool), the path relative to the overlay, the content,
+            and whether an existing file is kept instead
     """
-    informations = constant_info | supp_informations
-    if not metadata_path.exists():
-        metadata = METADATA_TEMPLATE.format(**informations)
-        return open(metadata_path, 'w').write(metadata)
-    else:
-        return 0
+    # dir of the project
+    parent_dir = Path(my_metadata.portage_cate) / my_metadata.portage_name
+    informations = my_metadata.export_dict() | constant_info
+    return [
+        # ${P}
+        (parent_dir / f"{my_metadata.portage_name}-{my_metadata.portage_version}.ebuild",
+         EBUILD_TEMPLATE.format(**informations), False),
+        (parent_dir / "metadata.xml", METADATA_TEMPLATE.format(**informations), True),
+    ]
+
+
+def write_files(output, files):
+    """
+    Write Portage -
+    write rendered files
+
+    Input:
+        output: DirectoryOutput / OverlayBundle
+        files: list of (Path, String, bool), see render()
+
+    return: (int, int), the number of files written and of files left as they were
+    """
+    written = 0
+    for rel_path, content, keep_existing in files:
+        if keep_existing and output.exists(rel_path):
+            continue
+        changed = output.write(rel_path, content)
+        if rel_path.suffix == ".ebuild":
+            info(f"{'Writing ebuild to' if changed else 'Unchanged'} {rel_path}")
+        written += changed
+    return written, len(files) - written
+
 
 def generate(repo_dir: Path,
-             pypi_id, my_metadata: PkgMetadata):
+             pypi_id, my_metadata: PkgMetadata, output=None):
     """
     Write Portage -
     resolve and (may recursively) generate the ebuild of a PyPI project
 
     Input:
-        package: ToString, project name
+        repo_dir: Path, location of the overlay
+        pypi_id: ToString, PyPI project name
+        my_metadata: PkgMetadata
+        output: OverlayBundle, the files go into it instead of repo_dir if provided
 
-    return: None
+    return: (int, int), the number of files written and of files left as they were
     """
-    # dir of the project
-    parent_dir = repo_dir / my_metadata.portage_cate / my_metadata.portage_name
-    # ${P}
-    ebuild_path = parent_dir / f"{my_metadata.portage_name}-{my_metadata.portage_version}.ebuild"
-    info('Writing ebuild to', ebuild_path)
-    parent_dir.mkdir(parents=True, exist_ok=True)
-    # write ebuild
-    with ebuild_path.open('w') as f:
-        informations = my_metadata.export_dict() | constant_info
-        content = EBUILD_TEMPLATE.format(**informations)
-        f.write(content)
-
-    # generate metadata, if it is not existing
-    generate_metadata_if_not_existing(parent_dir / "metadata.xml", informations)
+    return write_files(output or DirectoryOutput(repo_dir), render(pypi_id, my_metadata))
 
     # update existing_packages anyway
     ## will it cause infinity-loop?
@@ -0,0 +1,176 @@
+"""
+This file keeps PyPI responses on disk between runs
+
+Every response body is stored with its ETag/Last-Modified, so it can be
+revalidated with a conditional request once it is older than the TTL.
+"""
+import os
+import json
+import time
+import hashlib
+from collections import namedtuple
+from pathlib import Path
+from threading import Lock, get_ident
+from logging import info
+
+from . import profiling
+
+
+# path: pathlib.Path of the body, read it with HTTPCache.iter_chunks()
+CachedResponse = namedtuple("CachedResponse", ["path", "etag", "last_modified", "fetched"])
+
+
+def default_cache_dir():
+    """
+    the default location of the cache, i.e. $XDG_CACHE_HOME/pypi-ebuilder/http
+
+    return: pathlib.Path
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return Path(cache_home) / "pypi-ebuilder" / "http"
+
+
+class HTTPCache:
+    """
+    url => (body, ETag, Last-Modified, time of fetching)
+
+    The cache is stored as files:
+        <dir>/<sha256 of url>.body: the raw body
+        <dir>/<sha256 of url>.meta: json of {"url", "etag", "last_modified", "fetched"}
+    """
+
+    def __init__(self, path=None, ttl=3600, max_size=1024 * 1024 * 1024):
+        """
+        Input:
+            path: Path / String, directory of the cache, default_cache_dir() if None
+            ttl: float, seconds during which a cached response is used without asking the server
+            max_size: int, bytes of bodies kept after evict()
+        """
+        self.path = Path(path) if path else default_cache_dir()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_size = max_size
+        # statistics
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return self.path / f"{key}.body", self.path / f"{key}.meta"
+
+    def lookup(self, url):
+        """
+        Input:
+            url: String
+
+        return: CachedResponse or None
+        """
+        body_path, meta_path = self._paths(url)
+        try:
+            with meta_path.open() as f:
+                meta = json.load(f)
+            # the body is used, keep it away from evict()
+            os.utime(body_path)
+        except (OSError, ValueError):
+            return None
+        return CachedResponse(body_path, meta["etag"], meta["last_modified"], meta["fetched"])
+
+    def is_fresh(self, cached):
+        return time.time() - cached.fetched < self.ttl
+
+    def iter_chunks(self, cached, chunk_size=65536):
+        """
+        return: iterator of bytes, the body of a CachedResponse in chunks
+        """
+        with cached.path.open('rb') as f:
+            yield from iter(lambda: f.read(chunk_size), b'')
+
+    def store_stream(self, url, chunks, etag=None, last_modified=None):
+        """
+        store a response while it is streamed, it is stored once all chunks went through
+
+        Input:
+            url: String
+            chunks: iterator of bytes, the body
+            etag: String, the ETag header
+            last_modified: String, the Last-Modified header
+
+        return: iterator of bytes, the chunks
+        """
+        body_path, _ = self._paths(url)
+        tmp_path = self._tmp_path(body_path)
+        try:
+            with tmp_path.open('wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.replace(tmp_path, body_path)
+        except BaseException:
+            # a broken transfer, a bad body or a reader stopping early, e.g. GeneratorExit
+            tmp_path.unlink(missing_ok=True)
+            raise
+        self._write_meta(url, etag, last_modified)
+
+    def refresh(self, url, cached):
+        """
+        the server confirmed the cached response (304), restart its TTL
+        """
+        self._write_meta(url, cached.etag, cached.last_modified)
+
+    def _tmp_path(self, path):
+        return path.with_name(f"{path.name}.{os.getpid()}.{get_ident()}.tmp")
+
+    def _write(self, path, content):
+        tmp_path = self._tmp_path(path)
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, path)
+
+    def _write_meta(self, url, etag, last_modified):
+        _, meta_path = self._paths(url)
+        meta = {"url": url, "etag": etag, "last_modified": last_modified, "fetched": time.time()}
+        self._write(meta_path, json.dumps(meta).encode())
+
+    def count(self, hits=0, misses=0, revalidated=0):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+            self.revalidated += revalidated
+        profiling.count("http_cache_hits", hits)
+        profiling.count("http_cache_misses", misses)
+        profiling.count("http_cache_revalidated", revalidated)
+
+    def evict(self):
+        """
+        remove the least recently used responses until the bodies fit in max_size
+
+        return: int, the number of removed responses
+        """
+        bodies = []
+        total = 0
+        for body_path in self.path.glob("*.body"):
+            try:
+                st = body_path.stat()
+            except FileNotFoundError:
+                continue
+            bodies.append((st.st_mtime, st.st_size, body_path))
+            total += st.st_size
+        removed = 0
+        for _, size, body_path in sorted(bodies):
+            if total <= self.max_size:
+                break
+            body_path.with_suffix(".meta").unlink(missing_ok=True)
+            body_path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        if removed:
+            info(f"Evicted {removed} responses from {self.path}")
+        return removed
+
+    def describe_stats(self):
+        """
+        return: String, a human readable summary of the cache usage
+        """
+        return (f'HTTP cache: {self.hits} hits, {self.revalidated} revalidated, '
+                f'{self.misses} misses')
@@ -0,0 +1,198 @@
+"""
+This file extracts the needed fields of a PyPI json document while it is streamed
+
+Unneeded values, e.g. the README in info.description or the files of all
+releases, are scanned and dropped without building Python objects, so the
+memory per document is bounded by the largest *needed* value plus one chunk.
+"""
+import re
+import json
+import codecs
+
+# the fields of "info" used to generate an ebuild
+INFO_FIELDS = ("name", "version", "license", "requires_dist", "classifiers", "summary", "home_page")
+
+_non_ws = re.compile(r"\S")
+_string_special = re.compile(r'["\\]')
+_structural = re.compile(r'["{}\[\]]')
+_scalar_end = re.compile(r"[,\]}\s]")
+
+
+class JSONReader:
+    """
+    a pull parser over an iterator of bytes chunks,
+    it only keeps the text from the value being collected (or the current position) on
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        # start of the value being collected, None if nothing is collected
+        self.mark = None
+        # the largest buffer so far, in characters
+        self.peak = 0
+
+    def _fill(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            raise ValueError("truncated json document")
+        cut = self.pos if self.mark is None else self.mark
+        self.buf = self.buf[cut:] + self.decoder.decode(chunk)
+        self.pos -= cut
+        if self.mark is not None:
+            self.mark -= cut
+        self.peak = max(self.peak, len(self.buf))
+
+    def peek(self):
+        """
+        skip whitespaces
+
+        return: String, the next character, not consumed
+        """
+        while True:
+            m = _non_ws.search(self.buf, self.pos)
+            if m:
+                self.pos = m.start()
+                return self.buf[self.pos]
+            self.pos = len(self.buf)
+            self._fill()
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise ValueError(f"expected {c!r} at {self.buf[self.pos:self.pos + 20]!r}")
+        self.pos += 1
+
+    def skip_string(self):
+        self.expect('"')
+        while True:
+            m = _string_special.search(self.buf, self.pos)
+            if m is None:
+                self.pos = len(self.buf)
+                self._fill()
+            elif m.group() == '"':
+                self.pos = m.end()
+                return
+            elif m.end() < len(self.buf):
+                # an escaped character
+                self.pos = m.end() + 1
+            else:
+                # the escaped character is in the next chunk
+                self.pos = m.start()
+                self._fill()
+
+    def skip_value(self):
+        c = self.peek()
+        if c == '"':
+            self.skip_string()
+        elif c in "{[":
+            depth = 0
+            while True:
+                m = _structural.search(self.buf, self.pos)
+                if m is None:
+                    self.pos = len(self.buf)
+                    self._fill()
+                    continue
+                self.pos = m.start()
+                if m.group() == '"':
+                    self.skip_string()
+                    continue
+                self.pos += 1
+                depth += 1 if m.group() in "{[" else -1
+                if depth == 0:
+                    return
+        else:
+            while True:
+                m = _scalar_end.search(self.buf, self.pos)
+                if m:
+                    self.pos = m.start()
+                    return
+                self.pos = len(self.buf)
+                self._fill()
+
+    def collect_value(self):
+        """
+        return: the next value, decoded
+        """
+        self.peek()
+        self.mark = self.pos
+        try:
+            self.skip_value()
+            return json.loads(self.buf[self.mark:self.pos])
+        finally:
+            self.mark = None
+
+    def iter_object(self):
+        """
+        iterate over the keys of the next object,
+        the value of a key has to be consumed before asking for the next key
+
+        return: iterator of String
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            if self.peek() != '"':
+                raise ValueError(f"expected a key at {self.buf[self.pos:self.pos + 20]!r}")
+            key = self.collect_value()
+            self.expect(":")
+            yield key
+            c = self.peek()
+            self.pos += 1
+            if c == "}":
+                return
+            if c != ",":
+                raise ValueError(f"expected ',' or '}}' at {self.buf[self.pos - 1:self.pos + 20]!r}")
+
+
+def _sdists(files):
+    return [f for f in files if f.get("python_version") == "source" or f.get("packagetype") == "sdist"]
+
+
+def extract_project(chunks, info_fields=INFO_FIELDS):
+    """
+    Parse PyPI -
+    extract the needed parts of a /pypi/{name}/json or /pypi/{name}/{version}/json document
+
+    Input:
+        chunks: iterator of bytes, the document
+        info_fields: iterable of String, the fields of "info" to keep
+
+    return: (dict, int): the document with
+                "info": the chosen fields,
+                "urls": the sdists of the current release,
+                "releases": {current version: the sdists of the current release},
+            and the peak size of the parse buffer in characters
+    """
+    reader = JSONReader(chunks)
+    info_fields = set(info_fields)
+    body = {}
+    for key in reader.iter_object():
+        if key == "info":
+            info = body["info"] = {}
+            for field in reader.iter_object():
+                if field in info_fields:
+                    info[field] = reader.collect_value()
+                else:
+                    reader.skip_value()
+        elif key == "urls":
+            body["urls"] = _sdists(reader.collect_value())
+        elif key == "releases" and "info" in body:
+            # "info" comes before "releases" in PyPI's documents
+            version = body["info"].get("version")
+            for release in reader.iter_object():
+                if release == version:
+                    body["releases"] = {version: _sdists(reader.collect_value())}
+                else:
+                    reader.skip_value()
+        elif key == "message":
+            # e.g. {"message": "Not Found"}
+            body["message"] = reader.collect_value()
+        else:
+            reader.skip_value()
+    if "info" in body and "releases" not in body:
+        body["releases"] = {body["info"].get("version"): body.get("urls", [])}
+    return body, reader.peak
@@ -0,0 +1,233 @@
+"""
+This file writes the (thin) Manifest files of the overlay
+
+Every distfile is hashed once (BLAKE2B and SHA512 in one read) by a thread
+pool, and the digests are kept in an on-disk cache keyed by path, size and
+mtime, so a distfile is not hashed again until it changes. The Manifests of
+all packages of a run are written in one pass.
+"""
+import os
+import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock, get_ident
+from logging import info, warn
+
+from .overlay_bundle import DirectoryOutput
+from . import profiling
+
+# the default DISTDIR of Portage
+DEFAULT_DISTDIR = "/var/cache/distfiles"
+
+# bump it whenever the layout of the cache file changes
+CACHE_FORMAT = 2
+
+
+def default_cache_path():
+    """
+    the default location of the hash cache, i.e. $XDG_CACHE_HOME/pypi-ebuilder/distfile-hashes.json
+
+    return: pathlib.Path
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return Path(cache_home) / "pypi-ebuilder" / "distfile-hashes.json"
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    Parse Portage -
+    hash a distfile as a Manifest needs it, and as PyPI publishes it, reading it once
+
+    Input:
+        path: Path / String
+
+    return: dict of {"BLAKE2B": hex, "SHA512": hex, "SHA256": hex}
+    """
+    blake2b = hashlib.blake2b()
+    sha512 = hashlib.sha512()
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        # hashlib releases the GIL for large buffers, so threads hash in parallel
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            blake2b.update(chunk)
+            sha512.update(chunk)
+            sha256.update(chunk)
+    return {"BLAKE2B": blake2b.hexdigest(), "SHA512": sha512.hexdigest(), "SHA256": sha256.hexdigest()}
+
+
+class HashCache:
+    """
+    absolute path of a distfile => its size, mtime and digests
+
+    shared by ManifestWriter and DistfileStore, so a distfile is hashed once
+    whether it is verified after a download or put in a Manifest
+
+    The cache is stored as json:
+        {"format": CACHE_FORMAT,
+         "files": {path: {"size": int, "mtime_ns": int, "BLAKE2B": str, "SHA512": str, "SHA256": str}}}
+    """
+
+    def __init__(self, path=None):
+        """
+        Input:
+            path: Path / String, location of the cache file, default_cache_path() if None
+        """
+        self.path = Path(path) if path else default_cache_path()
+        self.files = {}
+        self.lock = Lock()
+        try:
+            with self.path.open() as f:
+                data = json.load(f)
+            if data.get("format") == CACHE_FORMAT:
+                self.files = data["files"]
+        except (OSError, ValueError):
+            pass
+
+    def get(self, path, st):
+        """
+        Input:
+            path: String, absolute path of a distfile
+            st: os.stat_result of it
+
+        return: dict of digests, or None if it is not cached or the file changed
+        """
+        with self.lock:
+            entry = self.files.get(path)
+        if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            return entry
+        return None
+
+    def put(self, path, st, digests):
+        with self.lock:
+            self.files[path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, **digests}
+
+    def save(self):
+        """
+        write the cache atomically, the entries of removed distfiles are dropped
+        """
+        with self.lock:
+            self.files = {path: entry for path, entry in self.files.items() if os.path.exists(path)}
+            files = dict(self.files)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # ManifestWriter and DistfileStore, or two runs, may save at once
+        tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.{get_ident()}.tmp")
+        with tmp_path.open('w') as f:
+            json.dump({"format": CACHE_FORMAT, "files": files}, f)
+        os.replace(tmp_path, self.path)
+
+
+def parse_manifest(content):
+    """
+    Parse Portage -
+    read the DIST entries of a Manifest
+
+    Input:
+        content: String, the Manifest, None if there is none
+
+    return: dict of {distfile: line}
+    """
+    if content is None:
+        return {}
+    return {line.split()[1]: line for line in content.splitlines() if line.startswith("DIST ")}
+
+
+class ManifestWriter:
+
+    def __init__(self, distdir=None, jobs=None, cache=None):
+        """
+        Input:
+            distdir: Path / String, the directory of the distfiles, DEFAULT_DISTDIR if None
+            jobs: int, the number of threads hashing distfiles, os.cpu_count() if None
+            cache: HashCache, a default one is loaded if None
+        """
+        self.distdir = Path(distdir or DEFAULT_DISTDIR)
+        self.jobs = jobs or os.cpu_count() or 1
+        self.cache = cache or HashCache()
+        # one write() at a time, e.g. between the requests of a server
+        self.lock = Lock()
+        # statistics
+        self.stats_lock = Lock()
+        self.stats = {"written": 0, "unchanged": 0, "hashed": 0, "cached": 0, "missing": 0,
+                      "bytes": 0, "seconds": 0.0}
+
+    def _digest(self, distfile):
+        """
+        return: (size, digests) of a distfile in distdir, or None if it is missing
+        """
+        path = os.path.abspath(self.distdir / distfile)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        digests = self.cache.get(path, st)
+        if digests is None:
+            digests = hash_file(path)
+            self.cache.put(path, st, digests)
+            with self.stats_lock:
+                self.stats["hashed"] += 1
+                self.stats["bytes"] += st.st_size
+            profiling.count("distfiles_hashed")
+            profiling.count("distfile_bytes_hashed", st.st_size)
+        else:
+            with self.stats_lock:
+                self.stats["cached"] += 1
+        return st.st_size, digests
+
+    def write(self, packages, output=None):
+        """
+        Write Portage -
+        hash the distfiles of packages in a thread pool, then update their Manifests,
+        the entries of other distfiles in a Manifest are kept
+
+        Input:
+            packages: list of (pkg_dir: Path, distfiles: list of String), pkg_dir is relative to output
+            output: DirectoryOutput / OverlayBundle, where the Manifests go, the file system if None
+
+        return: (int, the number of written Manifests;
+                 dict of {pkg_dir: list of String}, the distfiles missing in distdir,
+                 their packages can not be fetched by Portage)
+        """
+        with self.lock, profiling.stage("manifest"):
+            return self._write(packages, output or DirectoryOutput(Path()))
+
+    def _write(self, packages, output):
+        start = time.perf_counter()
+        distfiles = sorted({distfile for _, names in packages for distfile in names})
+        with ThreadPoolExecutor(self.jobs) as executor:
+            digests = dict(zip(distfiles, executor.map(self._digest, distfiles)))
+        written = 0
+        missing = {}
+        for pkg_dir, names in packages:
+            manifest_path = Path(pkg_dir) / "Manifest"
+            entries = parse_manifest(output.read(manifest_path))
+            for distfile in names:
+                if digests[distfile] is None:
+                    warn(f"{distfile} is not in {self.distdir}, it is left out of {manifest_path}")
+                    missing.setdefault(pkg_dir, []).append(distfile)
+                    self.stats["missing"] += 1
+                    continue
+                size, d = digests[distfile]
+                entries[distfile] = f"DIST {distfile} {size} BLAKE2B {d['BLAKE2B']} SHA512 {d['SHA512']}"
+            if not entries:
+                continue
+            content = "".join(entries[distfile] + "\n" for distfile in sorted(entries))
+            if output.write(manifest_path, content):
+                written += 1
+            else:
+                self.stats["unchanged"] += 1
+        self.stats["written"] += written
+        self.stats["seconds"] += time.perf_counter() - start
+        self.cache.save()
+        info(self.describe_stats())
+        return written, missing
+
+    def describe_stats(self):
+        """
+        return: String, a human readable summary of the Manifests written so far
+        """
+        s = self.stats
+        return (f'Manifest: {s["written"]} written, {s["unchanged"]} unchanged, '
+                f'{s["hashed"]} distfiles hashed ({s["bytes"] / 1024 / 1024 / max(s["seconds"], 1e-9):.1f} MiB/s, '
+                f'{self.jobs} threads), {s["cached"]} from the cache, {s["missing"]} missing')
@@ -1,11 +1,15 @@
 """
 This file represents the intermedia metadata
 """
+import sys
+from logging import warn
 
-### TODO: do I really need this lock?
-from threading import RLock
+from .registry import ShardedRegistry
 
 class PkgMetadata:
+    # no __dict__ per object, there may be thousands of them
+    __slots__ = ("pypi_id", "portage_cate", "portage_name", "portage_version", "portage_lic",
+                 "short_desc", "long_desc", "homepage", "dep_dict", "dep_str", "iuse")
 
     def __init__(self,
                  pypi_id,
@@ -14,7 +18,8 @@ class PkgMetadata:
         # pypi id (str): the related pypi id
         self.pypi_id = pypi_id
         #
-        self.portage_cate = portage_cate
+        # there are only a few hundred categories, share their strings
+        self.portage_cate = sys.intern(portage_cate)
         self.portage_name = portage_name
         # these two are not critical
         self.portage_version = portage_version
@@ -28,9 +33,20 @@ class PkgMetadata:
     def add_homepage(self, homepage):
         self.homepage = homepage
     
-    def parse_deps(self, dep_dict):
+    def parse_deps(self, dep_dict, fetch_missing=True):
         # import it here to resolve circular import....
         from .pypi_parser import PYPIParser, PYPICommunicator
+        # the missing deps claimed by someone else are translated already, or are being translated,
+        # e.g. by a caller up the stack in a dependency cycle
+        claimed = {}
+        if fetch_missing:
+            for pypi_id, _ in dep_dict["_default"]:
+                if not PYPIParser.catepn(pypi_id)[2]:
+                    future, owner = ToBeGeneratedEbuilds.registry.claim(pypi_id)
+                    if owner:
+                        claimed[pypi_id] = future
+        # all of them are needed, fetch them at once
+        bodies = PYPICommunicator.get_fetcher().fetch_many(claimed, return_exceptions=True) if claimed else {}
         dep_str = "\n"
         for pypi_id, version_hint in dep_dict["_default"]:
             cate, pn, exist = PYPIParser.catepn(pypi_id)
@@ -39,11 +55,6 @@ class PkgMetadata:
                 dep_str += f"\t{version_hint[0]}{cate}/{pn}-{version_hint[1]}[${{PYTHON_USEDEP}}]\n"
             else:
                 dep_str += f"\t{cate}/{pn}[${{PYTHON_USEDEP}}]\n"
-            # add missing to todo list
-            ## TODO:
-            if not exist:
-                t = PYPICommunicator()
-                t.test(pypi_id)
         for key, val in dep_dict.items():
             if key != "_default":
                 dep_str += f"\t{key}? (\n"
@@ -59,6 +70,12 @@ class PkgMetadata:
         self.dep_str = dep_str
         self.iuse = set(dep_dict.keys())
         self.iuse.remove("_default")
+        # translate the missing deps, and theirs
+        communicator = PYPICommunicator()
+        for pypi_id, future in claimed.items():
+            communicator.resolve(future, pypi_id, bodies[pypi_id])
+            if future.exception() is not None:
+                warn(f"Failed to translate {pypi_id}, a dependency of {self.pypi_id}: {future.exception()}")
 
     def export_dict(self):
         return {
@@ -72,9 +89,34 @@ class PkgMetadata:
             }
 
 
+class PortagePackage:
+    """
+    an existing Portage package providing a PyPI project,
+    one per pypi package of the scanned repositories, so it only keeps what lookups need
+    """
+    __slots__ = ("portage_cate", "portage_name", "portage_version")
+
+    def __init__(self, portage_cate, portage_name, portage_version=None):
+        self.portage_cate = sys.intern(portage_cate)
+        self.portage_name = portage_name
+        # versions repeat a lot, e.g. "1.0.0"
+        self.portage_version = sys.intern(portage_version) if portage_version else portage_version
+
+
 class ToBeGeneratedEbuilds:
-    lock = RLock()
-    # pypi_id: PkgMetadata
-    payload = {}
+    # key: normalized PyPI name
+    # value: Future of (pypi_id, dict of {use: deps}, PkgMetadata or None if Portage has it),
+    #        see PYPICommunicator.test()
+    registry = ShardedRegistry()
 
-        
\ No newline at end of file
+    @staticmethod
+    def items():
+        """
+        return: list of (pypi_id, PkgMetadata) of the translated packages to be generated,
+                once per project even if it was asked for by several names
+        """
+        payload = {}
+        for _, (pypi_id, _, pkgmeta) in ToBeGeneratedEbuilds.registry.items():
+            if pkgmeta is not None:
+                payload[pypi_id] = pkgmeta
+        return list(payload.items())
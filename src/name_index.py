@@ -0,0 +1,142 @@
+"""
+This file collects the rules of naming PyPI projects
+
+Every PyPI => Portage lookup goes through a NameIndex: names are normalized
+(PEP 503) once when they are added, aliases are expanded into the same table,
+so resolving a name is one hash lookup.
+"""
+import re
+from functools import lru_cache
+from threading import Lock, local
+
+_non_alnum_run = re.compile(r"[-_.]+")
+
+# PyPI projects that were renamed, requirements may still use the old name
+# key: old name
+# value: current name
+RENAMED = {
+    'sklearn': 'scikit-learn',
+    'msgpack-python': 'msgpack',
+    'tensorflow-tensorboard': 'tensorboard',
+}
+
+
+def _normalize(pypi_id):
+    key = _non_alnum_run.sub("-", pypi_id).lower()
+    # most names are normalized already, keep a single string for both
+    return pypi_id if key == pypi_id else key
+
+
+# requirements name the same projects again and again
+@lru_cache(maxsize=4096)
+def normalize_pypi_name(pypi_id):
+    """
+    PEP 503 normalization, so "Foo_Bar" in a requirement meets "foo-bar" from PyPI
+
+    Input:
+        pypi_id: String, PyPI project name
+
+    return: String
+    """
+    return _normalize(pypi_id)
+
+
+class NameIndex:
+    """
+    normalized PyPI name => value, e.g. the Portage package providing the project
+
+    Pinned entries (exceptions) are never replaced by add(), an entry added
+    under a current name is reachable by the old names in the rename table.
+    """
+
+    def __init__(self, exceptions=None, renames=RENAMED):
+        """
+        Input:
+            exceptions: dict of {pypi_id: value}, pinned entries
+            renames: dict of {old pypi_id: current pypi_id}
+        """
+        # key: normalized name
+        # value: the value of the entry
+        self.entries = {}
+        # normalized names of the pinned entries
+        self.pinned = set()
+        # key: normalized current name
+        # value: list of normalized old names
+        self.aliases = {}
+        for old, new in (renames or {}).items():
+            self.aliases.setdefault(normalize_pypi_name(new), []).append(normalize_pypi_name(old))
+        # statistics, [hits, misses] per thread, a lookup takes no lock
+        self.lock = Lock()
+        self.local = local()
+        self.counters = []
+        for pypi_id, value in (exceptions or {}).items():
+            self.pin(pypi_id, value)
+
+    def _keys(self, pypi_id):
+        # not memoized, every name is added once
+        key = _normalize(pypi_id)
+        return [key, *self.aliases.get(key, ())]
+
+    def pin(self, pypi_id, value):
+        for key in self._keys(pypi_id):
+            self.entries[key] = value
+            self.pinned.add(key)
+
+    def add(self, pypi_id, value):
+        """
+        add or replace an entry, unless it is pinned
+
+        Input:
+            pypi_id: String, PyPI project name, in any spelling
+            value: anything
+        """
+        for key in self._keys(pypi_id):
+            if key not in self.pinned:
+                self.entries[key] = value
+
+    def get(self, pypi_id, default=None):
+        """
+        Input:
+            pypi_id: String, PyPI project name, in any spelling
+
+        return: the value of the entry, or default if it is not found
+        """
+        value = self.entries.get(normalize_pypi_name(pypi_id), self)
+        counter = getattr(self.local, "counter", None)
+        if counter is None:
+            counter = self.local.counter = [0, 0]
+            with self.lock:
+                self.counters.append(counter)
+        if value is self:
+            counter[1] += 1
+            return default
+        counter[0] += 1
+        return value
+
+    def is_pinned(self, pypi_id):
+        return normalize_pypi_name(pypi_id) in self.pinned
+
+    def __contains__(self, pypi_id):
+        return normalize_pypi_name(pypi_id) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def items(self):
+        return self.entries.items()
+
+    @property
+    def hits(self):
+        return sum(counter[0] for counter in self.counters)
+
+    @property
+    def misses(self):
+        return sum(counter[1] for counter in self.counters)
+
+    def describe_stats(self):
+        """
+        return: String, a human readable summary of the lookups
+        """
+        lookups = self.hits + self.misses
+        return (f'Name index: {len(self.entries)} names, {self.hits} hits, {self.misses} misses '
+                f'({100 * self.hits / max(lookups, 1):.1f}% hit rate)')
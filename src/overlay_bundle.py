@@ -0,0 +1,192 @@
+"""
+This file collects the files of an overlay before they reach the disk
+
+Creating thousands of small files is slow on network filesystems, so instead
+of writing every file as it is generated, the files are either streamed into
+a single (compressed) tar archive, or kept as a tree in memory and flushed to
+the directory once. Both have the layout ebuild_writer.generate() writes.
+"""
+import os
+import time
+import tarfile
+import hashlib
+from io import BytesIO
+from pathlib import Path, PurePosixPath
+from logging import info
+
+from .overlay_files import write_if_changed, WriteStats
+
+# suffix => mode of tarfile, "|" streams the archive without seeking
+ARCHIVE_MODES = {
+    ".tar": "w|",
+    ".tar.gz": "w|gz",
+    ".tgz": "w|gz",
+    ".tar.bz2": "w|bz2",
+    ".tar.xz": "w|xz",
+}
+
+
+def archive_mode(path):
+    """
+    Input:
+        path: Path / String
+
+    return: String, the mode of tarfile for the archive, None if path is not an archive
+    """
+    name = str(path)
+    for suffix, mode in ARCHIVE_MODES.items():
+        if name.endswith(suffix):
+            return mode
+    return None
+
+
+class DirectoryOutput:
+    """
+    the files are written into the overlay directory as they come
+    """
+
+    def __init__(self, repo_dir):
+        self.repo_dir = Path(repo_dir)
+
+    def write(self, rel_path, content):
+        """
+        Input:
+            rel_path: Path / String, relative to the overlay
+            content: String
+
+        return: bool, whether the file was written
+        """
+        path = self.repo_dir / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return write_if_changed(path, content)
+
+    def exists(self, rel_path):
+        return (self.repo_dir / rel_path).exists()
+
+    def read(self, rel_path):
+        """
+        return: String, the content of a file of the overlay, None if it does not exist
+        """
+        try:
+            return (self.repo_dir / rel_path).read_text()
+        except FileNotFoundError:
+            return None
+
+
+class OverlayBundle:
+    """
+    relative path => content of the files of an overlay
+
+    An archive is written as the files come, only their digests are kept,
+    a directory gets all files at once in close().
+    """
+
+    def __init__(self, path, mtime=None):
+        """
+        Input:
+            path: Path / String, an archive (see ARCHIVE_MODES) or a directory
+            mtime: float, mtime of the members of an archive, the current time if None
+        """
+        self.path = Path(path)
+        self.mode = archive_mode(path)
+        self.mtime = int(time.time() if mtime is None else mtime)
+        # key: PurePosixPath relative to the overlay
+        # value: String, the content (directory), or bytes, its sha256 (archive)
+        self.files = {}
+        # directories already in the archive
+        self.dirs = set()
+        self.stats = WriteStats()
+        self.tar = None
+        if self.mode:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # renamed over the archive in close(), readers never see a partial one
+            self.tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+            self.fileobj = self.tmp_path.open('wb')
+            self.tar = tarfile.open(fileobj=self.fileobj, mode=self.mode, format=tarfile.PAX_FORMAT)
+
+    def write(self, rel_path, content):
+        """
+        Write Portage -
+        add a file to the bundle
+
+        Input:
+            rel_path: Path / String, relative to the overlay
+            content: String
+
+        return: bool, whether it was added, False if the bundle has the same file already
+        """
+        rel_path = PurePosixPath(rel_path)
+        if self.tar is None:
+            if self.files.get(rel_path) == content:
+                return False
+            self.files[rel_path] = content
+            return True
+        data = content.encode()
+        digest = hashlib.sha256(data).digest()
+        if self.files.get(rel_path) == digest:
+            return False
+        self.files[rel_path] = digest
+        for parent in reversed(rel_path.parents[:-1]):
+            if parent not in self.dirs:
+                self.dirs.add(parent)
+                self.tar.addfile(self._tarinfo(parent, tarfile.DIRTYPE, 0o755))
+        # a file added again is appended, and the last one wins when it is extracted
+        self.tar.addfile(self._tarinfo(rel_path, tarfile.REGTYPE, 0o644, len(data)), BytesIO(data))
+        self.stats.count(written=1)
+        return True
+
+    def _tarinfo(self, rel_path, member_type, mode, size=0):
+        tarinfo = tarfile.TarInfo(str(rel_path))
+        tarinfo.type = member_type
+        tarinfo.mode = mode
+        tarinfo.size = size
+        tarinfo.mtime = self.mtime
+        return tarinfo
+
+    def exists(self, rel_path):
+        """
+        whether the overlay will have a file, an archive starts empty,
+        a directory may have it already
+        """
+        rel_path = PurePosixPath(rel_path)
+        if rel_path in self.files:
+            return True
+        return self.tar is None and (self.path / rel_path).exists()
+
+    def read(self, rel_path):
+        """
+        return: String, the content of a file of the overlay, None if it does not exist,
+                or if it is in an archive, which keeps the digests only
+        """
+        rel_path = PurePosixPath(rel_path)
+        if self.tar is not None:
+            return None
+        if rel_path in self.files:
+            return self.files[rel_path]
+        try:
+            return (self.path / rel_path).read_text()
+        except FileNotFoundError:
+            return None
+
+    def close(self):
+        """
+        Write Portage -
+        finish the archive, or flush the tree into the directory
+
+        return: WriteStats, files written to and left unchanged in the directory, or the members of the archive
+        """
+        if self.tar is not None:
+            self.tar.close()
+            self.fileobj.close()
+            self.tar = None
+            os.replace(self.tmp_path, self.path)
+            info(f"Wrote {self.stats.written} files to {self.path}")
+            return self.stats
+        for rel_path in sorted(self.files):
+            path = self.path / rel_path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            written = write_if_changed(path, self.files[rel_path])
+            self.stats.count(written=written, unchanged=not written)
+        info(f"Flushed {len(self.files)} files to {self.path}")
+        self.files = {}
+        return self.stats
@@ -0,0 +1,86 @@
+"""
+This file writes the files of the overlay incrementally
+
+A rendered file is compared with the one on disk by its digest. Identical
+content is not written again, so the mtimes stay, and git status or the
+metadata regen of Portage do not see a change. Real changes are written to a
+temporary file and renamed over the old one, so readers never see a partial file.
+"""
+import os
+import hashlib
+from pathlib import Path
+from threading import Lock, get_ident
+
+from . import profiling
+
+
+def file_digest(path):
+    """
+    return: bytes, sha256 of a file, None if it does not exist
+    """
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+    except FileNotFoundError:
+        return None
+    return h.digest()
+
+
+def write_if_changed(path, content):
+    """
+    Write Portage -
+    write a file atomically, unless it already has the content
+
+    Input:
+        path: Path / String
+        content: String
+
+    return: bool, whether the file was written
+    """
+    path = Path(path)
+    data = content.encode()
+    try:
+        same_size = path.stat().st_size == len(data)
+    except FileNotFoundError:
+        same_size = False
+    if same_size and file_digest(path) == hashlib.sha256(data).digest():
+        profiling.count("files_unchanged")
+        return False
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{get_ident()}.tmp")
+    try:
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    profiling.count("files_written")
+    profiling.count("bytes_written", len(data))
+    return True
+
+
+class WriteStats:
+    """
+    written: files with new content
+    unchanged: files which already had the content
+    skipped: packages whose Manifest step was skipped, as none of their files changed
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.written = 0
+        self.unchanged = 0
+        self.skipped = 0
+
+    def count(self, written=0, unchanged=0, skipped=0):
+        with self.lock:
+            self.written += written
+            self.unchanged += unchanged
+            self.skipped += skipped
+
+    def describe_stats(self):
+        """
+        return: String, a human readable summary of the writes
+        """
+        return (f'Overlay: {self.written} files written, {self.unchanged} unchanged, '
+                f'{self.skipped} Manifest steps skipped')
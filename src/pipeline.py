@@ -0,0 +1,300 @@
+"""
+This file generates an overlay as a pipeline: fetch -> parse -> render -> write
+
+Every stage has its own workers, and the stages are connected by bounded
+queues, so a stage running ahead blocks until the next one catches up. A
+package is written as soon as it is resolved, and dropped afterwards: the
+memory does not grow with the number of packages, only the names seen so far
+are kept, and an interrupted run leaves the packages written so far behind.
+The missing dependencies found by parse go back to fetch, through a queue of
+names, which is not bounded so the stages can not wait for each other in a cycle.
+
+usage: python -m src.pipeline -r REPO -t TARGET PACKAGE...
+"""
+import time
+import queue
+import argparse
+import resource
+from pathlib import Path
+from threading import Thread, Lock
+from logging import info, warn
+
+from .pypi_parser import PYPIParser, PYPICommunicator
+from .name_index import normalize_pypi_name
+from .pypi_fetch import PyPIFetcher
+from .pypi_mirror import open_source
+from .http_cache import HTTPCache
+from .overlay_bundle import DirectoryOutput, OverlayBundle, archive_mode
+from . import ebuild_writer
+from . import profiling
+
+# tells the workers of a stage that nothing more will come
+_DONE = object()
+
+
+class _Stage:
+    """
+    the workers of a stage, and how long they worked and waited for the next stage
+    """
+
+    def __init__(self, name, workers, work, outbox=None):
+        """
+        Input:
+            name: String
+            workers: int
+            work: callable(item) -> the item for the next stage, or None if the package is done
+            outbox: queue.Queue, the inbox of the next stage, None for the last stage
+        """
+        self.name = name
+        self.workers = workers
+        self.work = work
+        self.outbox = outbox
+        self.inbox = None
+        self.next = None
+        self.threads = []
+        self.lock = Lock()
+        self.running = 0
+        # statistics
+        self.items = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+
+
+class Pipeline:
+
+    def __init__(self, output, fetcher=None, recursive=True, fetch_workers=8, parse_workers=1,
+                 render_workers=2, queue_size=16):
+        """
+        Input:
+            output: DirectoryOutput / OverlayBundle, where the files go
+            fetcher: PyPIFetcher, PYPICommunicator.get_fetcher() if None
+            recursive: bool, generate the missing dependencies as well
+            fetch_workers: int, threads fetching, at most the workers of fetcher run at once
+            parse_workers: int, threads translating the json metadata
+            render_workers: int, threads rendering the ebuilds
+            queue_size: int, packages waiting between two stages, bounds the memory
+        """
+        self.output = output
+        self.fetcher = fetcher or PYPICommunicator.get_fetcher()
+        self.recursive = recursive
+        self.communicator = PYPICommunicator()
+        self.lock = Lock()
+        # normalized names of the packages submitted so far
+        self.visited = set()
+        # packages submitted and not finished yet
+        self.pending = 0
+        # key: package
+        # value: String, the error
+        self.failed = {}
+        self.written = 0
+        self.unchanged = 0
+        self.existing = 0
+        # the names to fetch are not bounded, the documents in flight are
+        self.todo = queue.Queue()
+        fetched = queue.Queue(queue_size)
+        parsed = queue.Queue(queue_size)
+        rendered = queue.Queue(queue_size)
+        self.stages = [
+            _Stage("fetch", fetch_workers, self._fetch, fetched),
+            _Stage("parse", parse_workers, self._parse, parsed),
+            _Stage("render", render_workers, self._render, rendered),
+            _Stage("write", 1, self._write),
+        ]
+        for stage, inbox in zip(self.stages, (self.todo, fetched, parsed, rendered)):
+            stage.inbox = inbox
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next = next_stage
+        self.started = None
+        self.seconds = 0.0
+
+    def submit(self, package):
+        """
+        queue a package, unless it was queued already
+
+        Input:
+            package: ToString, project name
+
+        return: bool, whether it was queued
+        """
+        key = normalize_pypi_name(package)
+        with self.lock:
+            if key in self.visited:
+                return False
+            self.visited.add(key)
+            self.pending += 1
+        self.todo.put(package)
+        return True
+
+    def _finish(self, package, error=None):
+        """
+        a package left the pipeline, the pipeline is closed once the last one does
+        """
+        with self.lock:
+            if error is not None:
+                self.failed[package] = error
+            self.pending -= 1
+            done = self.pending == 0
+        if done:
+            for _ in range(self.stages[0].workers):
+                self.todo.put(_DONE)
+
+    def run(self, packages):
+        """
+        Write Portage -
+        generate packages, and their missing dependencies if recursive
+
+        Input:
+            packages: iterable of ToString, project names
+
+        return: dict of {package: error} of the failed packages
+        """
+        self.started = time.perf_counter()
+        # held while submitting, so the packages finishing meanwhile do not close the pipeline
+        with self.lock:
+            self.pending += 1
+        for stage in self.stages:
+            for i in range(stage.workers):
+                thread = Thread(target=self._worker, args=(stage,), name=f"pipeline-{stage.name}-{i}", daemon=True)
+                stage.threads.append(thread)
+                stage.running += 1
+                thread.start()
+        for package in packages:
+            self.submit(package)
+        self._finish(None)
+        for stage in self.stages:
+            for thread in stage.threads:
+                thread.join()
+        self.seconds = time.perf_counter() - self.started
+        return self.failed
+
+    def _worker(self, stage):
+        while True:
+            item = stage.inbox.get()
+            if item is _DONE:
+                break
+            package = item[0] if isinstance(item, tuple) else item
+            start = time.perf_counter()
+            try:
+                result = stage.work(item)
+            except Exception as e:
+                warn(f"Failed to generate {package}: {type(e).__name__}: {e}")
+                self._finish(package, f"{type(e).__name__}: {e}")
+                result = None
+            busy = time.perf_counter() - start
+            blocked = 0.0
+            if result is not None:
+                start = time.perf_counter()
+                # blocks while the next stage is behind
+                stage.outbox.put(result)
+                blocked = time.perf_counter() - start
+            with stage.lock:
+                stage.items += 1
+                stage.busy += busy
+                stage.blocked += blocked
+        with stage.lock:
+            stage.running -= 1
+            last = stage.running == 0
+        if last and stage.next is not None:
+            for _ in range(stage.next.workers):
+                stage.next.inbox.put(_DONE)
+
+    def _fetch(self, package):
+        with profiling.stage("fetch"):
+            return package, self.fetcher.fetch(package)
+
+    def _parse(self, item):
+        package, body = item
+        pypi_id, deps, pkgmeta = self.communicator.translate(package, body)
+        if pkgmeta is None:
+            with self.lock:
+                self.existing += 1
+            self._finish(package)
+            return None
+        pkgmeta.parse_deps(deps, fetch_missing=False)
+        if self.recursive:
+            # as PkgMetadata.parse_deps(), only the unconditional deps are followed
+            for dep_pypi_id, _ in deps["_default"]:
+                if not PYPIParser.catepn(dep_pypi_id)[2]:
+                    self.submit(dep_pypi_id)
+        return package, pypi_id, pkgmeta
+
+    def _render(self, item):
+        package, pypi_id, pkgmeta = item
+        with profiling.stage("render"):
+            return package, ebuild_writer.render(pypi_id, pkgmeta)
+
+    def _write(self, item):
+        package, files = item
+        with profiling.stage("write"):
+            written, unchanged = ebuild_writer.write_files(self.output, files)
+        with self.lock:
+            self.written += written
+            self.unchanged += unchanged
+        info(f'Wrote {package}')
+        self._finish(package)
+        return None
+
+    def describe_stats(self):
+        """
+        return: String, a human readable summary of the run
+        """
+        packages = len(self.visited) - len(self.failed) - self.existing
+        res = (f'Pipeline: {packages} packages generated, {self.existing} existing, {len(self.failed)} failed '
+               f'in {self.seconds:.2f}s, {self.written} files written, {self.unchanged} unchanged, '
+               f'peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB')
+        for stage in self.stages:
+            res += (f'\n  {stage.name:>6}: {stage.items} items, {stage.workers} workers, '
+                    f'{stage.busy:.2f}s working, {stage.blocked:.2f}s waiting for the next stage')
+        return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description='generate the ebuilds of PyPI projects as a pipeline, '
+                                                 'each one is written as soon as it is resolved')
+    parser.add_argument('-r', '--repos', action='append', default=[],
+        help='existing Portage repositories, do not specify it if you want it to find all repositories automatically')
+    parser.add_argument('-t', '--target', required=True,
+        help='target repo directory, or an archive (.tar, .tar.gz, .tgz, .tar.bz2, .tar.xz) the overlay is streamed into')
+    parser.add_argument('-R', '--recursive', action='store_true', help='generate the missing dependencies as well')
+    parser.add_argument('--fetch-jobs', type=int, default=8, help='the number of threads fetching')
+    parser.add_argument('--parse-jobs', type=int, default=1, help='the number of threads translating the metadata')
+    parser.add_argument('--render-jobs', type=int, default=2, help='the number of threads rendering ebuilds')
+    parser.add_argument('--queue-size', type=int, default=16, help='packages waiting between two stages')
+    parser.add_argument('--mirror', help='read PyPI metadata from a local directory, SQLite dump or JSONL dump instead of the network')
+    profiling.add_arguments(parser)
+    parser.add_argument('packages', nargs='+')
+    args = parser.parse_args()
+    profiling.start(args)
+
+    from . import portage_parser
+    if len(args.repos) == 0:
+        import portage
+        eroot = next(iter(portage.db.keys()))
+        repositories = portage.db[eroot]["vartree"].settings.repositories
+        repos = [repositories.treemap.get(name) for name in repositories.prepos_order]
+    else:
+        repos = args.repos
+    portage_parser.find_packages(repos)
+
+    if args.mirror:
+        fetcher = PyPIFetcher(args.fetch_jobs, source=open_source(args.mirror))
+    else:
+        fetcher = PyPIFetcher(args.fetch_jobs, upstream_template=PYPICommunicator.upstream_template,
+                              cache=HTTPCache())
+    # an archive is written as it goes, a directory gets every file as soon as it is rendered
+    output = OverlayBundle(args.target) if archive_mode(args.target) else DirectoryOutput(Path(args.target))
+    pipeline = Pipeline(output, fetcher, args.recursive, args.fetch_jobs, args.parse_jobs,
+                        args.render_jobs, args.queue_size)
+    failed = pipeline.run(args.packages)
+    if isinstance(output, OverlayBundle):
+        print(output.close().describe_stats())
+    fetcher.close()
+    print(pipeline.describe_stats())
+    print(fetcher.describe_stats())
+    for package, error in failed.items():
+        print(f'FAILED {package}: {error}')
+    profiling.finish(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,66 @@
-import re
-import glob
-import portage
+from functools import cmp_to_key
 from logging import info, warn
 from .pypi_parser import PYPIParser
-from .metadata_repr import PkgMetadata
+from .metadata_repr import PortagePackage
+from .repo_index import RepoIndex, md5_cache_versions, ebuild_versions, vercmp
 
-# TODO: this dependency can be replaced by `xml`
-import xmltodict
-
-p = portage.db[portage.root]["porttree"].dbapi
-
-def upstream_has_pypi(metadata_dict):
+def highest_versions(repo, cate_pns):
     """
     Parse Portage -
-    whether a package exists in PyPI
+    the highest versions of the packages of a repository, read from its md5-cache at once,
+    the names of the ebuilds are read for packages that the md5-cache does not have,
+    so Portage is not needed
 
     Input:
-        metadata_dict: dict, parsed metadata.xml
+        repo: ToString, the location of a repository
+        cate_pns: list of "cate/pn"
 
-    return: PyPI project name or False
+    return: dict of {"cate/pn": ${PVR}}, '0' for packages without an ebuild
     """
-    try:
-        upstream = metadata_dict['pkgmetadata']['upstream']['remote-id']
-    except:
-        return False
-    if isinstance(upstream, list):
-        for u in upstream:
-            if u['@type'] == 'pypi':
-                return u['#text']
-    else:
-        if upstream['@type'] == 'pypi':
-            return upstream['#text']
-    return False
+    cached = md5_cache_versions(repo, cate_pns)
+    if cached is None:
+        info(f"{repo} has no md5-cache, reading the ebuilds of {len(cate_pns)} packages")
+        cached = {}
+    missing = [cate_pn for cate_pn in cate_pns if not cached.get(cate_pn)]
+    cached.update(ebuild_versions(repo, missing))
+    by_version = cmp_to_key(vercmp)
+    res = {}
+    for cate_pn in cate_pns:
+        versions = cached.get(cate_pn)
+        if versions:
+            res[cate_pn] = max(versions, key=by_version)
+        else:
+            warn(f"{cate_pn} has no ebuild in {repo}")
+            res[cate_pn] = '0'
+    info(f"Resolved the versions of {len(cate_pns)} packages in {repo}, "
+         f"{len(cate_pns) - len(missing)} from the md5-cache")
+    return res
 
 # reimplement find_package() by checking the metadata.xml of a pkg
-def find_packages(repo):
+def find_packages(repos, index=None, jobs=None):
     """
     Parse Portage -
-    parse metadata of all pkgs from a Portage repository,
-    add existing pkgs to self.existing_packages
+    parse metadata of all pkgs from Portage repositories,
+    add existing pkgs to PYPIParser.PN_database
 
     Input:
-        repo: ToString, the location of a repository
+        repos: list of ToString, the locations of the repositories, in prepos_order
+        index: RepoIndex, the on-disk index to refresh,
+               the default one is loaded and saved if None
+        jobs: int, the number of processes parsing metadata.xml
 
     return: None
     """
-    #len_old = len(self.existing_packages)
-    cate_pkg_match = re.compile(f"{repo}/(.*)/(.+)/metadata.xml")
+    own_index = index is None
+    if own_index:
+        index = RepoIndex()
+    index.refresh(repos, version_lookup=highest_versions, jobs=jobs)
 
-    pkg_cnt = 0
-    for pkg_metadata in glob.glob(f'{repo}/**/metadata.xml', recursive=True):
-        match = cate_pkg_match.match(pkg_metadata)
-        if match:
-            metadata_dict = xmltodict.parse(open(pkg_metadata).read())
-            pypi_id = upstream_has_pypi(metadata_dict)
-            if pypi_id:
-                try:
-                    pkg_highest_match = p.xmatch("match-all", (f"{match.group(1)}/{match.group(2)}"))[-1]
-                    pkg_highest_ver = portage.catpkgsplit(pkg_highest_match)[-1]
-                except:
-                    warn(f"{match.group(1)}/{match.group(2)} not found")
-                    pkg_highest_ver = '0'
-                ## update the static member...
-                PYPIParser.PN_database[pypi_id] = PkgMetadata(pypi_id,
-                                                              match.group(1), match.group(2),
-                                                              portage_version=pkg_highest_ver)
-                pkg_cnt += 1
+    # later repos take priority
+    for pypi_id, (cate, pn, version) in index.merged(repos).items():
+        ## update the static member...
+        PYPIParser.PN_database.add(pypi_id, PortagePackage(cate, pn, version))
 
-    info(f'Found {pkg_cnt} packages in {repo}')
+    if own_index:
+        index.save()
+    info(f'Found {len(PYPIParser.PN_database)} packages in {len(repos)} repos')
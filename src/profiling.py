@@ -0,0 +1,269 @@
+"""
+This file measures where the time of a run goes
+
+Stages (e.g. scan, fetch, parse, render, write) record their calls, wall time
+and CPU time, histograms record the latency of single packages and requests,
+and counters record events such as fetches, cache hits, regex parses and bytes
+written. The profile of a run is dumped as json or in the Prometheus text
+format, and one selected stage can be captured by cProfile.
+
+All modules report into PROFILER, through stage(), observe() and count().
+"""
+import io
+import json
+import time
+import bisect
+import resource
+from contextlib import contextmanager
+from threading import Lock
+
+# upper bounds of the latency buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+# prefix of the Prometheus metrics
+METRIC_PREFIX = "pypi_ebuilder"
+
+STAGES = ("scan", "versions", "fetch", "parse", "render", "write", "download", "manifest")
+
+
+def _cpu_time():
+    # worker processes count once they are reaped, i.e. when their pool is shut down
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        # counts[i]: observations in (BUCKETS[i - 1], BUCKETS[i]]
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def cumulative(self):
+        """
+        return: list of (upper bound, observations not above it), as Prometheus buckets are
+        """
+        res = []
+        total = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            total += n
+            res.append((bound, total))
+        return res
+
+
+class Profiler:
+    """
+    stage name => [calls, wall seconds, CPU seconds]
+    histogram name => Histogram
+    counter name => int
+
+    The CPU time of a stage is the one of the whole process, so stages running
+    at the same time, e.g. in the threads of a server, are counted by each of them.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.stages = {}
+        self.histograms = {}
+        self.counters = {}
+        # cProfile of a single stage
+        self.cprofile_stage = None
+        self.cprofile = None
+        self.cprofile_active = False
+
+    def capture(self, stage):
+        """
+        capture every call of a stage by cProfile, in the thread running it,
+        so the stages working in thread pools (fetch, download) show the waiting only
+
+        Input:
+            stage: String, one of STAGES
+        """
+        import cProfile
+        self.cprofile_stage = stage
+        self.cprofile = cProfile.Profile()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        time a stage
+
+        Input:
+            name: String
+        """
+        profile = None
+        if name == self.cprofile_stage:
+            with self.lock:
+                # a profiler can not be enabled twice, nested or concurrent calls are left out
+                if not self.cprofile_active:
+                    self.cprofile_active = True
+                    profile = self.cprofile
+        start_cpu = _cpu_time()
+        start = time.perf_counter()
+        if profile:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+            wall = time.perf_counter() - start
+            cpu = _cpu_time() - start_cpu
+            with self.lock:
+                if profile:
+                    self.cprofile_active = False
+                entry = self.stages.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += wall
+                entry[2] += cpu
+
+    def observe(self, name, seconds):
+        """
+        add a latency to a histogram
+
+        Input:
+            name: String, e.g. "generate" for the latency of generating one package
+            seconds: float
+        """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, n=1):
+        """
+        Input:
+            name: String, e.g. "bytes_written"
+            n: int
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_json(self):
+        """
+        return: dict, see dump()
+        """
+        with self.lock:
+            return {
+                "stages": {name: {"calls": calls, "wall_seconds": wall, "cpu_seconds": cpu}
+                           for name, (calls, wall, cpu) in self.stages.items()},
+                "histograms": {name: {"buckets": {str(bound): n for bound, n in histogram.cumulative()},
+                                      "sum": histogram.sum, "count": histogram.count}
+                               for name, histogram in self.histograms.items()},
+                "counters": dict(self.counters),
+            }
+
+    def to_prometheus(self):
+        """
+        return: String, the profile in the Prometheus text exposition format
+        """
+        profile = self.to_json()
+        lines = []
+        for metric, key, description in (("stage_calls_total", "calls", "times a stage ran"),
+                                  ("stage_wall_seconds_total", "wall_seconds", "wall time spent in a stage"),
+                                  ("stage_cpu_seconds_total", "cpu_seconds", "CPU time of the process during a stage")):
+            lines.append(f"# HELP {METRIC_PREFIX}_{metric} {description}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{metric} counter")
+            for name, stage in sorted(profile["stages"].items()):
+                lines.append(f'{METRIC_PREFIX}_{metric}{{stage="{name}"}} {stage[key]}')
+        for name, histogram in sorted(profile["histograms"].items()):
+            metric = f"{METRIC_PREFIX}_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for bound, n in histogram["buckets"].items():
+                le = "+Inf" if bound == "inf" else bound
+                lines.append(f'{metric}_bucket{{le="{le}"}} {n}')
+            lines.append(f"{metric}_sum {histogram['sum']}")
+            lines.append(f"{metric}_count {histogram['count']}")
+        for name, n in sorted(profile["counters"].items()):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name}_total counter")
+            lines.append(f"{METRIC_PREFIX}_{name}_total {n}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path, output_format=None):
+        """
+        write the profile
+
+        Input:
+            path: String, "-" for stdout
+            output_format: String, "json" or "prometheus", chosen by the suffix of path if None (.prom / .txt)
+        """
+        if output_format is None:
+            output_format = "prometheus" if path.endswith((".prom", ".txt")) else "json"
+        text = self.to_prometheus() if output_format == "prometheus" else json.dumps(self.to_json(), indent=2) + "\n"
+        if path == "-":
+            print(text, end="")
+        else:
+            with open(path, 'w') as f:
+                f.write(text)
+
+    def dump_cprofile(self, path, limit=20):
+        """
+        write the cProfile capture as pstats, and return its hottest functions
+
+        Input:
+            path: String
+            limit: int, the number of functions
+
+        return: String, or None if nothing was captured
+        """
+        if self.cprofile is None or self.cprofile_stage not in self.stages:
+            return None
+        # it takes longer to import than most runs take to start
+        import pstats
+        self.cprofile.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(self.cprofile, stream=out).sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+
+PROFILER = Profiler()
+stage = PROFILER.stage
+observe = PROFILER.observe
+count = PROFILER.count
+
+
+def add_arguments(parser):
+    """
+    the profiling options of a command line
+
+    Input:
+        parser: argparse.ArgumentParser
+    """
+    parser.add_argument('--profile', metavar='FILE',
+        help='write the per-stage timings, latency histograms and counters to FILE ("-" for stdout), '
+             'as Prometheus text if it ends with .prom or .txt, as json otherwise')
+    parser.add_argument('--profile-format', choices=['json', 'prometheus'], help='the format of --profile')
+    parser.add_argument('--cprofile', metavar='STAGE', choices=STAGES, help='capture a stage by cProfile')
+    parser.add_argument('--cprofile-output', metavar='FILE', help='where the pstats of --cprofile go, default: STAGE.pstats')
+
+
+def start(args):
+    """
+    prepare the profiling asked for on the command line
+    """
+    if args.cprofile:
+        PROFILER.capture(args.cprofile)
+
+
+def finish(args):
+    """
+    write the profiling asked for on the command line
+    """
+    if args.profile:
+        PROFILER.dump(args.profile, args.profile_format)
+    if args.cprofile:
+        path = args.cprofile_output or f"{args.cprofile}.pstats"
+        summary = PROFILER.dump_cprofile(path)
+        if summary is None:
+            print(f"The stage {args.cprofile} did not run, nothing was captured")
+        else:
+            print(f"cProfile of the stage {args.cprofile} written to {path}")
+            print(summary)
@@ -0,0 +1,400 @@
+"""
+This file fetches the json metadata of PyPI projects
+
+All requests share one connection pool, and packages known to be needed at
+the same time are fetched concurrently by a bounded number of workers. The
+requests go through a RequestScheduler, which backs off while the server
+throttles them.
+"""
+import json
+import time
+import resource
+from collections import OrderedDict
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from logging import info, warn
+
+from .pypi_mirror import NOT_FOUND
+from .name_index import normalize_pypi_name
+from .json_extract import extract_project, INFO_FIELDS
+from .rate_limit import RequestScheduler
+from . import profiling
+
+# bytes read from the network at once in the streaming mode
+CHUNK_SIZE = 65536
+
+# PEP 691
+SIMPLE_JSON = "application/vnd.pypi.simple.v1+json"
+
+
+def _file_version(filename, name=None):
+    """
+    the version in the name of a sdist or a wheel
+
+    Input:
+        filename: String
+        name: String, the project name, a sdist whose name does not start with it has no version
+
+    return: String, or None if the version can not be told
+    """
+    if filename.endswith(".whl"):
+        return filename.split("-")[1]
+    for ext in (".tar.gz", ".tar.bz2", ".tar.xz", ".zip", ".tgz"):
+        if filename.endswith(ext):
+            stem = filename[:-len(ext)]
+            if name is None:
+                return stem.rsplit("-", 1)[-1]
+            # the name may have "-" in it, and so may a legacy version
+            for i, c in enumerate(stem):
+                if c == "-" and normalize_pypi_name(stem[:i]) == normalize_pypi_name(name):
+                    return stem[i + 1:]
+            return None
+    return None
+
+
+def latest_version(simple):
+    """
+    Parse PyPI -
+    choose the version PyPI presents as the current one from a PEP 691 project page,
+    as PyPI does: the highest version, preferring final releases over pre-releases
+    and unyanked over yanked ones
+
+    the versions come from the "versions" of PEP 700, the files only tell which are yanked,
+    whenever the page does not decide it the way PyPI does, None is returned,
+    and the full document has to be fetched, so the lean mode never generates something else
+
+    Input:
+        simple: dict, the json of a PEP 691 project page
+
+    return: String, the version as PyPI spells it, or None if it can not be decided
+    """
+    from packaging.version import Version, InvalidVersion
+    if "files" not in simple or not simple.get("versions"):
+        # before PEP 700, releases without files are unknown, and one of them may be the current one
+        return None
+    try:
+        parsed = {Version(version): version for version in simple["versions"]}
+    except InvalidVersion:
+        # PyPI orders legacy versions in its own way
+        return None
+    # key: Version
+    # value: whether all its files are yanked
+    yanked = {}
+    for f in simple["files"]:
+        try:
+            version = Version(_file_version(f["filename"], simple.get("name")) or "")
+        except InvalidVersion:
+            return None
+        if version not in parsed:
+            # a file which can not be told apart, e.g. a name with a "-" in the version
+            return None
+        yanked[version] = yanked.get(version, True) and bool(f.get("yanked"))
+    # a release without files may be yanked as well, it can not be told
+    latest = max(parsed, key=lambda version: (not yanked.get(version, False), not version.is_prerelease, version))
+    if latest not in yanked:
+        return None
+    return parsed[latest]
+
+
+class FetchError(Exception):
+    pass
+
+
+class PyPIFetcher:
+
+    upstream_template = "https://pypi.org/pypi/{}/json"
+
+    # used by the lean mode, and only if upstream_template points to a PyPI-like server
+    simple_template = "https://pypi.org/simple/{}/"
+    version_template = "https://pypi.org/pypi/{}/{}/json"
+
+    def __init__(self, workers=8, timeout=30, upstream_template=None, cache=None, memo_size=0, source=None,
+                 lean=False, stream=False, stream_fields=INFO_FIELDS, scheduler=None):
+        """
+        Input:
+            workers: int, the maximum number of concurrent requests
+            timeout: float, seconds to wait for the server
+            upstream_template: String, uri of the json metadata, "{}" is replaced by the project name
+            cache: HTTPCache, on-disk cache of the responses, nothing is cached if None
+            memo_size: int, the number of parsed responses kept in memory within the TTL of the cache,
+                       for long-running processes, it requires a cache
+            source: DirectorySource / SQLiteSource, local copy of PyPI metadata,
+                    the network is never used if it is provided
+            lean: bool, only download the metadata of the latest release, see fetch_lean()
+            stream: bool, extract the needed fields of project documents while they are streamed,
+                    instead of loading them as a whole, see json_extract.extract_project()
+            stream_fields: iterable of String, the fields of "info" kept in the streaming mode
+            scheduler: RequestScheduler, the limits and the retries of the requests,
+                       at most workers concurrent requests per host with the default retries if None
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.source = source
+        # a local source needs no cache
+        cache = None if source else cache
+        self.cache = cache
+        # key: url
+        # value: (time of fetching, parsed body), least recently used first
+        self.memo = OrderedDict()
+        self.memo_size = memo_size if cache else 0
+        if upstream_template:
+            self.upstream_template = upstream_template
+        self.lean = lean
+        self.stream = stream
+        self.stream_fields = stream_fields
+        if lean:
+            if self.upstream_template.endswith("/pypi/{}/json"):
+                base = self.upstream_template[:-len("/pypi/{}/json")]
+                self.simple_template = base + "/simple/{}/"
+                self.version_template = base + "/pypi/{}/{}/json"
+            else:
+                warn(f"{self.upstream_template} is not a PyPI-like server, the lean mode is disabled")
+                self.lean = False
+        # requests takes a while to import, a local source does not need it
+        self.session = None if source else self._session(workers)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="pypi-fetch")
+        self.scheduler = scheduler or RequestScheduler(max_concurrency=workers)
+        # statistics
+        self.lock = Lock()
+        # calls of fetch()
+        self.packages = 0
+        # all requests, the summed-up latency of them, and the bytes received
+        self.fetched = 0
+        self.seconds = 0.0
+        self.received = 0
+        # the largest buffer of the streaming parser, in characters
+        self.peak_buffer = 0
+        # requests issued by fetch_many(), and the wall time spent in it
+        self.batch_fetched = 0
+        self.batch_seconds = 0.0
+
+    @staticmethod
+    def _session(workers):
+        """
+        return: requests.Session, with one pooled connection per worker
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def fetch(self, package):
+        """
+        Fetch PyPI -
+        get the json metadata of a project
+
+        Input:
+            package: ToString, project name
+
+        return: dict, the json metadata provided by PyPI
+
+        raise: FetchError, the project does not exist, or the server did not answer with its metadata
+        """
+        with self.lock:
+            self.packages += 1
+        if self.source:
+            start = time.perf_counter()
+            content = self.source.get(package)
+            with self.lock:
+                self.fetched += 1
+                self.seconds += time.perf_counter() - start
+            body = self._decode([content if content is not None else NOT_FOUND], self.stream, package)
+        else:
+            body = self.fetch_lean(package) if self.lean else None
+            if body is None:
+                body = self.get_json(self.upstream_template.format(package), stream=True)
+        if "info" not in body:
+            raise FetchError(f"no metadata of {package}: {body.get('message', 'unexpected document')}")
+        return body
+
+    def fetch_lean(self, package):
+        """
+        Fetch PyPI -
+        get the json metadata of the latest release only:
+        find the version in the PEP 691 simple index, then ask the version-specific endpoint,
+        its "urls" (the files of the release) are put in "releases" as the full document has them
+
+        Input:
+            package: ToString, project name
+
+        return: dict, the json metadata, or None if the lean way does not work for the project
+        """
+        simple = self.get_json(self.simple_template.format(normalize_pypi_name(package)),
+                               accept=SIMPLE_JSON)
+        version = latest_version(simple)
+        if version is None:
+            return None
+        body = self.get_json(self.version_template.format(package, version), stream=True)
+        if "info" not in body:
+            return None
+        body = dict(body)
+        body["releases"] = {version: body["urls"]}
+        return body
+
+    def get_json(self, url, accept=None, stream=False):
+        """
+        Fetch PyPI -
+        get a json document, through the memo and the cache if there are
+
+        Input:
+            url: String
+            accept: String, the Accept header
+            stream: bool, the url is a project document, extract it while it is streamed
+                    if the fetcher is in the streaming mode
+
+        return: dict, {"message": "Not Found"} if the server has no such document
+
+        raise: FetchError, the server kept failing, or did not answer with json
+        """
+        stream = stream and self.stream
+        if self.memo_size:
+            with self.lock:
+                memo = self.memo.get(url)
+                if memo:
+                    self.memo.move_to_end(url)
+            if memo and time.time() - memo[0] < self.cache.ttl:
+                self.cache.count(hits=1)
+                return memo[1]
+
+        cached = self.cache.lookup(url) if self.cache else None
+        if cached and self.cache.is_fresh(cached):
+            self.cache.count(hits=1)
+            body = self._decode(self.cache.iter_chunks(cached), stream, url)
+            return self._remember(url, cached.fetched, body)
+
+        start = time.perf_counter()
+        headers = {}
+        if accept:
+            headers['Accept'] = accept
+        if cached and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached and cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+        # requests asks for gzip-compressed bodies by default
+        resp = self.scheduler.send(
+            url, lambda: self.session.get(url, headers=headers, timeout=self.timeout, stream=stream))
+        if cached and resp.status_code == 304:
+            self.cache.refresh(url, cached)
+            self.cache.count(revalidated=1)
+            body = self._decode(self.cache.iter_chunks(cached), stream, url)
+        elif resp.status_code == 404:
+            # the body may be a page of html, e.g. from the simple index
+            resp.close()
+            body = json.loads(NOT_FOUND)
+        elif resp.status_code != 200:
+            resp.close()
+            raise FetchError(f"{url}: HTTP {resp.status_code} {resp.reason}")
+        else:
+            chunks = resp.iter_content(CHUNK_SIZE) if stream else [resp.content]
+            if self.cache:
+                self.cache.count(misses=1)
+                chunks = self.cache.store_stream(url, chunks,
+                                                 resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
+            chunks = iter(chunks)
+            body = self._decode(chunks, stream, url)
+            # drain it, so the cache gets the whole body
+            for _ in chunks:
+                pass
+        elapsed = time.perf_counter() - start
+        # the bytes on the wire, i.e. before decompression
+        received = resp.raw.tell() or (0 if stream else len(resp.content))
+        with self.lock:
+            self.fetched += 1
+            self.seconds += elapsed
+            self.received += received
+        profiling.observe("pypi_request", elapsed)
+        profiling.count("pypi_requests")
+        profiling.count("pypi_bytes_received", received)
+        if resp.status_code in (200, 304):
+            self._remember(url, time.time(), body)
+        return body
+
+    def _decode(self, chunks, stream, origin):
+        """
+        Input:
+            chunks: iterator of bytes, a json document
+            stream: bool, extract the needed fields of a project document only
+            origin: String, where the document comes from, for the errors
+
+        return: dict
+        """
+        try:
+            if not stream:
+                return json.loads(b''.join(chunks))
+            body, peak = extract_project(chunks, self.stream_fields)
+        except ValueError as e:
+            raise FetchError(f"{origin} is not a json document: {e}") from e
+        with self.lock:
+            self.peak_buffer = max(self.peak_buffer, peak)
+        return body
+
+    def _remember(self, url, fetched, body):
+        """
+        keep a parsed body in memory, as long as the cache would consider it fresh
+        """
+        if self.memo_size:
+            with self.lock:
+                self.memo[url] = (fetched, body)
+                self.memo.move_to_end(url)
+                while len(self.memo) > self.memo_size:
+                    self.memo.popitem(last=False)
+        return body
+
+    def _fetch_or_error(self, package):
+        try:
+            return self.fetch(package)
+        except Exception as e:
+            return e
+
+    def fetch_many(self, packages, return_exceptions=False):
+        """
+        Fetch PyPI -
+        get the json metadata of several projects concurrently
+
+        Input:
+            packages: iterable of ToString, project names
+            return_exceptions: bool, put the exception of a failed request in the result instead of raising it
+
+        return: dict of {package: json metadata or Exception}
+        """
+        packages = list(dict.fromkeys(packages))
+        if len(packages) == 0:
+            return {}
+        start = time.perf_counter()
+        fetch = self._fetch_or_error if return_exceptions else self.fetch
+        bodies = dict(zip(packages, self.executor.map(fetch, packages)))
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.batch_fetched += len(packages)
+            self.batch_seconds += elapsed
+        info(f'Fetched {len(packages)} packages in {elapsed:.2f}s '
+             f'({len(packages) / max(elapsed, 1e-9):.1f} packages/s)')
+        return bodies
+
+    def describe_stats(self):
+        """
+        return: String, a human readable summary of the requests made so far
+        """
+        upstream = self.source.__class__.__name__ if self.source else 'PyPI'
+        res = (f'Made {self.fetched} requests to {upstream} with {self.workers} workers, '
+               f'{self.seconds / max(self.fetched, 1):.2f}s latency on average, '
+               f'{self.batch_fetched / max(self.batch_seconds, 1e-9):.1f} packages/s in parallel batches, '
+               f'{self.received / 1024 / max(self.packages, 1):.1f} KiB downloaded per package')
+        if self.stream:
+            res += f'\nStreaming parser: {self.peak_buffer / 1024:.0f} KiB largest buffer'
+        res += f'\nPeak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB'
+        if not self.source:
+            res += '\n' + self.scheduler.describe_stats()
+        if self.cache:
+            res += '\n' + self.cache.describe_stats()
+        return res
+
+    def close(self):
+        self.executor.shutdown()
+        if self.session:
+            self.session.close()
+        if self.cache:
+            self.cache.evict()
@@ -0,0 +1,191 @@
+"""
+This file serves the json metadata of PyPI projects from local copies, without network
+
+Supported sources:
+    a directory tree: <root>/<name>.json, <root>/<name> or <root>/<name>/json,
+                      e.g. the json/ or pypi/ directory of a bandersnatch mirror
+    a SQLite dump: table projects(name TEXT PRIMARY KEY, body BLOB), keyed by the normalized name
+    a JSONL dump: one project json per line, imported into a SQLite dump next to it on first use
+
+usage: python -m src.pypi_mirror import DUMP.jsonl[.gz] OUT.sqlite
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+import threading
+from pathlib import Path
+from itertools import islice
+from logging import info
+
+from .name_index import normalize_pypi_name
+
+# body of a project which is not in the source, as PyPI answers it
+NOT_FOUND = b'{"message": "Not Found"}'
+
+
+class DirectorySource:
+
+    def __init__(self, root):
+        """
+        Input:
+            root: Path / String, the directory holding one json document per project
+        """
+        self.root = Path(root)
+        # key: normalized name
+        # value: path of the json document
+        self.paths = {}
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    path = os.path.join(entry.path, "json")
+                    name = entry.name
+                else:
+                    path = entry.path
+                    name = entry.name[:-len(".json")] if entry.name.endswith(".json") else entry.name
+                self.paths[normalize_pypi_name(name)] = path
+        info(f"Found {len(self.paths)} projects in {self.root}")
+
+    def get(self, package):
+        """
+        Input:
+            package: ToString, project name
+
+        return: bytes, the json document, or None if it is not found
+        """
+        path = self.paths.get(normalize_pypi_name(package))
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except (TypeError, FileNotFoundError):
+            return None
+
+
+class SQLiteSource:
+
+    def __init__(self, path):
+        """
+        Input:
+            path: Path / String, the SQLite dump, see import_jsonl()
+        """
+        self.path = Path(path)
+        if not self.path.exists():
+            raise FileNotFoundError(self.path)
+        # sqlite3 connections can not be shared between threads
+        self.local = threading.local()
+
+    def get(self, package):
+        """
+        Input:
+            package: ToString, project name
+
+        return: bytes, the json document, or None if it is not found
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            import sqlite3
+            conn = self.local.conn = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri=True)
+        row = conn.execute("SELECT body FROM projects WHERE name = ?",
+                           (normalize_pypi_name(package),)).fetchone()
+        return row[0] if row else None
+
+
+def open_source(path):
+    """
+    open a local source of PyPI metadata by its type
+
+    Input:
+        path: Path / String, a directory, a SQLite dump (.sqlite / .db) or a JSONL dump (.jsonl / .jsonl.gz)
+
+    return: DirectorySource or SQLiteSource
+    """
+    path = Path(path)
+    if path.is_dir():
+        return DirectorySource(path)
+    if path.name.endswith((".jsonl", ".jsonl.gz")):
+        db_path = path.with_name(path.name + ".sqlite")
+        if not db_path.exists() or db_path.stat().st_mtime < path.stat().st_mtime:
+            import_jsonl(path, db_path)
+        return SQLiteSource(db_path)
+    return SQLiteSource(path)
+
+
+def _project_name(line):
+    return normalize_pypi_name(json.loads(line)["info"]["name"])
+
+
+def import_jsonl(dump_path, db_path, jobs=None, batch_size=10000):
+    """
+    Write Mirror -
+    ingest a JSONL dump into a SQLite dump, the lines are decoded by a process pool
+    and stored as they are
+
+    Input:
+        dump_path: Path / String, one project json per line, gzipped if it ends with .gz
+        db_path: Path / String, the SQLite dump, replaced if it exists
+        jobs: int, the number of processes decoding lines, os.cpu_count() if None
+        batch_size: int, the number of lines inserted at once
+
+    return: int, the number of imported projects
+    """
+    start = time.perf_counter()
+    dump_path = Path(dump_path)
+    db_path = Path(db_path)
+    tmp_path = db_path.with_name(db_path.name + ".tmp")
+    tmp_path.unlink(missing_ok=True)
+    import sqlite3
+    from concurrent.futures import ProcessPoolExecutor
+    conn = sqlite3.connect(tmp_path)
+    # nobody reads the temporary file, durability comes from the rename at the end
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("CREATE TABLE projects (name TEXT PRIMARY KEY, body BLOB) WITHOUT ROWID")
+    opener = gzip.open if dump_path.name.endswith(".gz") else open
+    imported = 0
+    with opener(dump_path, 'rb') as f, ProcessPoolExecutor(jobs) as executor:
+        lines = (line for line in f if line.strip())
+        while True:
+            batch = list(islice(lines, batch_size))
+            if not batch:
+                break
+            names = executor.map(_project_name, batch, chunksize=max(1, batch_size // 64))
+            # a later line of the same project wins
+            conn.executemany("INSERT OR REPLACE INTO projects VALUES (?, ?)", zip(names, batch))
+            imported += len(batch)
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, db_path)
+    elapsed = time.perf_counter() - start
+    info(f"Imported {imported} projects into {db_path} in {elapsed:.1f}s "
+         f"({imported / max(elapsed, 1e-9):.0f} projects/s)")
+    return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description='manage local copies of PyPI metadata')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_import = subparsers.add_parser('import', help='ingest a JSONL dump into a SQLite dump')
+    parser_import.add_argument('dump', help='one project json per line, may be gzipped')
+    parser_import.add_argument('db', help='the SQLite dump to write')
+    parser_import.add_argument('-j', '--jobs', type=int, help='the number of processes decoding lines')
+    parser_get = subparsers.add_parser('get', help='print the json metadata of a project')
+    parser_get.add_argument('source', help='a directory, a SQLite dump or a JSONL dump')
+    parser_get.add_argument('package')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        start = time.perf_counter()
+        imported = import_jsonl(args.dump, args.db, args.jobs)
+        elapsed = time.perf_counter() - start
+        print(f"Imported {imported} projects in {elapsed:.1f}s ({imported / max(elapsed, 1e-9):.0f} projects/s)")
+    elif args.command == 'get':
+        body = open_source(args.source).get(args.package)
+        if body is None:
+            sys.exit(f"{args.package} not found")
+        sys.stdout.buffer.write(body)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,14 @@
-from logging import debug, info, warn, error
-import argparse
-import sys
-import json
-import os
+from logging import debug, warn
+import atexit
 from typing import List
-import requests
-import re
-import glob
 from collections import defaultdict
-from pathlib import Path
 
 from .metadata_repr import PkgMetadata, ToBeGeneratedEbuilds
+from .pypi_fetch import PyPIFetcher, FetchError
+from .http_cache import HTTPCache
+from .name_index import NameIndex
+from .requirement import parse_requirement, version_hint, marker_extras, marker_variables, InvalidRequirement
+from . import profiling
 
 """
 I am going to represent everything in a intermedia format (on the basis of portage)
@@ -52,21 +50,9 @@ class PYPIParser():
         "dev": "ignore"
     }
 
-    # dep patterns
-    dep_use = re.compile("(.+); extra == '(.+)'")
-    dep_python_ver = re.compile('(.+); python_version < "(.+)"')
-    dep_fallback = re.compile("(.+); (.+)")
-    ## dep's PV patterns
-    # handle: package ([<>]=version)
-    depv_normal = re.compile(r"(^[ \(]+) *\(?([<>]=?) *([0-9\.\-]+)\)?")
-    # handle: package ([~=]=version)
-    depv_locked = re.compile(r"(^[ \(]+) *?\(?([~=])= *([0-9\.\-]+)\)?")
-    # handle: package (!=version)
-    depv_rej = re.compile(r"(^[ \(]+) *\(?!= *([0-9\.\-]+)\)?")
-
-    # database got by parsing the host's portage repo
+    # database got by parsing the host's portage repo, on top of PN_exceptions
     ## static member, meant to be modified by portage_parser
-    PN_database = {}
+    PN_database = NameIndex(PN_exceptions)
     '''
     translate pypi staffs to portage
     '''
@@ -80,14 +66,10 @@ class PYPIParser():
 
         Return: String: somehow regularized name
         """
-        if pypi_id in PYPIParser.PN_exceptions:
-            return PYPIParser.PN_exceptions[pypi_id].portage_cate, \
-                   PYPIParser.PN_exceptions[pypi_id].portage_name, \
-                   True
-        elif pypi_id in PYPIParser.PN_database:
-            return PYPIParser.PN_database[pypi_id].portage_cate, \
-                   PYPIParser.PN_database[pypi_id].portage_name, \
-                   True
+        # exceptions are pinned in the index, all spellings of a name meet
+        metadata = PYPIParser.PN_database.get(pypi_id)
+        if metadata is not None:
+            return metadata.portage_cate, metadata.portage_name, True
         else:
             return "dev-python", \
                    pypi_id.lower().replace('.', '-').replace('_', '-'), \
@@ -119,84 +101,44 @@ class PYPIParser():
         """
         requires = project_json['info']['requires_dist']
         deps = defaultdict(list)
-#        simple = []
-#        uses = defaultdict(list)
         if requires == None:
             return deps
         for req in requires:
-            ## TODO: update it so we can do less res
-            match_use = PYPIParser.dep_use.match(req)
-            match_pyver = PYPIParser.dep_python_ver.match(req)
-            match_fallback = PYPIParser.dep_fallback.match(req)
-            ##
-            if match_use:
-                dep_pypi_id = match_use.group(1).strip()
-                use = match_use.group(2)
-                if PYPIParser.use_special.get(use) == "ignore":
-                    continue
-                else:
-                    _pypi_id, _pv = PYPIParser.parse_single_dep(dep_pypi_id)
-                    deps[use].append((_pypi_id, _pv))
-            elif match_pyver:
-                dep_pypi_id = match_pyver.group(1).strip()
-                if not dep_pypi_id.startswith('backports'):
+            try:
+                requirement = parse_requirement(req)
+            except InvalidRequirement as e:
+                warn(f"Not implemented parser for dep-string: '{req}', {e}")
+                continue
+            dep = (requirement.name, version_hint(requirement))
+            extras = marker_extras(requirement.marker)
+            if extras:
+                for use in extras:
+                    if PYPIParser.use_special.get(use) != "ignore":
+                        deps[use].append(dep)
+            elif requirement.marker is None:
+                deps["_default"].append(dep)
+            elif marker_variables(requirement.marker) <= {"python_version", "python_full_version"}:
+                if not requirement.name.startswith('backports'):
                     # we don't need backports for python3
-                    _pypi_id, _pv = PYPIParser.parse_single_dep(dep_pypi_id)
-                    deps["_default"].append((_pypi_id, _pv))
-            elif match_fallback:
-                warn(f"Not implemented parser for dep-string: '{req}'")
+                    deps["_default"].append(dep)
             else:
-                dep_pypi_id = req.strip()
-                _pypi_id, _pv = PYPIParser.parse_single_dep(dep_pypi_id)
-                deps["_default"].append((_pypi_id, _pv))
+                warn(f"Not implemented parser for dep-string: '{req}'")
 
         return deps
-    
+
     @staticmethod
     def parse_single_dep(dep_string):
-        # ignore strings after ';'
-        if len(dep_string.split(';')) > 1:
-            warn(f"ignoring the latter part of a conditional dep string {dep_string}")
-        dep_string = dep_string.split(';')[0].strip()
-        # ignore strings after '[', e.g. horovod[torch]
-        if len(dep_string.split('[')) > 1:
-            warn(f"ignoring the latter part of a conditional dep string {dep_string}")
-        dep_string = dep_string.split('[')[0]
-
-        # handle: package ([<>]=version)
-        match_normal = PYPIParser.depv_normal.match(dep_string)
-        # handle: package ([~=]=version)
-        match_locked = PYPIParser.depv_locked.match(dep_string)
-        # handle: package (!=version)
-        match_rej = PYPIParser.depv_rej.match(dep_string)
-
-        if match_normal:
-            pypi_id = match_normal.group(1)
-            specifier = match_normal.group(2)
-            version = match_normal.group(3)
-        #    return '{}{}-{}[${{PYTHON_USEDEP}}]'.format(specifier, self.get_package_name(name), version)
-        elif match_locked:
-            pypi_id = match_locked.group(1)
-            specifier = match_locked.group(2)
-            version = match_locked.group(3)
-#            return '{}{}-{}[${{PYTHON_USEDEP}}]'.format(specifier, self.get_package_name(name), version)
-        elif match_rej:
-            pypi_id = match_rej.group(1)
-            specifier = "!="
-            version = match_rej.group(2)
-#            return '!={}-{}[${{PYTHON_USEDEP}}]'.format(self.get_package_name(name), version)
-        elif " " not in dep_string:
-            pypi_id = dep_string
-            specifier = None
-            version = None
-        else:
-            error(f"not handled dep string {dep_string}")
-            #raise ValueError
-            pypi_id = dep_string.split(" ")[0]
-            specifier = None
-            version = None
-        print(pypi_id, (specifier, version))
-        return pypi_id, (specifier, version)
+        """
+        Parse PyPI -
+        the name and the version constraint of a requirement, extras and markers are ignored
+
+        Input:
+            dep_string: String, a PEP 508 requirement
+
+        return: (pypi_id, (specifier, version)), see requirement.version_hint()
+        """
+        requirement = parse_requirement(dep_string)
+        return requirement.name, version_hint(requirement)
 
 def get_project_python_versions(self, project):
     """
@@ -227,43 +169,105 @@ class PYPICommunicator():
 
     upstream_template = "https://pypi.org/pypi/{}/json"
 
-    def test(self, package):
-        warn(f"Retriving metadata of {package}, uri: {self.upstream_template.format(package)}")
-        resp = requests.get(self.upstream_template.format(package))
-        body = json.loads(resp.content)
-        ###############################
-        #
+    # shared by all communicators, assign one to change the number of workers
+    fetcher = None
+
+    @staticmethod
+    def get_fetcher():
+        if PYPICommunicator.fetcher is None:
+            PYPICommunicator.fetcher = PyPIFetcher(upstream_template=PYPICommunicator.upstream_template,
+                                                   cache=HTTPCache())
+            # nobody else owns it, close it at exit so the HTTP cache is evicted down to its size
+            atexit.register(PYPICommunicator.fetcher.close)
+        return PYPICommunicator.fetcher
+
+    def test(self, package, body=None, fetch_missing=True):
+        """
+        Parse PyPI -
+        translate a project into a PkgMetadata in ToBeGeneratedEbuilds,
+        missing dependencies are translated as well if fetch_missing,
+        a project is translated once, concurrent calls for it wait for the first one
+
+        Input:
+            package: ToString, project name
+            body: dict, the json metadata provided by PyPI, fetched if None
+            fetch_missing: bool, recursively translate the missing dependencies
+
+        return: (pypi_id, dict of {use: deps}), see PYPIParser.get_iuse_and_depend()
+        """
+        future, owner = ToBeGeneratedEbuilds.registry.claim(package)
+        if owner:
+            self.resolve(future, package, body, fetch_missing)
+        pypi_id, deps, _ = future.result()
+        return pypi_id, deps
+
+    def resolve(self, future, package, body=None, fetch_missing=True):
+        """
+        Parse PyPI -
+        translate a project claimed in ToBeGeneratedEbuilds.registry, and publish it in its Future,
+        or the exception if it fails
+
+        Input:
+            future: Future, returned by ShardedRegistry.claim() to its owner
+            package: ToString, project name
+            body: dict / Exception, the json metadata provided by PyPI, or the failure to fetch it,
+                  fetched if None
+            fetch_missing: bool, recursively translate the missing dependencies
+        """
         try:
-            pypi_id = body["info"]["name"]
+            if body is None:
+                warn(f"Retriving metadata of {package}, uri: {self.upstream_template.format(package)}")
+                body = self.get_fetcher().fetch(package)
+            elif isinstance(body, Exception):
+                raise body
+            pypi_id, deps, pkgmeta = self.translate(package, body)
+            if pkgmeta is not None:
+                pkgmeta.parse_deps(deps, fetch_missing)
         except Exception as e:
-            print(body)
-            error(f"encountering {e} for pkg: '{package}'")
-            raise ValueError
+            future.set_exception(e)
+            return
+        future.set_result((pypi_id, deps, pkgmeta))
+
+    def translate(self, package, body):
+        """
+        Parse PyPI -
+        translate a project into a PkgMetadata, without fetching or registering anything
+
+        Input:
+            package: ToString, project name
+            body: dict, the json metadata provided by PyPI
+
+        return: (pypi_id, dict of {use: deps}, PkgMetadata or None if Portage has the project already),
+                the deps of the PkgMetadata are left to PkgMetadata.parse_deps()
+        """
+        ###############################
+        #
+        if "info" not in body:
+            raise FetchError(f"no metadata of {package}: {body.get('message', 'unexpected document')}")
+        pypi_id = body["info"]["name"]
         #
         portage_cate, portage_name, existed = PYPIParser.catepn(pypi_id)
         portage_version = PYPIParser.pv(body['info']['version'])
         portage_lic = PYPIParser.license(body['info']['license'])
         #
-        deps = PYPIParser.get_iuse_and_depend(body)
+        with profiling.stage("parse"):
+            deps = PYPIParser.get_iuse_and_depend(body)
         #
         homepage = body['info']['home_page']
         short_desc = body['info']['summary']
-        long_desc = body['info']['description']
+        # the streaming mode drops the README, see INFO_FIELDS
+        long_desc = body['info'].get('description', "")
         ###############################
+        pkgmeta = None
         if not existed:
-            with ToBeGeneratedEbuilds.lock:
-                pkgmeta = PkgMetadata(pypi_id,
-                            portage_cate, portage_name,
-                            portage_version, portage_lic)
-                pkgmeta.add_descriptions(short_desc, long_desc)
-                pkgmeta.add_homepage(homepage)
-                pkgmeta.parse_deps(deps)
-                ToBeGeneratedEbuilds.payload[pypi_id] = pkgmeta
+            pkgmeta = PkgMetadata(pypi_id,
+                        portage_cate, portage_name,
+                        portage_version, portage_lic)
+            pkgmeta.add_descriptions(short_desc, long_desc)
+            pkgmeta.add_homepage(homepage)
         #
-        print(portage_cate, portage_name)
-        print(portage_version)
-        print(portage_lic)
-        return
+        debug(f"{portage_cate}/{portage_name}-{portage_version}, {portage_lic}")
+        return pypi_id, deps, pkgmeta
         #
         versions = self.get_project_python_versions(body)
         compat = ' '.join(['python' + version.replace('.','_') for version in versions])
@@ -0,0 +1,256 @@
+"""
+This file schedules the requests to a server so it is not overrun
+
+Every host gets a token bucket (requests per second) and an AIMD limit of
+concurrent requests: each success raises the limit by about one per round of
+requests, a throttling answer (429, 503) or a dropped connection halves it, at
+most once per cooldown. Throttled and failed requests are retried with
+exponential backoff and full jitter, a Retry-After header pauses the whole host.
+"""
+import time
+import random
+from threading import Lock, Condition
+from urllib.parse import urlsplit
+from logging import info
+
+from . import profiling
+
+# answers worth another try
+RETRY_STATUS = frozenset((429, 500, 502, 503, 504))
+# answers telling that the server is overloaded
+THROTTLE_STATUS = frozenset((429, 503))
+
+
+def retry_after(resp):
+    """
+    Input:
+        resp: requests.Response
+
+    return: float, seconds to wait as the Retry-After header says, None if there is none
+    """
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    # e.g. "Wed, 21 Oct 2015 07:28:00 GMT", rare enough not to import it up front
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst=None):
+        """
+        Input:
+            rate: float, tokens per second
+            burst: float, the capacity, max(1, rate) if None
+        """
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def reserve(self):
+        """
+        take a token, possibly one that is not there yet
+
+        return: float, seconds to wait before the token may be used
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+
+class AIMDLimiter:
+    """
+    a limit of concurrent requests, increased additively on success and decreased multiplicatively on throttling
+    """
+
+    def __init__(self, initial, minimum=1, maximum=None, decrease=0.5, cooldown=1.0):
+        """
+        Input:
+            initial: float, the starting limit
+            minimum: float
+            maximum: float, initial if None
+            decrease: float, the factor applied on throttling
+            cooldown: float, seconds, the answers to requests already in flight do not decrease it again,
+                      and it is not increased either until the server had a quiet cooldown
+        """
+        self.limit = float(initial)
+        self.minimum = float(minimum)
+        self.maximum = float(maximum or initial)
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.lowest = self.limit
+        self.inflight = 0
+        self.decreased = 0.0
+        self.cond = Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+
+    def release(self, throttled=False):
+        with self.cond:
+            self.inflight -= 1
+            if throttled:
+                now = time.monotonic()
+                if now - self.decreased >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self.lowest = min(self.lowest, self.limit)
+                    self.decreased = now
+            elif time.monotonic() - self.decreased >= self.cooldown:
+                # about +1 once every request of the current limit succeeded,
+                # the successes right after a decrease would win it back within a few round trips
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+
+class _Host:
+
+    def __init__(self, limiter, bucket):
+        self.limiter = limiter
+        self.bucket = bucket
+        # time.monotonic() until which the host asked not to be bothered
+        self.paused_until = 0.0
+        self.lock = Lock()
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def delay(self):
+        """
+        return: float, seconds to wait before the next request
+        """
+        with self.lock:
+            delay = self.paused_until - time.monotonic()
+        if self.bucket:
+            delay = max(delay, 0.0) + self.bucket.reserve()
+        return max(delay, 0.0)
+
+
+class RequestScheduler:
+
+    def __init__(self, max_concurrency=8, min_concurrency=1, rate=None, burst=None, retries=5,
+                 backoff=0.5, max_backoff=60.0):
+        """
+        Input:
+            max_concurrency: int, the limit of concurrent requests per host to start from and to return to
+            min_concurrency: int, the lowest limit
+            rate: float, requests per second per host, unlimited if None
+            burst: float, requests a host may get at once after a quiet period, see TokenBucket
+            retries: int, times a throttled or failed request is repeated
+            backoff: float, seconds before the first retry, doubled for every further one
+            max_backoff: float, seconds, the longest wait, Retry-After included
+        """
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # key: host
+        # value: _Host
+        self.hosts = {}
+        # statistics
+        self.lock = Lock()
+        self.requests = 0
+        self.retried = 0
+        self.throttled = 0
+        self.waited = 0.0
+
+    def _host(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                state = self.hosts[host] = _Host(
+                    AIMDLimiter(self.max_concurrency, self.min_concurrency),
+                    TokenBucket(self.rate, self.burst) if self.rate else None)
+            return state
+
+    def backoff_delay(self, attempt):
+        """
+        return: float, seconds to wait before retry number attempt + 1, with full jitter
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            with self.lock:
+                self.waited += seconds
+            time.sleep(seconds)
+
+    def send(self, url, send):
+        """
+        Fetch PyPI -
+        send a request when the host allows it, and repeat it while it is throttled or fails
+
+        Input:
+            url: String, the host of it is limited
+            send: callable() -> requests.Response, sends the request
+
+        return: requests.Response, the last answer, which may still be an error once the retries are used up
+        """
+        import requests
+        host = self._host(url)
+        for attempt in range(self.retries + 1):
+            self._sleep(host.delay())
+            host.limiter.acquire()
+            with self.lock:
+                self.requests += 1
+            try:
+                resp = send()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # a dropped connection is how an overloaded proxy says it, too
+                throttled = True
+                host.limiter.release(throttled)
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                info(f"Retrying {url} in {delay:.2f}s after {type(e).__name__}")
+            else:
+                throttled = resp.status_code in THROTTLE_STATUS
+                host.limiter.release(throttled)
+                if resp.status_code not in RETRY_STATUS or attempt == self.retries:
+                    return resp
+                delay = retry_after(resp)
+                if delay is None:
+                    delay = self.backoff_delay(attempt)
+                else:
+                    # the whole host waits, and the retries do not all come back at once
+                    delay = min(self.max_backoff, delay) + random.uniform(0, self.backoff)
+                    host.pause(delay)
+                resp.close()
+                info(f"Retrying {url} in {delay:.2f}s after HTTP {resp.status_code}")
+            with self.lock:
+                self.retried += 1
+                self.throttled += throttled
+            profiling.count("pypi_retries")
+            self._sleep(delay)
+
+    def describe_stats(self):
+        """
+        return: String, a human readable summary of the scheduling
+        """
+        with self.lock:
+            res = (f'Scheduler: {self.requests} requests, {self.retried} retried ({self.throttled} throttled), '
+                   f'{self.waited:.1f}s waited')
+            for host, state in self.hosts.items():
+                res += (f'\n  {host}: concurrency limit {state.limiter.limit:.1f} '
+                        f'(lowest {state.limiter.lowest:.1f}, at most {state.limiter.maximum:.0f})')
+            return res
@@ -0,0 +1,91 @@
+"""
+This file keeps the packages being translated, shared by all threads
+
+A ShardedRegistry maps normalized PyPI names to Futures. The first caller
+claiming a name translates the package, every other caller, concurrent or
+later, gets the same Future instead of fetching and parsing it again. This
+also ends the recursion over dependency cycles. Names are spread over shards
+with a lock each, so threads working on different packages do not wait for
+each other.
+"""
+from concurrent.futures import Future
+from threading import Lock
+
+from .name_index import normalize_pypi_name
+
+
+class _Shard:
+    __slots__ = ("lock", "futures", "claimed", "joined")
+
+    def __init__(self):
+        self.lock = Lock()
+        # key: normalized name
+        # value: Future
+        self.futures = {}
+        # statistics
+        self.claimed = 0
+        self.joined = 0
+
+
+class ShardedRegistry:
+
+    def __init__(self, shards=16):
+        """
+        Input:
+            shards: int, the number of locks the names are spread over
+        """
+        self.shards = [_Shard() for _ in range(shards)]
+
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def claim(self, pypi_id):
+        """
+        get the Future of a package, the first caller owns it and has to resolve it,
+        by set_result() or set_exception(), or the others wait forever
+
+        Input:
+            pypi_id: String, PyPI project name, in any spelling
+
+        return: (Future, bool, whether the caller owns it)
+        """
+        key = normalize_pypi_name(pypi_id)
+        shard = self._shard(key)
+        with shard.lock:
+            future = shard.futures.get(key)
+            if future is not None:
+                shard.joined += 1
+                return future, False
+            future = shard.futures[key] = Future()
+            shard.claimed += 1
+        return future, True
+
+    def __contains__(self, pypi_id):
+        key = normalize_pypi_name(pypi_id)
+        return key in self._shard(key).futures
+
+    def __len__(self):
+        return sum(len(shard.futures) for shard in self.shards)
+
+    def items(self):
+        """
+        return: list of (normalized name, value) of the packages resolved successfully
+        """
+        res = []
+        for shard in self.shards:
+            with shard.lock:
+                futures = list(shard.futures.items())
+            res.extend((key, future.result()) for key, future in futures
+                       if future.done() and future.exception() is None)
+        return res
+
+    def describe_stats(self):
+        """
+        return: String, a human readable summary of the claims
+        """
+        claimed = sum(shard.claimed for shard in self.shards)
+        joined = sum(shard.joined for shard in self.shards)
+        failed = sum(1 for shard in self.shards for future in list(shard.futures.values())
+                     if future.done() and future.exception() is not None)
+        return (f'Registry: {claimed} packages translated ({failed} failed), '
+                f'{joined} requests for them shared instead of repeated, {len(self.shards)} shards')
@@ -0,0 +1,413 @@
+"""
+This file keeps an on-disk index of the PyPI projects found in Portage repositories
+
+The index maps every category/package directory to its pypi remote-id and its
+highest version, so metadata.xml files are only parsed again when they change.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+from pathlib import Path
+from logging import info, warn
+from xml.parsers.expat import ExpatError
+
+from . import profiling
+
+# bump it whenever the layout of the index file changes
+# 2: "version" is ${PVR}, it was the revision only
+INDEX_FORMAT = 2
+
+# ${P} or ${PF} => ${PN}, ${PVR}, see PMS "Version specifications"
+_pf = re.compile(r"(?P<pn>.+?)-(?P<pvr>\d+(?:\.\d+)*[a-z]?(?:_(?:alpha|beta|pre|rc|p)\d*)*(?:-r\d+)?)$")
+
+# ${PVR} => its parts, see PMS "Version comparison"
+_pvr = re.compile(r"(?P<numbers>\d+(?:\.\d+)*)(?P<letter>[a-z]?)"
+                  r"(?P<suffixes>(?:_(?:alpha|beta|pre|rc|p)\d*)*)(?:-r(?P<revision>\d+))?$")
+_suffix = re.compile(r"_(alpha|beta|pre|rc|p)(\d*)")
+# _p is the only suffix coming after the release itself
+_suffix_order = {"alpha": 0, "beta": 1, "pre": 2, "rc": 3, "p": 4}
+
+
+def default_index_path():
+    """
+    the default location of the index, i.e. $XDG_CACHE_HOME/pypi-ebuilder/repo-index.json
+
+    return: pathlib.Path
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return Path(cache_home) / "pypi-ebuilder" / "repo-index.json"
+
+
+def _cmp(a, b):
+    return (a > b) - (a < b)
+
+
+def vercmp(a, b):
+    """
+    Parse Portage -
+    compare two versions as PMS "Version comparison" does,
+    the same order as portage.versions.vercmp() without importing Portage
+
+    Input:
+        a: String, ${PVR}
+        b: String, ${PVR}
+
+    return: int, negative if a is older, 0 if they are equal, positive if a is newer
+    """
+    if a == b:
+        return 0
+    ma, mb = _pvr.match(a), _pvr.match(b)
+    if ma is None or mb is None:
+        raise ValueError(f"invalid version: {a if ma is None else b}")
+    na, nb = ma.group("numbers").split("."), mb.group("numbers").split(".")
+    res = _cmp(int(na[0]), int(nb[0]))
+    for x, y in zip(na[1:], nb[1:]):
+        if res:
+            return res
+        # a leading zero makes it a fraction, e.g. 1.01 < 1.1
+        if x.startswith("0") or y.startswith("0"):
+            res = _cmp(x.rstrip("0"), y.rstrip("0"))
+        else:
+            res = _cmp(int(x), int(y))
+    res = res or _cmp(len(na), len(nb)) or _cmp(ma.group("letter"), mb.group("letter"))
+    if res:
+        return res
+    sa, sb = _suffix.findall(ma.group("suffixes")), _suffix.findall(mb.group("suffixes"))
+    for (xs, xn), (ys, yn) in zip(sa, sb):
+        res = _cmp((_suffix_order[xs], int(xn or 0)), (_suffix_order[ys], int(yn or 0)))
+        if res:
+            return res
+    if len(sa) != len(sb):
+        # one more suffix makes it older, unless it is _p
+        extra = sa[len(sb)] if len(sa) > len(sb) else sb[len(sa)]
+        newer = 1 if extra[0] == "p" else -1
+        return newer if len(sa) > len(sb) else -newer
+    return _cmp(int(ma.group("revision") or 0), int(mb.group("revision") or 0))
+
+
+def upstream_has_pypi(metadata_dict):
+    """
+    Parse Portage -
+    whether a package exists in PyPI
+
+    Input:
+        metadata_dict: dict, parsed metadata.xml
+
+    return: PyPI project name or False
+    """
+    try:
+        upstream = metadata_dict['pkgmetadata']['upstream']['remote-id']
+    except (KeyError, TypeError):
+        # no <upstream> or no <remote-id>, xmltodict makes an empty element None
+        return False
+    for u in upstream if isinstance(upstream, list) else [upstream]:
+        # a <remote-id> without attributes is a plain String
+        if isinstance(u, dict) and u.get('@type') == 'pypi':
+            return u.get('#text') or False
+    return False
+
+
+def package_digest(pkg_dir, metadata_path):
+    """
+    Parse Portage -
+    hash the parts of a package directory that the index depends on:
+    the content of metadata.xml and the names of the ebuilds (i.e. the versions)
+
+    Input:
+        pkg_dir: String, the directory of the package
+        metadata_path: String, the path of its metadata.xml
+
+    return: String, hex digest
+    """
+    h = hashlib.sha1()
+    with open(metadata_path, 'rb') as f:
+        h.update(f.read())
+    for name in sorted(os.listdir(pkg_dir)):
+        if name.endswith('.ebuild'):
+            h.update(name.encode())
+    return h.hexdigest()
+
+
+def parse_metadata(metadata_path):
+    """
+    Parse Portage -
+    get the pypi remote-id of a metadata.xml
+
+    Input:
+        metadata_path: String, the path of the metadata.xml
+
+    return: PyPI project name or None
+    """
+    # the workers import it, the main process does not need it when the index is up to date
+    import xmltodict
+    try:
+        with open(metadata_path, 'rb') as f:
+            pypi_id = upstream_has_pypi(xmltodict.parse(f.read()))
+    except ExpatError as e:
+        warn(f"ignoring malformed {metadata_path}: {e}")
+        return None
+    return pypi_id or None
+
+
+def iter_package_dirs(repo):
+    """
+    Parse Portage -
+    enumerate the category/package/metadata.xml of a repository,
+    without descending into files/ or any other subtree
+
+    Input:
+        repo: String, the location of a repository
+
+    return: iterator of ("cate/pn", pkg_dir, metadata_path, mtime)
+    """
+    with os.scandir(repo) as categories:
+        for cate in categories:
+            if cate.name.startswith('.') or not cate.is_dir():
+                continue
+            with os.scandir(cate.path) as packages:
+                for pkg in packages:
+                    if not pkg.is_dir():
+                        continue
+                    metadata_path = os.path.join(pkg.path, "metadata.xml")
+                    try:
+                        metadata_mtime = os.stat(metadata_path).st_mtime
+                    except FileNotFoundError:
+                        continue
+                    # adding/removing an ebuild touches the directory, editing metadata.xml touches itself
+                    mtime = max(pkg.stat().st_mtime, metadata_mtime)
+                    yield f"{cate.name}/{pkg.name}", pkg.path, metadata_path, mtime
+
+
+def scan_package(job):
+    """
+    Parse Portage -
+    hash a package directory, parse its metadata.xml only if the hash changed,
+    meant to run in a worker process
+
+    Input:
+        job: (pkg_dir, metadata_path, old_digest or None)
+
+    return: (digest, pypi_id or None, parsed: bool)
+    """
+    pkg_dir, metadata_path, old_digest = job
+    digest = package_digest(pkg_dir, metadata_path)
+    if digest == old_digest:
+        return digest, None, False
+    return digest, parse_metadata(metadata_path), True
+
+
+def md5_cache_versions(repo, cate_pns):
+    """
+    Parse Portage -
+    read the versions of packages from the metadata/md5-cache of a repository at once,
+    one directory listing per category instead of one dbapi query per package
+
+    Input:
+        repo: ToString, the location of a repository
+        cate_pns: iterable of "cate/pn"
+
+    return: dict of {"cate/pn": [${PVR}]}, the packages without a cache entry are left out,
+            None if the repository has no md5-cache
+    """
+    cache_dir = os.path.join(str(repo), "metadata", "md5-cache")
+    if not os.path.isdir(cache_dir):
+        return None
+    wanted = {}
+    for cate_pn in cate_pns:
+        cate, pn = cate_pn.split('/')
+        wanted.setdefault(cate, set()).add(pn)
+    res = {}
+    for cate, pns in wanted.items():
+        try:
+            names = os.listdir(os.path.join(cache_dir, cate))
+        except FileNotFoundError:
+            continue
+        for name in names:
+            m = _pf.match(name)
+            if m and m.group("pn") in pns:
+                res.setdefault(f"{cate}/{m.group('pn')}", []).append(m.group("pvr"))
+    return res
+
+
+def ebuild_versions(repo, cate_pns):
+    """
+    Parse Portage -
+    read the versions of packages from the names of their ebuilds,
+    for repositories without a metadata/md5-cache, e.g. local overlays
+
+    Input:
+        repo: ToString, the location of a repository
+        cate_pns: iterable of "cate/pn"
+
+    return: dict of {"cate/pn": [${PVR}]}, the packages without an ebuild are left out
+    """
+    res = {}
+    for cate_pn in cate_pns:
+        pn = cate_pn.split('/')[1]
+        try:
+            names = os.listdir(os.path.join(str(repo), cate_pn))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        for name in names:
+            m = _pf.match(name[:-len(".ebuild")]) if name.endswith(".ebuild") else None
+            if m and m.group("pn") == pn:
+                res.setdefault(cate_pn, []).append(m.group("pvr"))
+    return res
+
+
+class RepoIndex:
+    """
+    pypi-id => (category, package, highest version) of all scanned repositories
+
+    The index is stored as json:
+        {"format": INDEX_FORMAT,
+         "repos": {repo: {"cate/pn": {"mtime": float, "digest": str,
+                                      "pypi_id": str or None, "version": str or None}}}}
+    """
+
+    def __init__(self, path=None, rebuild=False):
+        """
+        Input:
+            path: Path / String, location of the index file, default_index_path() if None
+            rebuild: bool, ignore the stored index and parse everything again
+        """
+        self.path = Path(path) if path else default_index_path()
+        # key: repo location
+        # value: {"cate/pn": entry}
+        self.repos = {}
+        # statistics of the last refresh()
+        self.stats = {"hashed": 0, "parsed": 0, "seconds": 0.0, "jobs": 0}
+        if not rebuild:
+            self.load()
+
+    def load(self):
+        try:
+            with self.path.open() as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("format") != INDEX_FORMAT:
+            info(f"ignoring outdated index {self.path}")
+            return
+        self.repos = data["repos"]
+
+    def save(self):
+        """
+        write the index atomically, so a crashed run never leaves a truncated index
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # two runs may save the shared index at once
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with tmp_path.open('w') as f:
+            json.dump({"format": INDEX_FORMAT, "repos": self.repos}, f)
+        os.replace(tmp_path, self.path)
+
+    def refresh(self, repos, version_lookup=None, jobs=None):
+        """
+        Parse Portage -
+        bring the index of repositories up to date,
+        only packages whose mtime and content hash changed are parsed again,
+        the parsing of all repositories is spread over a process pool
+
+        Input:
+            repos: list of ToString, locations of the repositories
+            version_lookup: callable(repo, ["cate/pn"]) -> {"cate/pn": String},
+                            resolve the highest versions of the packages of a repository at once,
+                            versions are left as None if it is not provided
+            jobs: int, the number of worker processes, os.cpu_count() if None
+
+        return: int, the number of parsed metadata.xml
+        """
+        start = time.perf_counter()
+        repos = [os.path.abspath(str(repo)) for repo in repos]
+        with profiling.stage("scan"):
+            # (repo, cate_pn, mtime, old entry) of the packages to be hashed
+            pending = []
+            scan_jobs = []
+            for repo in repos:
+                old = self.repos.get(repo, {})
+                new = {}
+                for cate_pn, pkg_dir, metadata_path, mtime in iter_package_dirs(repo):
+                    entry = old.get(cate_pn)
+                    if entry is not None and entry["mtime"] == mtime:
+                        new[cate_pn] = entry
+                    else:
+                        pending.append((repo, cate_pn, mtime, entry))
+                        scan_jobs.append((pkg_dir, metadata_path, entry and entry["digest"]))
+                self.repos[repo] = new
+
+            jobs = jobs or os.cpu_count() or 1
+            if jobs > 1 and len(scan_jobs) > 1:
+                # an up-to-date index needs no workers, and no multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor(jobs) as executor:
+                    results = list(executor.map(scan_package, scan_jobs,
+                                                chunksize=max(1, len(scan_jobs) // (jobs * 4))))
+            else:
+                results = list(map(scan_package, scan_jobs))
+
+            reparsed = 0
+            for (repo, cate_pn, mtime, entry), (digest, pypi_id, parsed) in zip(pending, results):
+                if parsed:
+                    entry = {"pypi_id": pypi_id, "version": None, "digest": digest}
+                    reparsed += 1
+                entry["mtime"] = mtime
+                self.repos[repo][cate_pn] = entry
+        profiling.count("metadata_hashed", len(scan_jobs))
+        profiling.count("metadata_parsed", reparsed)
+
+        # the version is resolved lazily, only for pypi packages
+        if version_lookup:
+            with profiling.stage("versions"):
+                for repo in repos:
+                    entries = self.repos[repo]
+                    pending_versions = [cate_pn for cate_pn, entry in entries.items()
+                                        if entry["pypi_id"] and entry["version"] is None]
+                    if pending_versions:
+                        for cate_pn, version in version_lookup(repo, pending_versions).items():
+                            entries[cate_pn]["version"] = version
+
+        elapsed = time.perf_counter() - start
+        self.stats = {"hashed": len(scan_jobs), "parsed": reparsed, "seconds": elapsed, "jobs": jobs}
+        info(self.describe_stats())
+        return reparsed
+
+    def describe_stats(self):
+        """
+        return: String, a human readable summary of the last refresh()
+        """
+        s = self.stats
+        return (f'Parsed {s["parsed"]} of {s["hashed"]} changed metadata.xml in {s["seconds"]:.2f}s '
+                f'({s["hashed"] / max(s["seconds"], 1e-9):.0f} files/s, {s["jobs"]} processes)')
+
+    def packages(self, repo):
+        """
+        iterate over the pypi packages of an (already refreshed) repository
+
+        Input:
+            repo: ToString, the location of a repository
+
+        return: iterator of (pypi_id, category, package, version)
+        """
+        for cate_pn, entry in self.repos.get(os.path.abspath(str(repo)), {}).items():
+            if entry["pypi_id"]:
+                cate, pn = cate_pn.split('/')
+                yield entry["pypi_id"], cate, pn, entry["version"]
+
+    def merged(self, repos):
+        """
+        merge the pypi packages of (already refreshed) repositories,
+        later repositories in the list, i.e. in prepos_order, take priority
+
+        Input:
+            repos: list of ToString, locations of the repositories
+
+        return: dict of {pypi_id: (category, package, version)}
+        """
+        res = {}
+        for repo in repos:
+            for pypi_id, cate, pn, version in self.packages(repo):
+                res[pypi_id] = (cate, pn, version)
+        return res
@@ -0,0 +1,229 @@
+"""
+This file parses PEP 508 requirement strings, e.g. the entries of requires_dist
+
+A requirement is matched by one regex, and its marker, if any, is tokenized in
+one pass and parsed into an AST. The same strings recur across
+thousands of projects, so parsed requirements are cached by their raw string.
+"""
+import re
+import sys
+from collections import namedtuple
+from functools import lru_cache
+
+from . import profiling
+
+# name: String, as written
+# extras: tuple of String
+# specifiers: tuple of (operator, version), e.g. ((">=", "1.17"), ("<", "2"))
+# url: String or None, for "name @ url"
+# marker: Comparison / BoolOp or None
+Requirement = namedtuple("Requirement", ["name", "extras", "specifiers", "url", "marker"])
+# a marker variable, e.g. Variable("python_version")
+Variable = namedtuple("Variable", ["name"])
+# left, right: Variable or String; op: e.g. "<", "in", "not in"
+Comparison = namedtuple("Comparison", ["left", "op", "right"])
+# op: "and" / "or"; operands: tuple of Comparison / BoolOp
+BoolOp = namedtuple("BoolOp", ["op", "operands"])
+
+
+class InvalidRequirement(ValueError):
+    pass
+
+
+_requirement = re.compile(r"\s*(?P<name>[A-Za-z0-9](?:[A-Za-z0-9._-]*[A-Za-z0-9])?)\s*"
+                          r"(?:\[(?P<extras>[^\]]*)\])?\s*"
+                          r"(?:@\s*(?P<url>[^\s;]+)\s*|\(\s*(?P<parenthesized>[^()]*)\)\s*|(?P<specifiers>[^;()]*))"
+                          r"(?:;(?P<marker>.*))?\s*$", re.DOTALL)
+_extra = re.compile(r"\s*([A-Za-z0-9](?:[A-Za-z0-9._-]*[A-Za-z0-9])?)\s*$")
+_specifier = re.compile(r"\s*(===|==|!=|~=|<=|>=|<|>)\s*([A-Za-z0-9*][A-Za-z0-9_.*+!-]*)\s*$")
+_variables = (r"(?:python_full_version|python_version|os_name|sys_platform|platform_release"
+              r"|platform_system|platform_version|platform_machine|platform_python_implementation"
+              r"|implementation_name|implementation_version|extra"
+              r"|os\.name|sys\.platform|platform\.version|platform\.machine"
+              r"|platform\.python_implementation|python_implementation)\b")
+# a whole comparison is one token, so the usual marker, e.g. extra == "test", is one match
+_marker_token = re.compile(
+    r"\s*(?:(?:(?P<lvar>{0})|'(?P<lsq>[^']*)'|\"(?P<ldq>[^\"]*)\")"
+    r"\s*(?P<op>===|==|!=|~=|<=|>=|<|>|not\s+in\b|in\b)\s*"
+    r"(?:(?P<rvar>{0})|'(?P<rsq>[^']*)'|\"(?P<rdq>[^\"]*)\")"
+    r"|(?P<bool>and|or)\b|(?P<paren>[()]))\s*".format(_variables))
+
+# legacy spellings of marker variables, see PEP 508
+_variable_aliases = {
+    "os.name": "os_name",
+    "sys.platform": "sys_platform",
+    "platform.version": "platform_version",
+    "platform.machine": "platform_machine",
+    "platform.python_implementation": "platform_python_implementation",
+    "python_implementation": "platform_python_implementation",
+}
+
+
+def _marker_value(variable, single_quoted, double_quoted):
+    if variable is not None:
+        return Variable(_variable_aliases.get(variable, variable))
+    return sys.intern(single_quoted if single_quoted is not None else double_quoted)
+
+
+def _tokenize_marker(string, requirement):
+    """
+    return: list of Comparison and String ("and", "or", "(", ")")
+    """
+    tokens = []
+    pos = 0
+    while pos < len(string):
+        m = _marker_token.match(string, pos)
+        if not m:
+            if string[pos:].isspace():
+                break
+            raise InvalidRequirement(f"invalid marker at {string[pos:pos + 20]!r} in {requirement!r}")
+        pos = m.end()
+        lvar, lsq, ldq, op, rvar, rsq, rdq, bool_op, paren = m.groups()
+        if op:
+            if op[0] == "n":
+                op = "not in"
+            tokens.append(Comparison(_marker_value(lvar, lsq, ldq), op, _marker_value(rvar, rsq, rdq)))
+        else:
+            tokens.append(bool_op or paren)
+    return tokens
+
+
+class _MarkerParser:
+    """
+    a recursive descent parser over the tokens of a marker,
+    i.e. marker := and_expr ("or" and_expr)*, and_expr := atom ("and" atom)*
+    """
+
+    def __init__(self, tokens, requirement):
+        self.tokens = tokens
+        self.requirement = requirement
+        self.pos = 0
+
+    def error(self, expected):
+        raise InvalidRequirement(f"expected {expected} in the marker of {self.requirement!r}")
+
+    def parse(self):
+        marker = self.expression("or")
+        if self.pos != len(self.tokens):
+            self.error("the end")
+        return marker
+
+    def expression(self, op):
+        operands = [self.expression("and") if op == "or" else self.atom()]
+        while self.pos < len(self.tokens) and self.tokens[self.pos] == op:
+            self.pos += 1
+            operands.append(self.expression("and") if op == "or" else self.atom())
+        return operands[0] if len(operands) == 1 else BoolOp(op, tuple(operands))
+
+    def atom(self):
+        if self.pos == len(self.tokens):
+            self.error("a comparison")
+        token = self.tokens[self.pos]
+        self.pos += 1
+        if isinstance(token, Comparison):
+            return token
+        if token != "(":
+            self.error("a comparison or '('")
+        marker = self.expression("or")
+        if self.pos == len(self.tokens) or self.tokens[self.pos] != ")":
+            self.error("')'")
+        self.pos += 1
+        return marker
+
+
+def _parse(string):
+    profiling.count("requirement_parses")
+    m = _requirement.match(string)
+    if not m:
+        raise InvalidRequirement(f"invalid requirement {string!r}")
+    name, extras, url, parenthesized, specifiers, marker = m.groups()
+    if extras:
+        extras = tuple(sys.intern((_extra.match(extra) or _invalid(string)).group(1))
+                       for extra in extras.split(","))
+    specifiers = parenthesized if parenthesized is not None else specifiers
+    if specifiers and not specifiers.isspace():
+        specifiers = specifiers.split(",")
+        if len(specifiers) > 1 and not specifiers[-1].strip():
+            # "foo>=1.0," is accepted by packaging
+            specifiers.pop()
+        specifiers = tuple((_specifier.match(specifier) or _invalid(string)).groups()
+                           for specifier in specifiers)
+    else:
+        specifiers = ()
+    if marker is not None:
+        tokens = _tokenize_marker(marker, string)
+        if len(tokens) == 1 and isinstance(tokens[0], Comparison):
+            marker = tokens[0]
+        else:
+            marker = _MarkerParser(tokens, string).parse()
+    return Requirement(sys.intern(name), extras or (), specifiers, url, marker)
+
+
+def _invalid(string):
+    raise InvalidRequirement(f"invalid requirement {string!r}")
+
+
+@lru_cache(maxsize=1 << 16)
+def parse_requirement(string):
+    """
+    Parse PyPI -
+    parse a PEP 508 requirement string, the result is cached by the raw string,
+    see parse_requirement.cache_info() for the hits and misses
+
+    Input:
+        string: String, e.g. "numpy>=1.17; extra == 'test'"
+
+    return: Requirement, raise InvalidRequirement if it is not understood
+    """
+    return _parse(string)
+
+
+def marker_variables(marker):
+    """
+    return: set of String, the variables used by a marker
+    """
+    if marker is None:
+        return set()
+    if isinstance(marker, BoolOp):
+        return set().union(*map(marker_variables, marker.operands))
+    return {side.name for side in (marker.left, marker.right) if isinstance(side, Variable)}
+
+
+def marker_extras(marker):
+    """
+    return: list of String, the extras a marker is conditional on, i.e. extra == "..."
+    """
+    if marker is None:
+        return []
+    if isinstance(marker, BoolOp):
+        return [extra for operand in marker.operands for extra in marker_extras(operand)]
+    if marker.op != "==":
+        return []
+    if marker.left == Variable("extra") and isinstance(marker.right, str):
+        return [marker.right]
+    if marker.right == Variable("extra") and isinstance(marker.left, str):
+        return [marker.left]
+    return []
+
+
+# PEP 440 operator => Portage operator
+_portage_ops = {"<": "<", "<=": "<=", ">": ">", ">=": ">=", "==": "=", "===": "=", "~=": "~", "!=": "!="}
+
+
+def version_hint(requirement):
+    """
+    Parse PyPI -
+    the version constraint of a requirement, as Portage spells it, only the first specifier is kept
+
+    Input:
+        requirement: Requirement
+
+    return: (specifier, version), or (None, None) if it is not constrained
+    """
+    if not requirement.specifiers:
+        return None, None
+    op, version = requirement.specifiers[0]
+    if version.endswith(".*"):
+        # ==1.4.* => =pn-1.4*
+        version = version[:-2] + "*"
+    return _portage_ops[op], version
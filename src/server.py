@@ -0,0 +1,89 @@
+"""
+This file serves requests over a Unix domain socket
+
+Every request and response is one line of json. A request names its operation
+in "op", e.g. {"op": "generate", "packages": ["xgboost"]}; a response always has
+"ok", and "error" if it failed. Every connection is handled by its own thread.
+"""
+import os
+import json
+import socket
+import socketserver
+from logging import info, error
+
+
+class JSONRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.dispatch(json.loads(line))
+            except Exception as e:
+                error(f"request {line[:200]!r} failed: {e}")
+                response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class JSONServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, handlers):
+        """
+        Input:
+            path: ToString, location of the socket, a stale socket there is replaced
+            handlers: dict of {op: callable(request: dict) -> dict}
+        """
+        self.path = str(path)
+        self.handlers = handlers
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        super().__init__(self.path, JSONRequestHandler)
+
+    def dispatch(self, request):
+        op = request.get("op")
+        if op not in self.handlers:
+            raise ValueError(f"unknown op {op!r}, expected one of {sorted(self.handlers)}")
+        response = self.handlers[op](request)
+        response.setdefault("ok", True)
+        return response
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def serve(path, handlers):
+    """
+    serve forever, until interrupted
+
+    Input:
+        path: ToString, location of the socket
+        handlers: dict of {op: callable(request: dict) -> dict}
+    """
+    with JSONServer(path, handlers) as server:
+        info(f"Listening on {path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def request(path, message):
+    """
+    send one request and wait for its response
+
+    Input:
+        path: ToString, location of the socket
+        message: dict, the request
+
+    return: dict, the response
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(path))
+        sock.sendall(json.dumps(message).encode() + b"\n")
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline())
@@ -1,6 +1,7 @@
 from src import pypi_parser
 from src import portage_parser
 from src import ebuild_writer
+from src.repo_index import RepoIndex
 import portage
 from pathlib import Path
 
@@ -14,8 +15,9 @@ if 1:
     for name in repo_names:
         repos.append(portage.db[eroot]["vartree"].settings.repositories.treemap.get(name))
     
-    for repo in repos:
-        portage_parser.find_packages(repo)
+    index = RepoIndex()
+    portage_parser.find_packages(repos, index)
+    index.save()
 
 #for k, v in pypi_parser.PYPIParser.PN_database.items():
 #    print(k,v)
@@ -25,9 +27,8 @@ t1.test("spark-utils")
 
 print()
 
-with pypi_parser.ToBeGeneratedEbuilds.lock:
-    print(pypi_parser.ToBeGeneratedEbuilds.payload)
-    for pypi_id, my_metadata in pypi_parser.ToBeGeneratedEbuilds.payload.items():
-        ebuild_writer.generate(Path("test"),
-                       pypi_id,
-                       my_metadata)
\ No newline at end of file
+print(pypi_parser.ToBeGeneratedEbuilds.registry.describe_stats())
+for pypi_id, my_metadata in pypi_parser.ToBeGeneratedEbuilds.items():
+    ebuild_writer.generate(Path("test"),
+                   pypi_id,
+                   my_metadata)
\ No newline at end of file
@@ -0,0 +1,43 @@
+"""
+shared fixtures of the tests, run them with: python -m pytest tests
+"""
+import sys
+from pathlib import Path
+from threading import Thread
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    """
+    the default caches, e.g. HTTPCache() or HashCache(), go into the temporary directory of the test
+
+    return: pathlib.Path, $XDG_CACHE_HOME
+    """
+    path = tmp_path / "cache"
+    monkeypatch.setenv("XDG_CACHE_HOME", str(path))
+    return path
+
+
+@pytest.fixture
+def serve():
+    """
+    run local http servers in the background, without network,
+    they are shut down at the end of the test
+
+    return: callable(server: ThreadingHTTPServer) -> the server, serving
+    """
+    servers = []
+
+    def start(server):
+        Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,128 @@
+import sys
+
+import pytest
+
+from src.dep_graph import DepGraph
+from src.metadata_repr import PortagePackage
+from src.name_index import NameIndex
+from src.pypi_parser import PYPIParser
+
+
+@pytest.fixture(autouse=True)
+def portage(monkeypatch):
+    # "existing" is provided by Portage, nothing else is
+    index = NameIndex()
+    index.add("existing", PortagePackage("dev-python", "existing", "1.0"))
+    monkeypatch.setattr(PYPIParser, "PN_database", index)
+
+
+def _graph(projects, extras=None):
+    """
+    projects: dict of {name: [unconditional deps]}
+    extras: dict of {name: {use: [deps]}}
+    """
+    graph = DepGraph()
+    for name, deps in projects.items():
+        uses = {"_default": [(dep, (None, None)) for dep in deps]}
+        for use, dep_list in (extras or {}).get(name, {}).items():
+            uses[use] = [(dep, (">=", "1.0")) for dep in dep_list]
+        graph.add_project(name, uses)
+    return graph
+
+
+def _check_levels(graph):
+    levels = graph.levels()
+    level_of = {key: i for i, level in enumerate(levels) for key in level}
+    assert sorted(level_of) == sorted(graph.resolved - graph.existing)
+    for key in level_of:
+        for dep in graph.dependencies(key):
+            # a dependency is on an earlier level, or on the same one if they are in a cycle
+            assert level_of[dep] < level_of[key] or any(
+                key in cycle and dep in cycle for cycle in graph.cycles())
+    return levels
+
+
+def test_chain():
+    graph = _graph({"a": ["b"], "b": ["c"], "c": []})
+    assert graph.strongly_connected_components() == [["c"], ["b"], ["a"]]
+    assert _check_levels(graph) == [["c"], ["b"], ["a"]]
+    assert graph.critical_path() == ["a", "b", "c"]
+    assert graph.cycles() == []
+    assert graph.topological_order() == ["c", "b", "a"]
+
+
+def test_diamond():
+    graph = _graph({"top": ["left", "right"], "left": ["bottom"], "right": ["bottom"], "bottom": []})
+    assert _check_levels(graph) == [["bottom"], ["left", "right"], ["top"]]
+    assert len(graph.critical_path()) == 3
+    assert graph.critical_path()[0] == "top" and graph.critical_path()[-1] == "bottom"
+
+
+def test_cycle_shares_a_level():
+    graph = _graph({"app": ["a"], "a": ["b"], "b": ["c"], "c": ["a", "leaf"], "leaf": []})
+    assert graph.cycles() == [["a", "b", "c"]]
+    assert _check_levels(graph) == [["leaf"], ["a", "b", "c"], ["app"]]
+    path = graph.critical_path()
+    # a cycle counts as one step
+    assert path[0] == "app" and path[-1] == "leaf" and len(path) == 3
+
+
+def test_self_loop():
+    graph = _graph({"a": ["a", "b"], "b": []})
+    assert graph.cycles() == [["a"]]
+    assert _check_levels(graph) == [["b"], ["a"]]
+    assert graph.critical_path() == ["a", "b"]
+
+
+def test_disconnected():
+    graph = _graph({"a": ["b"], "b": [], "x": ["y"], "y": ["z"], "z": [], "alone": []})
+    levels = _check_levels(graph)
+    assert levels[0] == ["b", "z", "alone"]
+    assert graph.critical_path() == ["x", "y", "z"]
+
+
+def test_empty():
+    graph = DepGraph()
+    assert graph.levels() == []
+    assert graph.critical_path() == []
+    assert graph.cycles() == []
+
+
+def test_conditional_and_existing_deps_are_not_followed():
+    # the test extra would make up a cycle, "existing" is provided by Portage
+    graph = _graph({"a": ["b", "existing"], "b": []}, extras={"b": {"test": ["a"]}})
+    assert "existing" in graph.existing
+    assert graph.cycles() == []
+    assert _check_levels(graph) == [["b"], ["a"]]
+    assert graph.unresolved() == []
+
+
+def test_unresolved():
+    graph = _graph({"a": ["Missing.Dep", "b"], "b": []}, extras={"a": {"doc": ["sphinx"]}})
+    # only the unconditional deps which were not added, by their normalized names
+    assert graph.unresolved() == ["missing-dep"]
+    assert graph.nodes["missing-dep"] == "Missing.Dep"
+    assert _check_levels(graph) == [["b"], ["a"]]
+
+
+def test_names_are_normalized():
+    graph = _graph({"Foo_Bar": ["baz"], "BAZ": []})
+    assert graph.nodes == {"foo-bar": "Foo_Bar", "baz": "BAZ"}
+    assert _check_levels(graph) == [["baz"], ["foo-bar"]]
+
+
+def test_deep_graph_does_not_recurse():
+    n = sys.getrecursionlimit() * 2
+    graph = _graph({f"p{i}": [f"p{i + 1}"] if i + 1 < n else ["p0"] for i in range(n)})
+    assert len(graph.cycles()) == 1 and len(graph.cycles()[0]) == n
+    graph = _graph({f"p{i}": [f"p{i + 1}"] if i + 1 < n else [] for i in range(n)})
+    assert len(graph.levels()) == n
+    assert len(graph.critical_path()) == n
+
+
+def test_to_json():
+    graph = _graph({"a": ["b", "existing"], "b": ["a"]})
+    data = graph.to_json()
+    assert data["cycles"] == [["a", "b"]]
+    assert {node["id"]: node["level"] for node in data["nodes"]} == {"a": 0, "b": 0, "existing": None}
+    assert {"from": "a", "to": "b", "use": "_default", "constraint": [None, None]} in data["edges"]
@@ -0,0 +1,211 @@
+"""
+DistfileStore against a local server which drops connections half-way, ignores
+Range requests, or serves files which do not match their sha256
+"""
+import os
+import hashlib
+from collections import Counter
+from concurrent.futures import wait
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Lock
+
+import pytest
+
+from src import distfiles
+from src.distfiles import DistfileStore, Distfile, DigestError, PARTIAL_SUFFIX
+from src.manifest import HashCache
+
+SIZE = 256 * 1024
+
+
+def content(filename, size=SIZE):
+    """
+    return: bytes, the distfile as it should be
+    """
+    return (filename.encode() * (size // len(filename) + 1))[:size]
+
+
+class DistfileServer(ThreadingHTTPServer):
+    """
+    /files/<filename>, the name tells how it is served:
+        flaky*: the connection is dropped half-way on the first request
+        norange*: Range is ignored, the whole file is sent
+        bad*: a byte differs from the file its sha256 was computed of
+        anything else: honours Range, 416 if it starts at the end
+    """
+    daemon_threads = True
+
+    def __init__(self, size):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.size = size
+        self.lock = Lock()
+        # key: filename
+        # value: list of String, the Range header of every request, "" if there was none
+        self.requests = {}
+        # status => int, the times it was answered
+        self.answers = Counter()
+
+    def url(self, filename):
+        return f"http://127.0.0.1:{self.server_address[1]}/files/{filename}"
+
+    def distfile(self, filename):
+        data = content(filename, self.size)
+        return Distfile(self.url(filename), filename, hashlib.sha256(data).hexdigest(), len(data))
+
+    def ranges(self, filename):
+        return self.requests.get(filename, [])
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        filename = self.path.rsplit("/", 1)[-1]
+        data = content(filename, server.size)
+        if filename.startswith("bad"):
+            data = b"x" + data[1:]
+        header = self.headers.get("Range", "")
+        with server.lock:
+            server.requests.setdefault(filename, []).append(header)
+            first = len(server.requests[filename]) == 1
+        start = int(header[len("bytes="):].split("-")[0]) if header else 0
+        if filename.startswith("norange"):
+            start = 0
+        if start >= len(data):
+            server.answers[416] += 1
+            self.send_response(416)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        status = 206 if start else 200
+        server.answers[status] += 1
+        self.send_response(status)
+        if start:
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        if filename.startswith("flaky") and first:
+            # the Content-Length promised more
+            self.wfile.write(data[start:start + (len(data) - start) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:])
+
+
+@pytest.fixture
+def server(serve):
+    return serve(DistfileServer(SIZE))
+
+
+@pytest.fixture
+def distdir(tmp_path):
+    return tmp_path / "distfiles"
+
+
+@pytest.fixture
+def store(distdir, tmp_path):
+    store = DistfileStore(distdir, workers=4, timeout=10, cache=HashCache(tmp_path / "hashes.json"))
+    yield store
+    store.close()
+
+
+def _verified(path, distfile):
+    return (path.exists() and hashlib.sha256(path.read_bytes()).hexdigest() == distfile.sha256
+            and not path.with_name(path.name + PARTIAL_SUFFIX).exists())
+
+
+def _partial(distdir, distfile, data):
+    distdir.mkdir(exist_ok=True)
+    (distdir / (distfile.filename + PARTIAL_SUFFIX)).write_bytes(data)
+
+
+def test_download_is_verified_once(server, store):
+    distfile = server.distfile("plain-1.0.tar.gz")
+    assert _verified(store.fetch(distfile), distfile)
+    store.fetch(distfile)
+    # a distfile in the distdir is not downloaded again
+    assert server.ranges(distfile.filename) == [""]
+    assert store.downloaded == 1 and store.present == 1
+
+
+def test_dropped_transfer_is_resumed(server, store):
+    distfile = server.distfile("flaky-1.0.tar.gz")
+    assert _verified(store.fetch(distfile), distfile)
+    assert server.ranges(distfile.filename) == ["", f"bytes={SIZE // 2}-"]
+    assert store.resumed == 1
+
+
+def test_partial_file_of_an_earlier_run_is_resumed(server, store, distdir):
+    distfile = server.distfile("interrupted-1.0.tar.gz")
+    _partial(distdir, distfile, content(distfile.filename)[:SIZE // 2])
+    assert _verified(store.fetch(distfile), distfile)
+    assert server.ranges(distfile.filename) == [f"bytes={SIZE // 2}-"]
+
+
+def test_complete_partial_file_is_verified_on_416(server, store, distdir):
+    distfile = server.distfile("complete-1.0.tar.gz")
+    _partial(distdir, distfile, content(distfile.filename))
+    assert _verified(store.fetch(distfile), distfile)
+    assert server.ranges(distfile.filename) == [f"bytes={SIZE}-"]
+    assert server.answers[416] == 1
+
+
+def test_server_ignoring_range_is_downloaded_from_the_start(server, store, distdir):
+    distfile = server.distfile("norange-1.0.tar.gz")
+    _partial(distdir, distfile, b"garbage" * 100)
+    assert _verified(store.fetch(distfile), distfile)
+
+
+def test_digest_mismatch_leaves_nothing_behind(server, store, distdir):
+    distfile = server.distfile("bad-1.0.tar.gz")
+    with pytest.raises(DigestError):
+        store.fetch(distfile)
+    path = distdir / distfile.filename
+    assert not path.exists() and not path.with_name(path.name + PARTIAL_SUFFIX).exists()
+    assert store.failed == 1
+
+
+def test_concurrent_requests_share_one_transfer(server, store):
+    distfile = server.distfile("shared-1.0.tar.gz")
+    futures = [store.submit(distfile) for _ in range(8)]
+    wait(futures)
+    assert all(future.exception() is None for future in futures)
+    assert len(server.ranges(distfile.filename)) == 1
+    assert store.shared == 7
+
+
+def test_verification_is_kept_across_runs(server, distdir, tmp_path, monkeypatch):
+    distfile = server.distfile("kept-1.0.tar.gz")
+    store = DistfileStore(distdir, cache=HashCache(tmp_path / "hashes.json"))
+    store.fetch(distfile)
+    # the download only knows its sha256, the file is hashed for the cache the first time it is checked
+    store.fetch(distfile)
+    store.close()
+
+    def hash_file(path):
+        raise AssertionError(f"{path} hashed again")
+
+    monkeypatch.setattr(distfiles, "hash_file", hash_file)
+    store = DistfileStore(distdir, cache=HashCache(tmp_path / "hashes.json"))
+    assert _verified(store.fetch(distfile), distfile)
+    assert store.present == 1
+    monkeypatch.undo()
+
+    # a file changed since, even of the same size, is hashed again and replaced
+    path = distdir / distfile.filename
+    path.write_bytes(b"x" * SIZE)
+    os.utime(path, ns=(0, path.stat().st_mtime_ns + 10 ** 9))
+    assert _verified(store.fetch(distfile), distfile)
+    assert len(server.ranges(distfile.filename)) == 2
+    store.close()
+
+
+def test_distdir_is_created_by_the_first_download(server, store, distdir):
+    assert not distdir.exists()
+    store.fetch(server.distfile("first-1.0.tar.gz"))
+    assert distdir.is_dir()
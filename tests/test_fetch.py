@@ -0,0 +1,168 @@
+"""
+PyPIFetcher against a local server playing a misbehaving PyPI: it throttles
+(429 with Retry-After, 503), revalidates cached documents (304), has no such
+project (404), answers with HTML, and throttles a burst of concurrent requests
+beyond a few at a time
+"""
+import json
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Lock
+
+import pytest
+
+from src.pypi_fetch import PyPIFetcher, FetchError
+from src.rate_limit import RequestScheduler
+from src.http_cache import HTTPCache
+
+ETAG = '"v1"'
+
+
+def _body(name):
+    return json.dumps({"info": {"name": name, "version": "1.0"}, "releases": {}}).encode()
+
+
+class ThrottlingServer(ThreadingHTTPServer):
+    """
+    /pypi/<name>/json, the name tells how it is answered:
+        throttled*: 429 with Retry-After: 1 on the first request, then the document
+        busy*: 503 on the first two requests, then the document
+        down*: always 503
+        missing*: 404 with PyPI's json
+        html*: 200 with an HTML page
+        anything else: the document with an ETag, 304 if the request has it,
+                       429 while more than cap requests are in flight
+    """
+    daemon_threads = True
+
+    def __init__(self, cap, delay=0.02):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.cap = cap
+        self.delay = delay
+        self.lock = Lock()
+        self.inflight = 0
+        self.peak = 0
+        # key: request path
+        # value: int, the times it was requested
+        self.requests = Counter()
+        # status => int, the times it was answered
+        self.answers = Counter()
+
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/pypi/{{}}/json"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _answer(self, status, data=b"", headers=()):
+        self.server.answers[status] += 1
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        name = self.path.split("/")[2]
+        with server.lock:
+            server.requests[self.path] += 1
+            seen = server.requests[self.path]
+            server.inflight += 1
+            server.peak = max(server.peak, server.inflight)
+            over = server.inflight > server.cap
+        try:
+            time.sleep(server.delay)
+            if name.startswith("throttled") and seen == 1:
+                self._answer(429, headers=[("Retry-After", "1")])
+            elif name.startswith("busy") and seen <= 2 or name.startswith("down"):
+                self._answer(503)
+            elif name.startswith("missing"):
+                self._answer(404, b'{"message": "Not Found"}', [("Content-Type", "application/json")])
+            elif name.startswith("html"):
+                self._answer(200, b"<html><body>maintenance</body></html>", [("Content-Type", "text/html")])
+            elif over:
+                self._answer(429, headers=[("Retry-After", "0.2")])
+            elif self.headers.get("If-None-Match") == ETAG:
+                self._answer(304, headers=[("ETag", ETAG)])
+            else:
+                self._answer(200, _body(name), [("Content-Type", "application/json"), ("ETag", ETAG)])
+        finally:
+            with server.lock:
+                server.inflight -= 1
+
+
+@pytest.fixture
+def server(serve):
+    return serve(ThrottlingServer(cap=3))
+
+
+@pytest.fixture
+def make_fetcher(server, tmp_path):
+    """
+    return: callable(workers, retries) -> a PyPIFetcher of the server, with a fresh HTTP cache
+    """
+    fetchers = []
+
+    def make(workers=8, retries=3):
+        scheduler = RequestScheduler(workers, retries=retries, backoff=0.05)
+        fetcher = PyPIFetcher(workers, 10, server.url(), HTTPCache(tmp_path / f"http{len(fetchers)}", ttl=0),
+                              scheduler=scheduler)
+        fetchers.append(fetcher)
+        return fetcher
+
+    yield make
+    for fetcher in fetchers:
+        fetcher.close()
+
+
+def test_429_with_retry_after_is_retried(server, make_fetcher):
+    fetcher = make_fetcher()
+    assert fetcher.fetch("throttled1")["info"]["name"] == "throttled1"
+    assert server.requests["/pypi/throttled1/json"] == 2
+    assert fetcher.scheduler.throttled == 1
+
+
+def test_503_is_retried(server, make_fetcher):
+    fetcher = make_fetcher()
+    assert fetcher.fetch("busy1")["info"]["name"] == "busy1"
+    assert server.requests["/pypi/busy1/json"] == 3
+
+
+def test_503_beyond_the_retries_raises(server, make_fetcher):
+    fetcher = make_fetcher(retries=3)
+    with pytest.raises(FetchError):
+        fetcher.fetch("down1")
+    assert server.requests["/pypi/down1/json"] == 4
+
+
+def test_304_revalidates_the_cached_document(server, make_fetcher):
+    fetcher = make_fetcher()
+    first = fetcher.fetch("cached1")
+    second = fetcher.fetch("cached1")
+    assert first == second
+    assert fetcher.cache.revalidated == 1 and fetcher.cache.misses == 1
+    assert server.answers[304] == 1
+
+
+@pytest.mark.parametrize("package", ["missing1", "html1"], ids=["404", "html"])
+def test_errors_raise(make_fetcher, package):
+    with pytest.raises(FetchError):
+        make_fetcher().fetch(package)
+
+
+def test_a_burst_is_throttled_and_completes(server, make_fetcher):
+    fetcher = make_fetcher(workers=16, retries=8)
+    names = [f"pkg{i}" for i in range(100)]
+    bodies = fetcher.fetch_many(names, return_exceptions=True)
+    assert [name for name, body in bodies.items() if isinstance(body, Exception)] == []
+    limiter = next(iter(fetcher.scheduler.hosts.values())).limiter
+    # the server throttled beyond its cap, the concurrency limit went down
+    assert server.answers[429] > 0
+    assert limiter.lowest < limiter.maximum
@@ -0,0 +1,107 @@
+import json
+
+import pytest
+
+from src.json_extract import JSONReader, extract_project, INFO_FIELDS
+from src.pypi_parser import PYPICommunicator
+
+
+DOCUMENT = {
+    "info": {
+        "name": "Foo.Bar",
+        "version": "1.0",
+        "license": "MIT",
+        "summary": 'a "quoted" summary, with \\ and café',
+        "home_page": "https://example.org/☃",
+        "description": "# README\n\n" + "escapes: \\\" \\\\ \t é \U0001f600\n" * 5,
+        "requires_dist": ["six (>=1.0)", "pytest ; extra == 'test'"],
+        "classifiers": ["Programming Language :: Python :: 3"],
+        "yanked": False,
+        "requires_python": None,
+        "downloads": {"last_day": -1, "last_week": -1},
+    },
+    "last_serial": 1234567,
+    "releases": {
+        "0.9": [{"filename": "Foo.Bar-0.9.tar.gz", "packagetype": "sdist", "size": 10}],
+        "1.0": [{"filename": "Foo.Bar-1.0.tar.gz", "packagetype": "sdist", "size": 1.5e3},
+                {"filename": "Foo.Bar-1.0-py3-none-any.whl", "packagetype": "bdist_wheel", "size": 20}],
+    },
+    "urls": [{"filename": "Foo.Bar-1.0.tar.gz", "packagetype": "sdist", "size": 1.5e3},
+             {"filename": "Foo.Bar-1.0-py3-none-any.whl", "packagetype": "bdist_wheel", "size": 20}],
+    "vulnerabilities": [],
+}
+
+
+def _expected(document, fields=INFO_FIELDS):
+    sdists = [f for f in document["urls"] if f["packagetype"] == "sdist"]
+    return {"info": {k: v for k, v in document["info"].items() if k in fields},
+            "urls": sdists,
+            "releases": {document["info"]["version"]: sdists}}
+
+
+def _split(data, *cuts):
+    bounds = [0, *cuts, len(data)]
+    return [data[a:b] for a, b in zip(bounds, bounds[1:])]
+
+
+@pytest.mark.parametrize("ensure_ascii", [True, False], ids=["escaped", "utf-8"])
+def test_every_split_point(ensure_ascii):
+    # the cut falls inside keys, strings, escapes, numbers, literals and multi-byte characters
+    data = json.dumps(DOCUMENT, ensure_ascii=ensure_ascii).encode()
+    expected = _expected(DOCUMENT)
+    for cut in range(1, len(data)):
+        body, _ = extract_project(_split(data, cut))
+        assert body == expected, cut
+
+
+def test_one_byte_chunks():
+    document = json.loads(json.dumps(DOCUMENT))
+    document["info"]["description"] *= 100
+    data = json.dumps(document, ensure_ascii=False, indent=2).encode()
+    body, peak = extract_project(bytes([b]) for b in data)
+    assert body == _expected(document)
+    # the README is skipped, never buffered as a whole
+    assert peak < len(document["info"]["description"]) // 10
+
+
+@pytest.mark.parametrize("value", ['a\\"b', "a\\\\", "\\\\\\\"", "\\u00e9\\ud83d\\ude00", "\\/\\b\\f\\n\\r\\t"])
+def test_escapes_across_chunks(value):
+    data = ('{"info": {"summary": "%s", "name": "x"}}' % value).encode()
+    for cut in range(1, len(data)):
+        for second in range(cut + 1, len(data)):
+            body, _ = extract_project(_split(data, cut, second), info_fields=("summary", "name"))
+            assert body["info"] == json.loads(data)["info"], (cut, second)
+
+
+def test_skipped_values_with_brackets_in_strings():
+    data = b'{"info": {"description": "} ] { [ \\" }", "name": "x", "version": "1"}, "releases": {"1": []}}'
+    for cut in range(1, len(data)):
+        body, _ = extract_project(_split(data, cut))
+        assert body == {"info": {"name": "x", "version": "1"}, "releases": {"1": []}}, cut
+
+
+def test_not_found():
+    body, _ = extract_project([b'{"message": "Not Found"}'])
+    assert body == {"message": "Not Found"}
+
+
+def test_truncated_document():
+    data = json.dumps(DOCUMENT).encode()
+    with pytest.raises(ValueError):
+        extract_project([data[:len(data) // 2]])
+
+
+def test_collect_value_matches_json():
+    values = [0, -1.5e-3, True, None, "", "é", [1, [2, {}]], {"a": {"b": [None]}}]
+    data = json.dumps({str(i): v for i, v in enumerate(values)}).encode()
+    for cut in range(1, len(data)):
+        reader = JSONReader(_split(data, cut))
+        assert [reader.collect_value() for _ in reader.iter_object()] == values, cut
+
+
+def test_translate_a_streamed_document():
+    body, _ = extract_project([json.dumps(DOCUMENT).encode()])
+    pypi_id, _, pkgmeta = PYPICommunicator().translate("foo.bar", body)
+    assert pypi_id == "Foo.Bar"
+    assert pkgmeta.long_desc == ""
+    assert pkgmeta.short_desc == DOCUMENT["info"]["summary"]
@@ -0,0 +1,72 @@
+from src.pypi_fetch import PyPIFetcher, latest_version
+
+
+def _page(versions, files):
+    """
+    files: list of (filename, yanked)
+    """
+    return {"meta": {"api-version": "1.1"}, "name": "foo", "versions": versions,
+            "files": [{"filename": name, "url": "u", "hashes": {}, "yanked": yanked} for name, yanked in files]}
+
+
+def test_final_release_beats_pre_release():
+    page = _page(["1.0", "1.1", "2.0rc1"],
+                 [("foo-1.0.tar.gz", False), ("foo-1.1-py3-none-any.whl", False), ("foo-2.0rc1.tar.gz", False)])
+    assert latest_version(page) == "1.1"
+
+
+def test_yanked_release_is_skipped():
+    page = _page(["1.0", "1.1"], [("foo-1.0.tar.gz", False), ("foo-1.1.tar.gz", True)])
+    assert latest_version(page) == "1.0"
+
+
+def test_a_release_is_yanked_only_if_all_its_files_are():
+    page = _page(["1.0", "1.1"], [("foo-1.0.tar.gz", False), ("foo-1.1.tar.gz", True),
+                                  ("foo-1.1-py3-none-any.whl", False)])
+    assert latest_version(page) == "1.1"
+
+
+def test_only_pre_releases():
+    page = _page(["1.0a1", "1.0b2"], [("foo-1.0a1.tar.gz", False), ("foo-1.0b2.tar.gz", False)])
+    assert latest_version(page) == "1.0b2"
+
+
+def test_spelling_of_pypi_is_kept():
+    page = _page(["1.0.0"], [("foo-1.0.tar.gz", False)])
+    assert latest_version(page) == "1.0.0"
+
+
+def test_undecidable_pages():
+    # no PEP 700 versions
+    assert latest_version({"files": [{"filename": "foo-1.0.tar.gz"}]}) is None
+    # the highest release has no files, it may be yanked
+    assert latest_version(_page(["1.0", "2.0"], [("foo-1.0.tar.gz", False)])) is None
+    # a file of an unknown version
+    assert latest_version(_page(["1.0"], [("foo-1.0.tar.gz", False), ("foo-0.9-1.tar.gz", False)])) is None
+    # a legacy version
+    assert latest_version(_page(["1.0", "2004d"], [("foo-1.0.tar.gz", False)])) is None
+
+
+def test_fetch_falls_back_to_the_full_document():
+    fetcher = PyPIFetcher(1, lean=True)
+    full = {"info": {"name": "foo", "version": "2.0"}, "releases": {"2.0": []}}
+    requested = []
+
+    def get_json(url, accept=None, stream=False):
+        requested.append(url)
+        if "/simple/" in url:
+            return _page(["1.0", "2.0"], [("foo-1.0.tar.gz", False)])
+        return full
+
+    fetcher.get_json = get_json
+    try:
+        assert fetcher.fetch("foo") is full
+    finally:
+        fetcher.close()
+    assert requested == ["https://pypi.org/simple/foo/", "https://pypi.org/pypi/foo/json"]
+
+
+def test_project_name_with_dashes():
+    page = _page(["1.0", "1.1"], [("foo-bar-1.0.tar.gz", False), ("foo_bar-1.1-py3-none-any.whl", False)])
+    page["name"] = "foo-bar"
+    assert latest_version(page) == "1.1"
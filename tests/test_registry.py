@@ -0,0 +1,111 @@
+"""
+every package of a dependency graph is translated once: the graph is a diamond,
+every package depends on the next three, and the last one depends on the first
+again, so it is a cycle as well; several threads translate it from the same root
+"""
+import json
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+
+import pytest
+
+from src.metadata_repr import ToBeGeneratedEbuilds
+from src.name_index import NameIndex, normalize_pypi_name
+from src.pypi_fetch import PyPIFetcher, FetchError
+from src.pypi_parser import PYPICommunicator, PYPIParser
+from src.registry import ShardedRegistry
+
+
+class CountingSource:
+    """
+    a local source of a diamond-shaped, cyclic graph of packages, dia0 ... dia{n-1}
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.lock = Lock()
+        # key: normalized name
+        # value: int, the times it was requested
+        self.requests = Counter()
+
+    def get(self, package):
+        """
+        Input:
+            package: ToString, project name
+
+        return: bytes, the json document, or None if it is not found
+        """
+        key = normalize_pypi_name(package)
+        with self.lock:
+            self.requests[key] += 1
+        if not key.startswith("dia") or not key[3:].isdigit() or int(key[3:]) >= self.n:
+            return None
+        i = int(key[3:])
+        requires = [f"dia{j}" for j in (i + 1, i + 2, i + 3) if j < self.n]
+        if i == self.n - 1:
+            requires.append("dia0")
+        return json.dumps({"info": {"name": f"dia{i}", "version": "1.0", "license": "MIT", "summary": "s",
+                                    "home_page": "h", "description": "d", "requires_dist": requires,
+                                    "classifiers": []},
+                           "releases": {}}).encode()
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """
+    a fresh ToBeGeneratedEbuilds, and nothing provided by Portage
+    """
+    registry = ShardedRegistry()
+    monkeypatch.setattr(ToBeGeneratedEbuilds, "registry", registry)
+    monkeypatch.setattr(PYPIParser, "PN_database", NameIndex())
+    return registry
+
+
+@pytest.fixture
+def source(monkeypatch):
+    source = CountingSource(200)
+    fetcher = PyPIFetcher(source=source)
+    monkeypatch.setattr(PYPICommunicator, "fetcher", fetcher)
+    yield source
+    fetcher.close()
+
+
+@pytest.mark.parametrize("threads", [1, 8])
+def test_every_package_is_fetched_once(registry, source, threads):
+    with ThreadPoolExecutor(threads) as executor:
+        futures = [executor.submit(PYPICommunicator().test, "dia0") for _ in range(threads)]
+        for future in futures:
+            assert future.result()[0] == "dia0"
+    assert len(ToBeGeneratedEbuilds.items()) == source.n
+    assert set(source.requests) == {f"dia{i}" for i in range(source.n)}
+    assert source.requests.most_common(1)[0][1] == 1
+
+
+def test_other_spellings_join_the_translation(registry, source):
+    PYPICommunicator().test("dia0")
+    for spelling in ("DIA0", "Dia0", "dia0"):
+        assert PYPICommunicator().test(spelling)[0] == "dia0"
+    assert source.requests["dia0"] == 1
+
+
+def test_a_failed_package_is_not_translated(registry, source):
+    with pytest.raises(FetchError):
+        PYPICommunicator().test("missing")
+    assert ToBeGeneratedEbuilds.items() == []
+    assert "Missing" in registry
+
+
+def test_claim():
+    registry = ShardedRegistry(shards=4)
+    future, owner = registry.claim("Foo.Bar")
+    assert owner and isinstance(future, Future)
+    # all spellings share one Future
+    assert registry.claim("foo_bar") == (future, False)
+    assert "FOO-BAR" in registry and len(registry) == 1
+    assert registry.items() == []
+    future.set_result("done")
+    failed, _ = registry.claim("baz")
+    failed.set_exception(ValueError())
+    assert registry.items() == [("foo-bar", "done")]
+    assert "2 packages translated (1 failed), 1 requests" in registry.describe_stats()
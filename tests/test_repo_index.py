@@ -0,0 +1,137 @@
+import os
+import json
+from functools import cmp_to_key
+
+import pytest
+
+from src.repo_index import RepoIndex, vercmp, ebuild_versions, INDEX_FORMAT
+
+
+@pytest.mark.parametrize("older, newer", [
+    ("1.0", "1.0.1"),
+    ("1.2", "1.10"),
+    ("1.01", "1.1"),
+    ("1.001", "1.01"),
+    ("1.0", "1.0a"),
+    ("1.0a", "1.0b"),
+    ("1.0_alpha", "1.0_beta"),
+    ("1.0_beta", "1.0_pre"),
+    ("1.0_pre", "1.0_rc"),
+    ("1.0_rc", "1.0"),
+    ("1.0", "1.0_p"),
+    ("1.0_rc1", "1.0_rc2"),
+    ("1.0_rc9", "1.0_rc10"),
+    ("1.0_p1", "1.0_p2"),
+    ("1.0_alpha_p1", "1.0_beta"),
+    ("1.0_rc1_alpha", "1.0_rc1"),
+    ("1.0_rc1", "1.0_rc1_p1"),
+    ("1.0", "1.0-r1"),
+    ("1.0-r1", "1.0-r2"),
+    ("1.0-r9", "1.0-r10"),
+    ("1.0-r99", "1.0.1"),
+    ("1.0_rc1-r5", "1.0"),
+    ("1.0z", "1.0.1"),
+    ("2", "10"),
+])
+def test_vercmp_order(older, newer):
+    assert vercmp(older, newer) < 0
+    assert vercmp(newer, older) > 0
+
+
+@pytest.mark.parametrize("a, b", [("1.0", "1.0"), ("1.0", "1.0-r0"), ("1.0_p", "1.0_p0"), ("01.0", "1.0")])
+def test_vercmp_equal(a, b):
+    assert vercmp(a, b) == 0
+    assert vercmp(b, a) == 0
+
+
+def test_vercmp_invalid():
+    with pytest.raises(ValueError):
+        vercmp("1.0", "1.0-beta")
+
+
+def _package(repo, cate_pn, versions, pypi_id=None):
+    pkg_dir = repo / cate_pn
+    pkg_dir.mkdir(parents=True, exist_ok=True)
+    remote_id = f'<upstream><remote-id type="pypi">{pypi_id}</remote-id></upstream>' if pypi_id else ""
+    (pkg_dir / "metadata.xml").write_text(f'<?xml version="1.0" encoding="UTF-8"?>\n<pkgmetadata>{remote_id}</pkgmetadata>\n')
+    for version in versions:
+        (pkg_dir / f"{cate_pn.split('/')[1]}-{version}.ebuild").write_text("EAPI=8\n")
+    return pkg_dir
+
+
+def _touch(path, delta):
+    # a later mtime than the index saw, without sleeping
+    st = os.stat(path)
+    os.utime(path, (st.st_atime, st.st_mtime + delta))
+
+
+@pytest.fixture
+def repo(tmp_path):
+    repo = tmp_path / "repo"
+    _package(repo, "dev-python/foo", ["1.0", "1.2"], "Foo")
+    _package(repo, "dev-python/bar", ["2.0"], "bar")
+    _package(repo, "app-misc/baz", ["0.1"])
+    return repo
+
+
+def _refresh(index, repo):
+    index.refresh([repo], version_lookup=lambda repo, cate_pns: {
+        cate_pn: max(versions, key=cmp_to_key(vercmp))
+        for cate_pn, versions in ebuild_versions(repo, cate_pns).items()}, jobs=1)
+    return index.stats["hashed"], index.stats["parsed"]
+
+
+def test_refresh_is_incremental(tmp_path, repo):
+    index = RepoIndex(tmp_path / "index.json", rebuild=True)
+    assert _refresh(index, repo) == (3, 3)
+    assert dict(index.merged([repo])) == {"Foo": ("dev-python", "foo", "1.2"), "bar": ("dev-python", "bar", "2.0")}
+
+    # unchanged: nothing is hashed
+    assert _refresh(index, repo) == (0, 0)
+
+    # touched but unchanged: hashed, not parsed
+    _touch(repo / "dev-python/bar/metadata.xml", 10)
+    assert _refresh(index, repo) == (1, 0)
+
+    # a new ebuild changes the digest
+    (repo / "dev-python/foo/foo-1.10.ebuild").write_text("EAPI=8\n")
+    _touch(repo / "dev-python/foo", 10)
+    assert _refresh(index, repo) == (1, 1)
+    assert index.merged([repo])["Foo"] == ("dev-python", "foo", "1.10")
+
+    # a changed remote-id
+    _package(repo, "app-misc/baz", [], "Baz")
+    _touch(repo / "app-misc/baz/metadata.xml", 10)
+    assert _refresh(index, repo) == (1, 1)
+    assert index.merged([repo])["Baz"] == ("app-misc", "baz", "0.1")
+
+    # an added package
+    _package(repo, "dev-python/qux", ["3.0"], "qux")
+    assert _refresh(index, repo) == (1, 1)
+
+    # a removed package is dropped, its metadata.xml is gone
+    os.remove(repo / "dev-python/bar/metadata.xml")
+    assert _refresh(index, repo) == (0, 0)
+    assert "bar" not in index.merged([repo])
+    assert set(index.repos[str(repo)]) == {"dev-python/foo", "app-misc/baz", "dev-python/qux"}
+
+
+def test_saved_index_is_reused(tmp_path, repo):
+    path = tmp_path / "cache" / "index.json"
+    index = RepoIndex(path)
+    _refresh(index, repo)
+    index.save()
+    assert json.loads(path.read_text())["format"] == INDEX_FORMAT
+    assert os.listdir(path.parent) == ["index.json"]
+
+    index = RepoIndex(path)
+    assert _refresh(index, repo) == (0, 0)
+    assert index.merged([repo])["Foo"] == ("dev-python", "foo", "1.2")
+    # rebuild ignores the stored index
+    assert _refresh(RepoIndex(path, rebuild=True), repo) == (3, 3)
+
+
+def test_outdated_index_is_ignored(tmp_path, repo):
+    path = tmp_path / "index.json"
+    path.write_text(json.dumps({"format": INDEX_FORMAT - 1, "repos": {str(repo): {}}}))
+    assert _refresh(RepoIndex(path), repo) == (3, 3)
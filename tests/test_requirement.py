@@ -0,0 +1,94 @@
+import pytest
+from packaging.requirements import Requirement as PackagingRequirement
+
+from src.requirement import (parse_requirement, version_hint, marker_extras, marker_variables,
+                             InvalidRequirement, Variable, Comparison, BoolOp)
+
+SAMPLE = [
+    "numpy",
+    "numpy>=1.17",
+    "numpy >= 1.17 , < 2",
+    "requests (>=2.20,<3)",
+    "foo>=1.0,",
+    "foo (>=1.0,)",
+    "black==22.*",
+    "pkg~=1.4.2",
+    "pkg!=1.5",
+    "pkg===1.0+local",
+    "horovod[torch]>=0.19",
+    "horovod[torch, keras]",
+    "zope.interface>=5",
+    "typing_extensions>=3.7.4; python_version < '3.8'",
+    "pytest ; extra == 'test'",
+    'pywin32>=1.0; sys_platform == "win32" and extra == "win"',
+    "a; (python_version < '3.8' or os_name == 'nt') and extra == 'x'",
+    "torch @ https://example.org/torch.whl",
+    "torch @ https://example.org/torch.whl ; extra == 'gpu'",
+]
+
+
+@pytest.mark.parametrize("string", SAMPLE)
+def test_same_as_packaging(string):
+    requirement = parse_requirement(string)
+    expected = PackagingRequirement(string)
+    assert requirement.name == expected.name
+    assert set(requirement.extras) == expected.extras
+    assert {op + version for op, version in requirement.specifiers} == {str(s) for s in expected.specifier}
+    assert requirement.url == expected.url
+    assert (requirement.marker is None) == (expected.marker is None)
+
+
+@pytest.mark.parametrize("string", [
+    "",
+    "foo,",
+    "foo>=1.0,,<2",
+    "foo>>1",
+    "foo[a,]",
+    "foo; python_version <",
+    "foo; (extra == 'x'",
+    "foo; extra == 'x' and",
+    "foo; unknown_variable == '1'",
+])
+def test_invalid(string):
+    with pytest.raises(InvalidRequirement):
+        parse_requirement(string)
+
+
+def test_specifiers_keep_their_order():
+    assert parse_requirement("foo>=1.0,<2,!=1.5").specifiers == ((">=", "1.0"), ("<", "2"), ("!=", "1.5"))
+
+
+def test_marker_tree():
+    marker = parse_requirement("a; (python_version < '3.8' or os_name == 'nt') and extra == 'x'").marker
+    assert marker == BoolOp("and", (
+        BoolOp("or", (Comparison(Variable("python_version"), "<", "3.8"),
+                      Comparison(Variable("os_name"), "==", "nt"))),
+        Comparison(Variable("extra"), "==", "x")))
+
+
+def test_legacy_marker_variables():
+    marker = parse_requirement("a; os.name == 'posix' and 'linux' in sys.platform").marker
+    assert marker_variables(marker) == {"os_name", "sys_platform"}
+    assert marker.operands[1] == Comparison("linux", "in", Variable("sys_platform"))
+
+
+def test_marker_extras():
+    assert marker_extras(parse_requirement("a; extra == 'test'").marker) == ["test"]
+    assert marker_extras(parse_requirement("a; 'dev' == extra or extra == \"doc\"").marker) == ["dev", "doc"]
+    assert marker_extras(parse_requirement("a; extra != 'test'").marker) == []
+    assert marker_extras(None) == []
+
+
+def test_version_hint():
+    assert version_hint(parse_requirement("foo")) == (None, None)
+    assert version_hint(parse_requirement("foo>=1.0,<2")) == (">=", "1.0")
+    assert version_hint(parse_requirement("foo==1.4.*")) == ("=", "1.4*")
+    assert version_hint(parse_requirement("foo~=1.4")) == ("~", "1.4")
+    assert version_hint(parse_requirement("foo (!=1.5)")) == ("!=", "1.5")
+
+
+def test_parses_are_cached():
+    parse_requirement.cache_clear()
+    first = parse_requirement("cached-pkg>=1")
+    assert parse_requirement("cached-pkg>=1") is first
+    assert parse_requirement.cache_info().hits == 1